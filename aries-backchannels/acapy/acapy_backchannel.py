@@ -8,7 +8,6 @@ import subprocess
 import sys
 import uuid
 from timeit import default_timer
-from time import sleep
 from operator import itemgetter
 
 from aiohttp import (
@@ -21,8 +20,11 @@ from aiohttp import (
 )
 
 from python.agent_backchannel import AgentBackchannel, default_genesis_txns, RUN_MODE, START_TIMEOUT
-from python.utils import require_indy, flatten, log_json, log_msg, log_timer, output_reader, prompt_loop
-from python.storage import store_resource, get_resource, delete_resource, push_resource, pop_resource, pop_resource_latest
+from python.utils import require_indy, flatten, log_json, log_msg, log_payload, log_timer, output_reader, prompt_loop
+from python.storage import close_storage, store_resource, get_resource, delete_resource, push_resource, wait_pop, wait_pop_latest
+from python.metrics import observe_admin_request
+from python.tracing import span, trace_headers
+from python.webhooks import WebhookDispatcher
 
 #from helpers.jsonmapper.json_mapper import JsonMapper
 
@@ -258,57 +260,54 @@ class AcaPyAgentBackchannel(AgentBackchannel):
         app.add_routes([web.post("/webhooks/topic/{topic}/", self._receive_webhook)])
         runner = web.AppRunner(app)
         await runner.setup()
+        self.webhook_dispatcher = WebhookDispatcher(self.handle_webhook)
         self.webhook_site = web.TCPSite(runner, "0.0.0.0", webhook_port)
         await self.webhook_site.start()
         print("Listening to web_hooks on port", webhook_port)
 
     async def _receive_webhook(self, request: ClientRequest):
         topic = request.match_info["topic"]
-        payload = await request.json()
-        await self.handle_webhook(topic, payload)
-        # TODO web hooks don't require a response???
+        # acknowledge straight away, the dispatcher runs handle_webhook in the background
+        self.webhook_dispatcher.submit(topic, await request.read())
         return web.Response(text="")
 
     async def handle_webhook(self, topic: str, payload):
-        if topic != "webhook":  # would recurse
-            handler = f"handle_{topic}"
-
-            # Remove this handler change when bug is fixed. 
-            if handler == "handle_oob-invitation":
-                handler = "handle_oob_invitation"
-
-            method = getattr(self, handler, None)
+        handler_name = self.WEBHOOK_HANDLERS.get(topic)
+        if handler_name:
             # put a log message here
-            log_msg('Passing webhook payload to handler ' + handler)
-            if method:
-                await method(payload)
-            else:
-                log_msg(
-                    f"Error: agent {self.ident} "
-                    f"has no method {handler} "
-                    f"to handle webhook on topic {topic}"
-                )
+            log_msg('Passing webhook payload to handler ' + handler_name)
+            await getattr(self, handler_name)(payload)
+        elif topic != "webhook":
+            log_msg(
+                f"Error: agent {self.ident} "
+                f"has no handler "
+                f"for webhook on topic {topic}"
+            )
         else:
-            log_msg('in webhook, topic is: ' + topic + ' payload is: ' + json.dumps(payload))
+            log_payload('in webhook, topic is: ' + topic + ' payload is: ', payload)
 
     async def handle_connections(self, message):
         if "invitation_msg_id" in message:
             # This is an did-exchange message based on a Non-Public DID invitation
             invitation_id = message["invitation_msg_id"]
             push_resource(invitation_id, "didexchange-msg", message)
+            self.publish_event("did-exchange", message, record_id=message.get("connection_id"), thread_id=invitation_id)
         elif "request_id" in message:
             # This is a did-exchange message based on a Public DID non-invitation
             request_id = message["request_id"]
             push_resource(request_id, "didexchange-msg", message)
+            self.publish_event("did-exchange", message, record_id=message.get("connection_id"), thread_id=request_id)
         else:
             connection_id = message["connection_id"]
             push_resource(connection_id, "connection-msg", message)
-        log_msg('Received a Connection Webhook message: ' + json.dumps(message))
+            self.publish_event("connection", message, record_id=connection_id)
+        log_payload('Received a Connection Webhook message: ', message)
 
     async def handle_issue_credential(self, message):
         thread_id = message["thread_id"]
         push_resource(thread_id, "credential-msg", message)
-        log_msg('Received Issue Credential Webhook message: ' + json.dumps(message)) 
+        self.publish_event("issue-credential", message, record_id=message.get("credential_exchange_id"), thread_id=thread_id)
+        log_payload('Received Issue Credential Webhook message: ', message) 
         if "revocation_id" in message: # also push as a revocation message 
             push_resource(thread_id, "revocation-registry-msg", message)
             log_msg('Issue Credential Webhook message contains revocation info') 
@@ -316,7 +315,8 @@ class AcaPyAgentBackchannel(AgentBackchannel):
     async def handle_issue_credential_v2_0(self, message):
         thread_id = message["thread_id"]
         push_resource(thread_id, "credential-msg", message)
-        log_msg('Received Issue Credential v2 Webhook message: ' + json.dumps(message)) 
+        self.publish_event("issue-credential-v2", message, record_id=message.get("cred_ex_id"), thread_id=thread_id)
+        log_payload('Received Issue Credential v2 Webhook message: ', message) 
         if "revocation_id" in message: # also push as a revocation message 
             push_resource(thread_id, "revocation-registry-msg", message)
             log_msg('Issue Credential Webhook message contains revocation info') 
@@ -324,29 +324,47 @@ class AcaPyAgentBackchannel(AgentBackchannel):
     async def handle_present_proof_v2_0(self, message):
         thread_id = message["thread_id"]
         push_resource(thread_id, "presentation-msg", message)
-        log_msg('Received a Present Proof v2 Webhook message: ' + json.dumps(message))
+        self.publish_event("proof-v2", message, record_id=message.get("pres_ex_id"), thread_id=thread_id)
+        log_payload('Received a Present Proof v2 Webhook message: ', message)
 
     async def handle_present_proof(self, message):
         thread_id = message["thread_id"]
         push_resource(thread_id, "presentation-msg", message)
-        log_msg('Received a Present Proof Webhook message: ' + json.dumps(message))
+        self.publish_event("proof", message, record_id=message.get("presentation_exchange_id"), thread_id=thread_id)
+        log_payload('Received a Present Proof Webhook message: ', message)
 
     async def handle_revocation_registry(self, message):
         # No thread id in the webhook for revocation registry messages
         cred_def_id = message["cred_def_id"]
         push_resource(cred_def_id, "revocation-registry-msg", message)
-        log_msg('Received Revocation Registry Webhook message: ' + json.dumps(message)) 
+        self.publish_event("revocation-registry", message, record_id=cred_def_id)
+        log_payload('Received Revocation Registry Webhook message: ', message) 
 
     async def handle_oob_invitation(self, message):
         # No thread id in the webhook for revocation registry messages
         invitation_id = message["invitation_id"]
         push_resource(invitation_id, "oob-inviation-msg", message)
-        log_msg('Received Out of Band Invitation Webhook message: ' + json.dumps(message)) 
+        self.publish_event("out-of-band", message, record_id=invitation_id)
+        log_payload('Received Out of Band Invitation Webhook message: ', message) 
 
     async def handle_problem_report(self, message):
         thread_id = message["thread_id"]
         push_resource(thread_id, "problem-report-msg", message)
-        log_msg('Received Problem Report Webhook message: ' + json.dumps(message)) 
+        self.publish_event("problem-report", message, thread_id=thread_id)
+        log_payload('Received Problem Report Webhook message: ', message)
+
+    # webhook topic -> handler method name, looked up on the instance so subclasses can override it
+    WEBHOOK_HANDLERS = {
+        "connections": "handle_connections",
+        "issue_credential": "handle_issue_credential",
+        "issue_credential_v2_0": "handle_issue_credential_v2_0",
+        "present_proof": "handle_present_proof",
+        "present_proof_v2_0": "handle_present_proof_v2_0",
+        "revocation_registry": "handle_revocation_registry",
+        "oob-invitation": "handle_oob_invitation",
+        "oob_invitation": "handle_oob_invitation",
+        "problem_report": "handle_problem_report",
+    }
 
     async def swap_thread_id_for_exchange_id(self, thread_id, data_type, id_txt):
         timeout = 0
@@ -367,12 +385,17 @@ class AcaPyAgentBackchannel(AgentBackchannel):
         self, method, path, data=None, text=False, params=None
     ) -> (int, str):
         params = {k: v for (k, v) in (params or {}).items() if v is not None}
-        async with self.client_session.request(
-            method, self.admin_url + path, json=data, params=params
-        ) as resp:
-            resp_status = resp.status
-            resp_text = await resp.text()
-            return (resp_status, resp_text)
+        start = default_timer()
+        try:
+            with span(f"{method} {path}", "admin"):
+                async with self.client_session.request(
+                    method, self.admin_url + path, json=data, params=params, headers=trace_headers()
+                ) as resp:
+                    resp_status = resp.status
+                    resp_text = await resp.text()
+                    return (resp_status, resp_text)
+        finally:
+            observe_admin_request(method, default_timer() - start)
 
     async def admin_GET(self, path, text=False, params=None) -> (int, str):
         try:
@@ -861,12 +884,7 @@ class AcaPyAgentBackchannel(AgentBackchannel):
         self, topic, rec_id=None, text=False, params=None
     ) -> (int, str):
         if topic == "connection" and rec_id:
-            connection_msg = pop_resource(rec_id, "connection-msg")
-            i = 0
-            while connection_msg is None and i < MAX_TIMEOUT:
-                sleep(1)
-                connection_msg = pop_resource(rec_id, "connection-msg")
-                i = i + 1
+            connection_msg = await wait_pop(rec_id, "connection-msg", MAX_TIMEOUT)
 
             resp_status = 200
             if connection_msg:
@@ -877,12 +895,7 @@ class AcaPyAgentBackchannel(AgentBackchannel):
             return (resp_status, resp_text)
 
         if topic == "did-exchange" and rec_id:
-            didexchange_msg = pop_resource(rec_id, "didexchange-msg")
-            i = 0
-            while didexchange_msg is None and i < MAX_TIMEOUT:
-                sleep(1)
-                didexchange_msg = pop_resource(rec_id, "didexchange-msg")
-                i = i + 1
+            didexchange_msg = await wait_pop(rec_id, "didexchange-msg", MAX_TIMEOUT)
 
             resp_status = 200
             if didexchange_msg:
@@ -896,12 +909,7 @@ class AcaPyAgentBackchannel(AgentBackchannel):
         # Poping webhook messages wihtout an id is unusual. This code may be removed when issue 944 is fixed
         # see https://app.zenhub.com/workspaces/von---verifiable-organization-network-5adf53987ccbaa70597dbec0/issues/hyperledger/aries-cloudagent-python/944
         if topic == "did-exchange" and rec_id is None:
-            didexchange_msg = pop_resource_latest("connection-msg")
-            i = 0
-            while didexchange_msg is None and i < MAX_TIMEOUT:
-                sleep(1)
-                didexchange_msg = pop_resource_latest("connection-msg")
-                i = i + 1
+            didexchange_msg = await wait_pop_latest("connection-msg", MAX_TIMEOUT)
 
             resp_status = 200
             if didexchange_msg:
@@ -913,12 +921,7 @@ class AcaPyAgentBackchannel(AgentBackchannel):
             return (resp_status, resp_text)
 
         elif topic == "issue-credential" and rec_id:
-            credential_msg = pop_resource(rec_id, "credential-msg")
-            i = 0
-            while credential_msg is None and i < MAX_TIMEOUT:
-                sleep(1)
-                credential_msg = pop_resource(rec_id, "credential-msg")
-                i = i + 1
+            credential_msg = await wait_pop(rec_id, "credential-msg", MAX_TIMEOUT)
 
             resp_status = 200
             if credential_msg:
@@ -929,12 +932,7 @@ class AcaPyAgentBackchannel(AgentBackchannel):
             return (resp_status, resp_text)
 
         elif topic == "credential" and rec_id:
-            credential_msg = pop_resource(rec_id, "credential-msg")
-            i = 0
-            while credential_msg is None and i < MAX_TIMEOUT:
-                sleep(1)
-                credential_msg = pop_resource(rec_id, "credential-msg")
-                i = i + 1
+            credential_msg = await wait_pop(rec_id, "credential-msg", MAX_TIMEOUT)
 
             resp_status = 200
             if credential_msg:
@@ -945,12 +943,7 @@ class AcaPyAgentBackchannel(AgentBackchannel):
             return (resp_status, resp_text)
         
         elif topic == "proof" and rec_id:
-            presentation_msg = pop_resource(rec_id, "presentation-msg")
-            i = 0
-            while presentation_msg is None and i < MAX_TIMEOUT:
-                sleep(1)
-                presentation_msg = pop_resource(rec_id, "presentation-msg")
-                i = i + 1
+            presentation_msg = await wait_pop(rec_id, "presentation-msg", MAX_TIMEOUT)
 
             resp_status = 200
             if presentation_msg:
@@ -962,12 +955,7 @@ class AcaPyAgentBackchannel(AgentBackchannel):
             return (resp_status, resp_text)
 
         elif topic == "revocation-registry" and rec_id:
-            revocation_msg = pop_resource(rec_id, "revocation-registry-msg")
-            i = 0
-            while revocation_msg is None and i < MAX_TIMEOUT:
-                sleep(1)
-                revocation_msg = pop_resource(rec_id, "revocation-registry-msg")
-                i = i + 1
+            revocation_msg = await wait_pop(rec_id, "revocation-registry-msg", MAX_TIMEOUT)
 
             resp_status = 200
             if revocation_msg:
@@ -1091,8 +1079,10 @@ class AcaPyAgentBackchannel(AgentBackchannel):
         if self.proc:
             await loop.run_in_executor(None, self._terminate)
         await self.client_session.close()
+        close_storage()
         if self.webhook_site:
             await self.webhook_site.stop()
+            await self.webhook_dispatcher.close()
 
     def map_test_json_to_admin_api_json(self, topic, operation, data):
         # If the translation of the json get complicated in the future we might want to consider a switch to JsonMapper or equivalent.
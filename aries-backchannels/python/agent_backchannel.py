@@ -5,20 +5,14 @@ import logging
 import os
 import traceback
 import random
+import re
 import subprocess
 import sys
-import prompt_toolkit
-from prompt_toolkit.application import run_in_terminal
-from prompt_toolkit.eventloop.defaults import use_asyncio_event_loop
-from prompt_toolkit.patch_stdout import patch_stdout
+import time
+from collections import deque
+from itertools import islice
 from timeit import default_timer
 
-import pygments
-from pygments.filter import Filter
-from pygments.lexer import Lexer
-from pygments.lexers.data import JsonLdLexer
-from prompt_toolkit.formatted_text import FormattedText, PygmentsTokens
-
 from aiohttp import (
     web,
     ClientSession,
@@ -28,10 +22,15 @@ from aiohttp import (
     ClientTimeout,
 )
 
-from python.utils import require_indy, flatten, log_json, log_msg, log_timer, output_reader, prompt_loop, read_operations
+from python.utils import require_indy, flatten, log_json, log_msg, log_timer, output_reader, prompt_loop, read_operations, compile_operations, find_operation, load_operations, env_flag
+from python.storage import open_storage
+from python.metrics import metrics_middleware, register_operations, render_metrics
+from python.tracing import open_trace, tracing_middleware
 
-import ptvsd
-ptvsd.enable_attach()
+# the debugger listener is only opened on request, see Debugging.md
+if env_flag("ENABLE_PTVSD"):
+    import ptvsd
+    ptvsd.enable_attach()
 
 LOGGER = logging.getLogger(__name__)
 
@@ -41,6 +40,15 @@ DEFAULT_EXTERNAL_HOST = "localhost"
 
 START_TIMEOUT = float(os.getenv("START_TIMEOUT", 30.0))
 
+# state change events kept for clients resuming /agent/events from a sequence number
+EVENT_HISTORY = int(os.getenv("EVENT_HISTORY", 10_000))
+EVENT_KEEPALIVE = 15.0
+
+# GET /agent/command/{topic}/{id}?wait_for_state=<s1,s2>&timeout=<secs> long-poll limits
+LONG_POLL_TIMEOUT = 60.0
+LONG_POLL_MAX_TIMEOUT = 300.0
+LONG_POLL_RECHECK = 2.0
+
 RUN_MODE = os.getenv("RUNMODE")
 
 GENESIS_URL = os.getenv("GENESIS_URL")
@@ -87,6 +95,39 @@ async def default_genesis_txns():
     return genesis
 
 
+BATCH_REFERENCE = re.compile(r"\$\{(\d+)((?:\.[^.}]+)*)\}")
+
+
+def batch_references(command):
+    """
+    Indexes of the earlier batch results a batch command refers to.
+    """
+    text = json.dumps([command.get("id"), command.get("data")])
+    return sorted({int(m.group(1)) for m in BATCH_REFERENCE.finditer(text)})
+
+
+def resolve_batch_references(value, results):
+    """
+    Replace "${<index>.<path>}" references in value with fields of earlier batch results.
+    """
+    def lookup(match):
+        found = results[int(match.group(1))]["response"]
+        for field in match.group(2).split(".")[1:]:
+            found = found[int(field)] if isinstance(found, list) else found[field]
+        return found
+
+    if isinstance(value, str):
+        match = BATCH_REFERENCE.fullmatch(value)
+        if match:
+            return lookup(match)
+        return BATCH_REFERENCE.sub(lambda m: str(lookup(m)), value)
+    if isinstance(value, dict):
+        return {k: resolve_batch_references(v, results) for k, v in value.items()}
+    if isinstance(value, list):
+        return [resolve_batch_references(v, results) for v in value]
+    return value
+
+
 class AgentBackchannel:
     """
     Base class for building Aries agent backchannel adapters for integration into the interoperability test suite.
@@ -135,8 +176,20 @@ class AgentBackchannel:
         self.did = None
         self.postgres = False
 
+        self.operations = []
+        self.operation_index = None
+
+        self.events = deque(maxlen=EVENT_HISTORY)
+        self.event_seq = 0
+        self.event_signal = None
+
         self.client_session: ClientSession = ClientSession()
 
+        # reload webhook/exchange state from a previous run if STORAGE_BACKEND persists it
+        open_storage(self.ident)
+        # write Chrome trace-event spans if TRACE_DIR is set
+        open_trace(self.ident)
+
     def activate(self, active: bool = True):
         self.ACTIVE = active
 
@@ -166,13 +219,36 @@ class AgentBackchannel:
 
         Operations for each topic are in the backchannel_operations.csv file, generated from
         the Google sheet at https://bit.ly/AriesTestHarnessScenarios
+
+        POST to /agent/command/batch runs several commands in one round trip, see _post_batch_backchannel
+
+        GET /agent/events streams protocol state changes as server-sent events, see _get_events_backchannel
+
+        GET /agent/command/{topic}/{id}?wait_for_state=<s1,s2>&timeout=<secs> holds the request until the
+        record reaches one of the states or the timeout passes, see wait_for_agent_state
+
+        GET /agent/metrics returns request counts and latencies in the Prometheus text format, see python/metrics.py
         """
         #operations_file = "../backchannel_operations.txt"
         #self.operations = read_operations(file_name=operations_file, parser="pipe")
         operations_file = "./backchannel_operations.csv"
-        self.operations = read_operations(file_name=operations_file)
+        (self.operations, self.operation_index) = load_operations(operations_file)
+        register_operations(self.operations)
 
-        app = web.Application()
+        runner = web.AppRunner(self.backchannel_app())
+        await runner.setup()
+        self.backchannel_site = web.TCPSite(runner, "0.0.0.0", backchannel_port)
+        await self.backchannel_site.start()
+        print("Listening to backchannel on port", backchannel_port)
+
+    def backchannel_app(self) -> web.Application:
+        """
+        The web application serving the backchannel routes, see listen_backchannel.
+        """
+        app = web.Application(middlewares=[tracing_middleware, metrics_middleware])
+        # must come before the /agent/command/{topic} routes, which would otherwise match "batch"
+        app.add_routes([web.post("/agent/command/batch/", self._post_batch_backchannel)])
+        app.add_routes([web.post("/agent/command/batch", self._post_batch_backchannel)])
         app.add_routes([web.post("/agent/command/{topic}/", self._post_command_backchannel)])
         app.add_routes([web.post("/agent/command/{topic}", self._post_command_backchannel)])
         app.add_routes([web.post("/agent/command/{topic}/{operation}/", self._post_command_backchannel)])
@@ -189,11 +265,11 @@ class AgentBackchannel:
         app.add_routes([web.get("/agent/response/{topic}", self._get_response_backchannel)])
         app.add_routes([web.get("/agent/response/{topic}/{id}/", self._get_response_backchannel)])
         app.add_routes([web.get("/agent/response/{topic}/{id}", self._get_response_backchannel)])
-        runner = web.AppRunner(app)
-        await runner.setup()
-        self.backchannel_site = web.TCPSite(runner, "0.0.0.0", backchannel_port)
-        await self.backchannel_site.start()
-        print("Listening to backchannel on port", backchannel_port)
+        app.add_routes([web.get("/agent/events", self._get_events_backchannel)])
+        app.add_routes([web.get("/agent/events/", self._get_events_backchannel)])
+        app.add_routes([web.get("/agent/metrics", self._get_metrics_backchannel)])
+        app.add_routes([web.get("/agent/metrics/", self._get_metrics_backchannel)])
+        return app
 
     def match_operation(self, topic, method, payload=None, operation=None, rec_id=None):
         """
@@ -207,25 +283,131 @@ class AgentBackchannel:
                 rec_id = payload["cred_ex_id"]
             if "data" in payload:
                 data = payload["data"]
-        for op in self.operations:
-            if operation is not None:
-                if (op["topic"] == topic and op["method"] == method and
-                    ((rec_id and op["id"] == "Y") or (rec_id is None)) and
-                    ((operation and op["operation"] == operation)) and
-                    ((data and op["data"] == "Y") or (data is None))
-                ):
-                    print("Matched operation:", op)
-                    return op
-            else:
-                if (op["topic"] == topic and op["method"] == method and
-                    ((rec_id and op["id"] == "Y") or (rec_id is None)) and
-                    ((method == "GET") or (operation and op["operation"] == operation) or (operation is None)) and
-                    ((data and op["data"] == "Y") or (data is None))
-                ):
-                    print("Matched operation:", op)
-                    return op
+        if self.operation_index is None:
+            self.operation_index = compile_operations(self.operations)
+        op = find_operation(self.operation_index, topic, method, operation=operation, rec_id=rec_id, data=data)
+        if op and LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug("Matched operation: %s", op)
+        return op
+
+    def publish_event(self, topic, message, record_id=None, thread_id=None):
+        """
+        Record a state change reported by an agent webhook and wake /agent/events subscribers.
+
+        The state is translated to the RFC state with the backchannel's agent_state_translation,
+        if it has one, so subscribers see the same states as the /agent/command responses.
+        """
+        state = message.get("state") if isinstance(message, dict) else None
+        translate = getattr(self, "agent_state_translation", None)
+        if translate and state is not None:
+            try:
+                state = json.loads(translate(topic, None, json.dumps(message))).get("state", state)
+            except Exception:
+                # an untranslatable state must not stop the webhook being handled
+                LOGGER.exception("Error translating %s state %s:", topic, state)
+
+        self.event_seq += 1
+        event = {
+            "seq": self.event_seq,
+            "topic": topic,
+            "id": record_id,
+            "thread_id": thread_id,
+            "state": state,
+            "time": time.time(),
+        }
+        self.events.append(event)
+        if self.event_signal:
+            self.event_signal.set()
+            self.event_signal = None
+        return event
+
+    async def _get_events_backchannel(self, request: ClientRequest):
+        """
+        Stream state change events as server-sent events.
+
+        Query parameters (all optional):
+            topic   comma separated topics to include, e.g. connection,issue-credential
+            id      comma separated record or thread ids to include
+            since   only send events after this sequence number; the Last-Event-ID header
+                    sent by reconnecting SSE clients is used when it is not given
+        """
+        topics = set(t for t in request.query.get("topic", "").split(",") if t)
+        ids = set(i for i in request.query.get("id", "").split(",") if i)
+        try:
+            last_seq = int(request.query.get("since") or request.headers.get("Last-Event-ID") or 0)
+        except ValueError:
+            return web.Response(body=b"400 bad request: since must be a number", status=400)
+
+        response = web.StreamResponse(
+            headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"}
+        )
+        await response.prepare(request)
+        try:
+            await self._stream_events(response, topics, ids, last_seq)
+        except ConnectionResetError:
+            # subscriber went away
+            pass
+        return response
+
+    def _events_after(self, last_seq):
+        """
+        Events newer than last_seq, and the signal that is set when the next one is published.
+        """
+        if self.event_signal is None:
+            self.event_signal = asyncio.Event()
+        # sequence numbers are contiguous, so skip straight to the first unseen event
+        start = max(0, len(self.events) - (self.event_seq - last_seq))
+        return (list(islice(self.events, start, None)), self.event_signal)
+
+    async def wait_for_event(self, last_seq, timeout, ids=None):
+        """
+        Wait up to timeout seconds for an event after last_seq whose record or thread id is in ids.
+
+        Returns the event (or None on timeout) and the last sequence number seen.
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        while True:
+            (pending, signal) = self._events_after(last_seq)
+            for event in pending:
+                last_seq = event["seq"]
+                if not ids or event["id"] in ids or event["thread_id"] in ids:
+                    return (event, last_seq)
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return (None, last_seq)
+            try:
+                await asyncio.wait_for(signal.wait(), remaining)
+            except asyncio.TimeoutError:
+                return (None, last_seq)
+
+    async def _stream_events(self, response, topics, ids, last_seq):
+        while True:
+            (pending, signal) = self._events_after(last_seq)
+            for event in pending:
+                last_seq = event["seq"]
+                if topics and event["topic"] not in topics:
+                    continue
+                if ids and event["id"] not in ids and event["thread_id"] not in ids:
+                    continue
+                await response.write(
+                    f"id: {event['seq']}\nevent: {event['topic']}\ndata: {json.dumps(event)}\n\n".encode("utf8")
+                )
+            if pending:
+                continue
+            try:
+                await asyncio.wait_for(signal.wait(), EVENT_KEEPALIVE)
+            except asyncio.TimeoutError:
+                await response.write(b": keep-alive\n\n")
 
-        return None
+    async def _get_metrics_backchannel(self, request: ClientRequest):
+        """
+        Request, admin API and webhook metrics in the Prometheus text format.
+        """
+        return web.Response(
+            body=render_metrics(self.ident).encode("utf8"),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
 
     def not_found_response(self, request):
         resp_text = "404 not found: " + str(request)
@@ -292,11 +474,19 @@ class AgentBackchannel:
         else:
             rec_id = None
         
+        wait_for_state = request.query.get("wait_for_state")
+
         try:
             operation = self.match_operation(topic, "GET", operation=topic_operation, rec_id=rec_id)
             if operation:
                 try:
-                    (resp_status, resp_text) = await self.make_agent_GET_request(operation, rec_id=rec_id)
+                    if wait_for_state and rec_id:
+                        timeout = float(request.query.get("timeout", LONG_POLL_TIMEOUT))
+                        (resp_status, resp_text) = await self.wait_for_agent_state(
+                            operation, rec_id, wait_for_state.split(","), timeout
+                        )
+                    else:
+                        (resp_status, resp_text) = await self.make_agent_GET_request(operation, rec_id=rec_id)
 
                     if resp_status == 200:
                         return web.Response(text=resp_text, status=resp_status)
@@ -316,6 +506,34 @@ class AgentBackchannel:
             traceback.print_exc()
             return web.Response(body=str(e), status=500)
 
+    async def wait_for_agent_state(self, op, rec_id, states, timeout) -> (int, str):
+        """
+        GET the record until its state is one of states or timeout seconds have passed,
+        and return the last response.
+
+        The record is fetched again whenever a webhook event for rec_id arrives, and every
+        LONG_POLL_RECHECK seconds for backchannels that don't publish events.
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + min(timeout, LONG_POLL_MAX_TIMEOUT)
+        last_seq = self.event_seq
+        while True:
+            (resp_status, resp_text) = await self.make_agent_GET_request(op, rec_id=rec_id)
+            if resp_status == 501:
+                return (resp_status, resp_text)
+            if resp_status == 200:
+                try:
+                    if json.loads(resp_text).get("state") in states:
+                        return (resp_status, resp_text)
+                except (AttributeError, TypeError, ValueError):
+                    return (resp_status, resp_text)
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return (resp_status, resp_text)
+            (_, last_seq) = await self.wait_for_event(
+                last_seq, min(remaining, LONG_POLL_RECHECK), ids={rec_id}
+            )
+
     async def _delete_command_backchannel(self, request: ClientRequest):
             """
             Post a DELETE command to the agent.
@@ -380,6 +598,97 @@ class AgentBackchannel:
             traceback.print_exc()
             return web.Response(body=str(e), status=500)
 
+    async def execute_command(self, method, topic, operation=None, rec_id=None, data=None) -> (int, str):
+        """
+        Match and run a single command the way the /agent/command routes do.
+        """
+        if method == "POST":
+            payload = {"data": data} if data is not None else {}
+            if rec_id is not None:
+                payload["id"] = rec_id
+            op = self.match_operation(topic, method, payload=payload, operation=operation)
+        else:
+            op = self.match_operation(topic, method, operation=operation, rec_id=rec_id)
+        if not op:
+            return (404, "404 not found: " + " ".join(x for x in (method, topic, operation) if x))
+
+        try:
+            if method == "POST":
+                (resp_status, resp_text) = await self.make_agent_POST_request(op, rec_id=rec_id, data=data)
+            elif method == "GET":
+                (resp_status, resp_text) = await self.make_agent_GET_request(op, rec_id=rec_id)
+            else:
+                (resp_status, resp_text) = await self.make_agent_DELETE_request(op, rec_id=rec_id)
+        except NotImplementedError:
+            return (501, "501 not implemented: " + json.dumps(op))
+        if isinstance(resp_text, bytes):
+            resp_text = resp_text.decode("utf8")
+        return (resp_status, resp_text)
+
+    async def _post_batch_backchannel(self, request: ClientRequest):
+        """
+        Run an ordered list of commands and return every result in one response.
+
+        The payload is {"commands": [{"topic", "operation", "id", "data", "method", "independent"}, ...]},
+        method defaults to POST. A command waits for all of the commands before it to finish
+        unless it is marked "independent", in which case it only waits for the commands it
+        references. A string of the form "${<index>.<field>.<field>}" anywhere in "id" or "data"
+        is replaced by that field of the JSON response of the command at <index>.
+
+        The response is {"results": [{"status": <int>, "response": <json or text>}, ...]} in
+        command order; a command whose reference failed gets status 424.
+        """
+        try:
+            payload = await request.json()
+            commands = payload["commands"] if isinstance(payload, dict) else payload
+            if not isinstance(commands, list):
+                raise ValueError("commands must be a list")
+            for (index, command) in enumerate(commands):
+                if not isinstance(command, dict) or not isinstance(command.get("topic"), str):
+                    raise ValueError(f"command {index} must be an object with a topic")
+        except (ValueError, KeyError) as e:
+            return web.Response(body=f"400 bad request: {e}".encode("utf8"), status=400)
+
+        results = [None] * len(commands)
+        tasks = []
+
+        async def run_item(index, command, deps):
+            if deps:
+                await asyncio.gather(*(tasks[i] for i in deps))
+            try:
+                refs = batch_references(command)
+                failed = [i for i in refs if i >= index or results[i]["status"] != 200]
+                if failed:
+                    results[index] = {"status": 424, "response": f"424 failed dependency: commands {failed}"}
+                    return
+                rec_id = resolve_batch_references(command.get("id"), results)
+                data = resolve_batch_references(command.get("data"), results)
+                (resp_status, resp_text) = await self.execute_command(
+                    command.get("method", "POST").upper(),
+                    command["topic"],
+                    operation=command.get("operation"),
+                    rec_id=rec_id,
+                    data=data,
+                )
+                try:
+                    response = json.loads(resp_text)
+                except (TypeError, ValueError):
+                    response = resp_text
+                results[index] = {"status": resp_status, "response": response}
+            except Exception as e:
+                traceback.print_exc()
+                results[index] = {"status": 500, "response": str(e)}
+
+        for (index, command) in enumerate(commands):
+            if command.get("independent"):
+                deps = [i for i in batch_references(command) if i < index]
+            else:
+                deps = list(range(index))
+            tasks.append(asyncio.ensure_future(run_item(index, command, deps)))
+        await asyncio.gather(*tasks)
+
+        return web.Response(text=json.dumps({"results": results}), content_type="application/json")
+
     async def make_agent_POST_request(
         self, op, rec_id=None, data=None, text=False, params=None
     ) -> (int, str):
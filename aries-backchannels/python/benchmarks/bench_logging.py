@@ -0,0 +1,90 @@
+"""
+Measure the per-message cost of backchannel logging on the request/webhook
+path: the original printed text output, and the queued JSON lines mode
+(LOG_FORMAT=json) at INFO and DEBUG, with a webhook sized payload.
+
+"caller" is the time spent in the logging call itself, which is what a
+webhook or request handler waits for; "drained" includes the time for the
+background writer to get every record out.
+
+Run from the aries-backchannels folder:
+
+    python -m python.benchmarks.bench_logging [--messages 20000]
+"""
+import argparse
+import contextlib
+import logging
+import os
+import time
+from timeit import default_timer
+
+from python import utils
+from python.utils import LOGGER, log_payload, setup_json_logging
+
+WEBHOOK = {
+    "thread_id": "4a64a5b1-3c0a-4d6b-8f5e-2a9bde0c1f4e",
+    "credential_exchange_id": "9c6e3b5a-5f6e-4b8c-9d7b-6c1e0a2f3d4b",
+    "state": "offer_received",
+    "credential_offer_dict": {
+        "credential_preview": {
+            "attributes": [{"name": f"attr_{i}", "value": "x" * 40} for i in range(20)]
+        },
+        "offers~attach": [{"data": {"base64": "A" * 1500}}],
+    },
+}
+
+
+def drain(writer):
+    while not writer.records.empty():
+        time.sleep(0.001)
+
+
+def bench(label, messages, writer=None):
+    start = default_timer()
+    for i in range(messages):
+        log_payload("Received Issue Credential Webhook message: ", WEBHOOK)
+    caller = default_timer() - start
+    if writer:
+        drain(writer)
+    drained = default_timer() - start
+    print(f"{label:<32} caller {caller / messages * 1_000_000:8.2f} us/msg   drained {drained / messages * 1_000_000:8.2f} us/msg")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark backchannel logging")
+    parser.add_argument("--messages", type=int, default=20_000, help="Messages per measurement")
+    args = parser.parse_args()
+
+    devnull = open(os.devnull, "w")
+
+    utils.LOG_FORMAT = "text"
+    utils.COLORIZE = False
+    with contextlib.redirect_stdout(devnull):
+        start = default_timer()
+        for i in range(args.messages):
+            log_payload("Received Issue Credential Webhook message: ", WEBHOOK)
+        elapsed = default_timer() - start
+    print(f"{'text (printed)':<32} caller {elapsed / args.messages * 1_000_000:8.2f} us/msg")
+
+    utils.LOG_FORMAT = "json"
+    writer = setup_json_logging(stream=devnull)
+
+    LOGGER.setLevel(logging.INFO)
+    bench("json INFO", args.messages, writer)
+
+    LOGGER.setLevel(logging.DEBUG)
+    utils.LOG_PAYLOAD_SAMPLE = 1.0
+    bench("json DEBUG", args.messages, writer)
+
+    utils.LOG_PAYLOAD_SAMPLE = 0.1
+    bench("json DEBUG, 10% payloads sampled", args.messages, writer)
+
+    utils.LOG_PAYLOAD_SAMPLE = 1.0
+    utils.LOG_MAX_PAYLOAD = 0
+    bench("json DEBUG, payloads untruncated", args.messages, writer)
+
+    writer.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Compare the linear operations table scan previously done by
+AgentBackchannel.match_operation with the compiled operation index.
+
+Every row of the operations table is turned into the request that should
+select it (plus a few requests that match nothing), both lookups are checked
+to agree, and the average lookup cost of each is reported.
+
+Run from the aries-backchannels folder:
+
+    python -m python.benchmarks.bench_match_operation [--operations data/backchannel_operations.csv]
+"""
+import argparse
+from timeit import default_timer
+
+from python.utils import compile_operations, find_operation, read_operations
+
+ROUNDS = 200
+
+
+def linear_match(operations, topic, method, operation=None, rec_id=None, data=None):
+    # the scan match_operation used before the index, without its print()
+    for op in operations:
+        if operation is not None:
+            if (op["topic"] == topic and op["method"] == method and
+                ((rec_id and op["id"] == "Y") or (rec_id is None)) and
+                ((operation and op["operation"] == operation)) and
+                ((data and op["data"] == "Y") or (data is None))
+            ):
+                return op
+        else:
+            if (op["topic"] == topic and op["method"] == method and
+                ((rec_id and op["id"] == "Y") or (rec_id is None)) and
+                ((method == "GET") or (operation and op["operation"] == operation) or (operation is None)) and
+                ((data and op["data"] == "Y") or (data is None))
+            ):
+                return op
+    return None
+
+
+def build_requests(operations):
+    requests = []
+    for op in operations:
+        requests.append(
+            (
+                op["topic"],
+                op["method"],
+                op["operation"] or None,
+                "rec-id" if op["id"] == "Y" else None,
+                {"data": 1} if op["data"] == "Y" else None,
+            )
+        )
+    # lookups that never match
+    requests.append(("no-such-topic", "POST", "send-offer", None, None))
+    requests.append(("connection", "POST", "no-such-operation", None, None))
+    requests.append(("schema", "DELETE", None, "rec-id", None))
+    return requests
+
+
+def time_lookups(lookup, requests):
+    start = default_timer()
+    for _ in range(ROUNDS):
+        for request in requests:
+            lookup(*request)
+    return (default_timer() - start) / (ROUNDS * len(requests)) * 1_000_000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark match_operation lookups")
+    parser.add_argument(
+        "--operations",
+        default="data/backchannel_operations.csv",
+        help="Operations table to load",
+    )
+    args = parser.parse_args()
+
+    operations = read_operations(file_name=args.operations)
+    start = default_timer()
+    index = compile_operations(operations)
+    compile_ms = (default_timer() - start) * 1000
+
+    requests = build_requests(operations)
+    for request in requests:
+        assert linear_match(operations, *request) is find_operation(index, *request), request
+
+    linear_us = time_lookups(lambda *r: linear_match(operations, *r), requests)
+    indexed_us = time_lookups(lambda *r: find_operation(index, *r), requests)
+
+    print(f"operations: {len(operations)}, index keys: {len(index)}, compiled in {compile_ms:.2f} ms")
+    print(f"linear scan:  {linear_us:8.3f} us/lookup")
+    print(f"index lookup: {indexed_us:8.3f} us/lookup ({linear_us / indexed_us:.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
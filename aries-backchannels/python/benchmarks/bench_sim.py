@@ -0,0 +1,135 @@
+"""
+Throughput of the simulated agents (sim/sim_backchannel.py): complete
+connection, issue credential and present proof exchanges between an issuer
+and a holder, run concurrently through the backchannel routing layer
+(operation matching, execute_command, storage and long-poll waits) without
+HTTP, agents or a ledger.
+
+Run from the aries-backchannels folder:
+
+    python -m python.benchmarks.bench_sim [--exchanges 1000] [--concurrency 100] [--latency 0]
+"""
+import argparse
+import asyncio
+import json
+from timeit import default_timer
+
+from python import storage
+from python.utils import load_operations
+from sim import sim_backchannel
+from sim.sim_backchannel import SimAgentBackchannel, _parse_latency
+
+OPERATIONS_FILE = "./backchannel_operations.csv"
+
+
+async def command(agent, method, topic, operation=None, rec_id=None, data=None):
+    (status, text) = await agent.execute_command(method, topic, operation=operation, rec_id=rec_id, data=data)
+    assert status == 200, f"{agent.ident} {method} {topic} {operation}: {status} {text}"
+    return json.loads(text)
+
+
+async def wait_for(agent, topic, rec_id, state):
+    op = agent.match_operation(topic, "GET", rec_id=rec_id)
+    (status, text) = await agent.wait_for_agent_state(op, rec_id, [state], 10.0)
+    record = json.loads(text)
+    assert record["state"] == state, f"{agent.ident} {topic} {rec_id}: {record['state']} is not {state}"
+
+
+async def connect(issuer, holder):
+    invitation = await command(issuer, "POST", "connection", "create-invitation")
+    issuer_conn = invitation["connection_id"]
+    holder_conn = (await command(holder, "POST", "connection", "receive-invitation", data=invitation["invitation"]))["connection_id"]
+    await command(holder, "POST", "connection", "accept-invitation", rec_id=holder_conn)
+    await wait_for(issuer, "connection", issuer_conn, "requested")
+    await command(issuer, "POST", "connection", "accept-request", rec_id=issuer_conn)
+    await wait_for(holder, "connection", holder_conn, "responded")
+    await command(holder, "POST", "connection", "send-ping", rec_id=holder_conn)
+    await wait_for(issuer, "connection", issuer_conn, "complete")
+    return (issuer_conn, holder_conn)
+
+
+async def issue(issuer, holder, issuer_conn, cred_def_id, schema_id):
+    offer = {
+        "connection_id": issuer_conn,
+        "credential_preview": {"attributes": [{"name": "attr_1", "value": "value_1"}]},
+        "filter": {"indy": {"cred_def_id": cred_def_id, "schema_id": schema_id}},
+    }
+    thread_id = (await command(issuer, "POST", "issue-credential-v2", "send-offer", data=offer))["thread_id"]
+    await wait_for(holder, "issue-credential-v2", thread_id, "offer-received")
+    await command(holder, "POST", "issue-credential-v2", "send-request", rec_id=thread_id)
+    await wait_for(issuer, "issue-credential-v2", thread_id, "request-received")
+    await command(issuer, "POST", "issue-credential-v2", "issue", rec_id=thread_id, data={"comment": "issuing"})
+    await wait_for(holder, "issue-credential-v2", thread_id, "credential-received")
+    stored = await command(holder, "POST", "issue-credential-v2", "store", rec_id=thread_id)
+    await wait_for(issuer, "issue-credential-v2", thread_id, "done")
+    return stored["cred_ex_record"]["cred_id_stored"]
+
+
+async def prove(verifier, prover, verifier_conn, credential_id):
+    request = {"presentation_proposal": {
+        "connection_id": verifier_conn,
+        "data": {"requested_attributes": {"attr_1": {"name": "attr_1"}}},
+    }}
+    thread_id = (await command(verifier, "POST", "proof-v2", "send-request", data=request))["thread_id"]
+    await wait_for(prover, "proof-v2", thread_id, "request-received")
+    presentation = {"requested_attributes": {"attr_1": {"revealed": True, "cred_id": credential_id}}}
+    await command(prover, "POST", "proof-v2", "send-presentation", rec_id=thread_id, data=presentation)
+    await wait_for(verifier, "proof-v2", thread_id, "presentation-received")
+    verified = await command(verifier, "POST", "proof-v2", "verify-presentation", rec_id=thread_id)
+    assert verified["verified"] == "true"
+    await wait_for(prover, "proof-v2", thread_id, "done")
+
+
+async def run(exchanges, concurrency):
+    issuer = SimAgentBackchannel("sim.Faber", 9040)
+    holder = SimAgentBackchannel("sim.Bob", 9030)
+    for agent in (issuer, holder):
+        (agent.operations, agent.operation_index) = load_operations(OPERATIONS_FILE)
+        agent.activate()
+
+    schema = {"schema_name": "bench", "schema_version": "1.0", "attributes": ["attr_1"]}
+    schema_id = (await command(issuer, "POST", "schema", data=schema))["schema_id"]
+    cred_def_id = (await command(issuer, "POST", "credential-definition", data={"schema_id": schema_id}))["credential_definition_id"]
+
+    timings = {"connection": 0.0, "issue": 0.0, "proof": 0.0}
+    limit = asyncio.Semaphore(concurrency)
+
+    async def exchange():
+        async with limit:
+            start = default_timer()
+            (issuer_conn, holder_conn) = await connect(issuer, holder)
+            connected = default_timer()
+            credential_id = await issue(issuer, holder, issuer_conn, cred_def_id, schema_id)
+            issued = default_timer()
+            await prove(issuer, holder, issuer_conn, credential_id)
+            timings["connection"] += connected - start
+            timings["issue"] += issued - connected
+            timings["proof"] += default_timer() - issued
+
+    start = default_timer()
+    await asyncio.gather(*(exchange() for _ in range(exchanges)))
+    elapsed = default_timer() - start
+
+    print(f"{exchanges} connection + issue + proof exchanges, {concurrency} at a time: {elapsed:.2f}s, "
+          f"{exchanges / elapsed:.0f} exchanges/s, {exchanges * 3 / elapsed:.0f} protocol runs/s")
+    for (name, total) in timings.items():
+        print(f"  {name:<12} mean {total / exchanges * 1000:7.2f} ms")
+    print("  storage", storage.get_storage_stats())
+
+    for agent in (issuer, holder):
+        await agent.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the simulated agents")
+    parser.add_argument("--exchanges", type=int, default=1000, help="Exchanges to run")
+    parser.add_argument("--concurrency", type=int, default=100, help="Exchanges in flight at a time")
+    parser.add_argument("--latency", type=str, default="0", help="SIM_LATENCY for the run")
+    args = parser.parse_args()
+
+    sim_backchannel.SIM_LATENCY = _parse_latency(args.latency)
+    asyncio.get_event_loop().run_until_complete(run(args.exchanges, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
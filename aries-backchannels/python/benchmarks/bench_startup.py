@@ -0,0 +1,100 @@
+"""
+Measure backchannel startup cost: how long importing the shared backchannel
+module takes, and how long a fresh process takes until the backchannel port
+accepts connections (with a cold and a warm operations table cache).
+
+Run from the aries-backchannels folder:
+
+    python -m python.benchmarks.bench_startup [--runs 5]
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+from timeit import default_timer
+
+IMPORT_SCRIPT = """
+from timeit import default_timer
+start = default_timer()
+import {module}
+print(default_timer() - start)
+"""
+
+LISTEN_SCRIPT = """
+import asyncio
+from python.agent_backchannel import AgentBackchannel
+
+async def main():
+    agent = AgentBackchannel("bench", {port} + 1, {port} + 2)
+    await agent.listen_backchannel({port})
+    await asyncio.sleep(3600)
+
+asyncio.get_event_loop().run_until_complete(main())
+"""
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def time_import(module, env):
+    out = subprocess.check_output(
+        [sys.executable, "-c", IMPORT_SCRIPT.format(module=module)], env=env
+    )
+    return float(out.decode().strip().splitlines()[-1])
+
+
+def time_to_listening(env, timeout=30.0):
+    port = free_port()
+    start = default_timer()
+    proc = subprocess.Popen(
+        [sys.executable, "-c", LISTEN_SCRIPT.format(port=port)],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while default_timer() - start < timeout:
+            try:
+                with socket.create_connection(("127.0.0.1", port), timeout=0.1):
+                    return default_timer() - start
+            except OSError:
+                if proc.poll() is not None:
+                    raise Exception("Backchannel exited before listening")
+        raise Exception("Timed out waiting for the backchannel to listen")
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def report(label, samples):
+    print(f"{label:<40} median {statistics.median(samples) * 1000:8.1f} ms  min {min(samples) * 1000:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark backchannel startup")
+    parser.add_argument("--runs", type=int, default=5, help="Samples per measurement")
+    args = parser.parse_args()
+
+    cache_file = os.path.join(tempfile.mkdtemp(), "operations.json")
+    env = dict(os.environ, PYTHONPATH=os.getcwd(), OPERATIONS_CACHE=cache_file)
+
+    report("import python.agent_backchannel", [time_import("python.agent_backchannel", env) for _ in range(args.runs)])
+    report("import prompt_toolkit + pygments (lazy)", [time_import("prompt_toolkit, pygments.lexers.data", env) for _ in range(args.runs)])
+
+    cold = []
+    for _ in range(args.runs):
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+        cold.append(time_to_listening(env))
+    report("time to listening (cold cache)", cold)
+    report("time to listening (warm cache)", [time_to_listening(env) for _ in range(args.runs)])
+
+
+if __name__ == "__main__":
+    main()
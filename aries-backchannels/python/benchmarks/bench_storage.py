@@ -0,0 +1,108 @@
+"""
+Microbenchmark for the backchannel resource store (python/storage.py).
+
+Fills the store with an increasing number of thread ids and reports the
+per-operation cost of the webhook/response hot path at each size.
+
+The store does the same amount of work per operation at any size; what is
+left of the growth comes from CPU caches (about 3.6us per push at 10^3 ids and
+4.3us at 10^6). The operations are timed with the garbage collector paused: a
+full collection walks every object in the store, so one landing in a sample
+otherwise adds a cost that grows with the store (e.g. 15-20us per push at 10^5
+ids). Pass --gc to time them with the collector running.
+
+Run from the aries-backchannels folder:
+
+    python -m python.benchmarks.bench_storage [--max-entries 1000000]
+"""
+import argparse
+import gc
+import uuid
+from timeit import default_timer
+
+from python import storage
+from python.storage import (
+    clear_resource,
+    configure_storage,
+    get_storage_stats,
+    get_resource,
+    get_resources,
+    pop_resource,
+    pop_resource_latest,
+    push_resource,
+    store_resource,
+)
+
+SAMPLES = 10_000
+
+
+def fill(count):
+    clear_resource()
+    for i in range(count):
+        push_resource(str(i), "credential-msg", {"thread_id": str(i), "state": "offer_sent"})
+    # a handful of records of a rare type spread through the store
+    for i in range(0, count, max(count // 10, 1)):
+        store_resource(str(i), "connection", {"connection_id": str(i)})
+
+
+def time_op(func, args_list, pause_gc=True):
+    gc.collect()
+    if pause_gc:
+        gc.disable()
+    try:
+        start = default_timer()
+        for args in args_list:
+            func(*args)
+        return (default_timer() - start) / len(args_list) * 1_000_000
+    finally:
+        gc.enable()
+
+
+def bench(count, pause_gc=True):
+    fill(count)
+    new_ids = [str(uuid.uuid4()) for _ in range(SAMPLES)]
+    existing = [(str(i), "credential-msg") for i in range(0, count, max(count // SAMPLES, 1))]
+
+    results = {}
+    results["push"] = time_op(
+        push_resource, [(data_id, "credential-msg", {}) for data_id in new_ids], pause_gc
+    )
+    results["get"] = time_op(get_resource, existing, pause_gc)
+    results["pop"] = time_op(pop_resource, [(data_id, "credential-msg") for data_id in new_ids], pause_gc)
+    results["pop_latest"] = time_op(pop_resource_latest, [("credential-msg",)] * SAMPLES, pause_gc)
+    results["get_resources"] = time_op(get_resources, [("connection",)] * 100, pause_gc)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark python/storage.py")
+    parser.add_argument(
+        "--max-entries",
+        type=int,
+        default=1_000_000,
+        help="Largest number of thread ids to fill the store with",
+    )
+    parser.add_argument("--gc", action="store_true", help="Keep the garbage collector running while timing")
+    args = parser.parse_args()
+
+    # no size caps so every entry stays resident, per-type TTLs still apply
+    configure_storage(max_entries=0, max_bytes=0)
+
+    sizes = []
+    size = 1_000
+    while size <= args.max_entries:
+        sizes.append(size)
+        size *= 10
+
+    ops = ["push", "get", "pop", "pop_latest", "get_resources"]
+    print(f"{'entries':>10} " + " ".join(f"{op + ' us':>16}" for op in ops))
+    for size in sizes:
+        results = bench(size, pause_gc=not args.gc)
+        print(f"{size:>10} " + " ".join(f"{results[op]:>16.3f}" for op in ops))
+    print("ids indexed for credential-msg:", len(storage.type_index.get("credential-msg", ())))
+    print("store stats:", get_storage_stats())
+    clear_resource()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+import re
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from timeit import default_timer
+
+from aiohttp import web
+
+
+# upper bounds in seconds, the last ones cover long-polled GETs
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# backchannel endpoints that are not timed: streams and the metrics themselves
+UNTIMED_PATHS = ("/agent/events", "/agent/metrics")
+
+START_TIME = time.time()
+
+# label values are bounded so a client sending arbitrary paths or ids can't grow the tables:
+# anything not known is counted as "other"
+OTHER = "other"
+HTTP_METHODS = {"GET", "POST", "PUT", "PATCH", "DELETE", "HEAD", "OPTIONS"}
+
+# topics and operations of the backchannel routes, completed from the operations table by register_operations()
+known_labels = {"topic": {"", "batch"}, "operation": {"", "response"}}
+
+# webhook topics are set by the agent, the first MAX_WEBHOOK_TOPICS well-formed ones get their own label
+WEBHOOK_TOPIC = re.compile(r"[\w-]{1,64}")
+MAX_WEBHOOK_TOPICS = 64
+webhook_topics = set()
+
+
+class Histogram:
+    """
+    Cumulative latency histogram in the Prometheus layout.
+    """
+
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+# (topic, method, operation) -> count / Histogram
+request_counts = {}
+request_errors = {}
+request_latency = {}
+admin_latency = {}
+overhead_latency = {}
+
+# admin method -> Histogram, for every admin API call including those made from webhook handlers
+admin_request_latency = {}
+
+# (topic,) -> count / Histogram
+webhook_counts = {}
+webhook_wait_latency = {}
+webhook_handling_latency = {}
+
+# webhooks received but not handled yet
+webhook_queue = {"depth": 0, "max_depth": 0}
+
+# seconds spent in make_admin_request by the backchannel request being handled
+_admin_time = ContextVar("admin_time", default=None)
+
+
+def register_operations(operations):
+    """
+    Allow the topics and operations of the operations table as request labels.
+    """
+    for op in operations:
+        known_labels["topic"].add(op["topic"])
+        known_labels["operation"].add(op["operation"])
+
+
+def _label(name, value):
+    value = value or ""
+    return value if value in known_labels[name] else OTHER
+
+
+def _method_label(method):
+    return method if method in HTTP_METHODS else OTHER
+
+
+def _webhook_label(topic):
+    if topic in webhook_topics:
+        return topic
+    if len(webhook_topics) < MAX_WEBHOOK_TOPICS and isinstance(topic, str) and WEBHOOK_TOPIC.fullmatch(topic):
+        webhook_topics.add(topic)
+        return topic
+    return OTHER
+
+
+def _observe(table, key, value):
+    histogram = table.get(key)
+    if histogram is None:
+        histogram = table[key] = Histogram()
+    histogram.observe(value)
+
+
+def observe_request(topic, method, operation, status, elapsed, admin_elapsed=0.0):
+    """
+    Record a handled backchannel request, split into admin API time and backchannel overhead.
+    """
+    key = (_label("topic", topic), _method_label(method), _label("operation", operation))
+    request_counts[key] = request_counts.get(key, 0) + 1
+    if status >= 400:
+        error_key = key + (str(status),)
+        request_errors[error_key] = request_errors.get(error_key, 0) + 1
+    _observe(request_latency, key, elapsed)
+    _observe(admin_latency, key, admin_elapsed)
+    _observe(overhead_latency, key, max(elapsed - admin_elapsed, 0.0))
+
+
+def observe_admin_request(method, elapsed):
+    """
+    Record one call to the agent admin API, called from make_admin_request.
+    """
+    _observe(admin_request_latency, (_method_label(method),), elapsed)
+    spent = _admin_time.get()
+    if spent is not None:
+        spent[0] += elapsed
+
+
+def record_webhook(topic):
+    """
+    Count a webhook as it arrives; it stays in the queue depth until observe_webhook.
+    """
+    key = (_webhook_label(topic),)
+    webhook_counts[key] = webhook_counts.get(key, 0) + 1
+    webhook_queue["depth"] += 1
+    webhook_queue["max_depth"] = max(webhook_queue["max_depth"], webhook_queue["depth"])
+
+
+def observe_webhook(topic, received, started):
+    """
+    Record a handled webhook: the time it was queued and the time its handler took.
+    """
+    webhook_queue["depth"] -= 1
+    key = (_webhook_label(topic),)
+    _observe(webhook_wait_latency, key, started - received)
+    _observe(webhook_handling_latency, key, default_timer() - started)
+
+
+def reset_metrics():
+    for table in (
+        request_counts,
+        request_errors,
+        request_latency,
+        admin_latency,
+        overhead_latency,
+        admin_request_latency,
+        webhook_counts,
+        webhook_wait_latency,
+        webhook_handling_latency,
+    ):
+        table.clear()
+    webhook_queue["max_depth"] = webhook_queue["depth"]
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{value}"' for (name, value) in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _render_counter(lines, name, help_txt, names, table):
+    lines.append(f"# HELP {name} {help_txt}")
+    lines.append(f"# TYPE {name} counter")
+    for (key, value) in sorted(table.items()):
+        lines.append(f"{name}{_labels(names, map(_escape, key))} {value}")
+
+
+def _render_histogram(lines, name, help_txt, names, table):
+    lines.append(f"# HELP {name} {help_txt}")
+    lines.append(f"# TYPE {name} histogram")
+    for (key, histogram) in sorted(table.items()):
+        values = list(map(_escape, key))
+        cumulative = 0
+        for (bound, count) in zip(LATENCY_BUCKETS, histogram.counts):
+            cumulative += count
+            le = 'le="%s"' % bound
+            lines.append(f"{name}_bucket{_labels(names, values, le)} {cumulative}")
+        le = 'le="+Inf"'
+        lines.append(f"{name}_bucket{_labels(names, values, le)} {histogram.count}")
+        lines.append(f"{name}_sum{_labels(names, values)} {histogram.total}")
+        lines.append(f"{name}_count{_labels(names, values)} {histogram.count}")
+
+
+def render_metrics(ident=None):
+    """
+    All metrics in the Prometheus text exposition format.
+    """
+    labels = ("topic", "method", "operation")
+    lines = []
+    if ident:
+        lines.append("# HELP backchannel_info Backchannel identity")
+        lines.append("# TYPE backchannel_info gauge")
+        lines.append(f'backchannel_info{{agent="{_escape(ident)}"}} 1')
+    lines.append("# HELP backchannel_start_time_seconds Start time of the backchannel since the epoch")
+    lines.append("# TYPE backchannel_start_time_seconds gauge")
+    lines.append(f"backchannel_start_time_seconds {START_TIME}")
+    _render_counter(
+        lines, "backchannel_requests_total",
+        "Backchannel requests handled", labels, request_counts,
+    )
+    _render_counter(
+        lines, "backchannel_request_errors_total",
+        "Backchannel requests answered with an error status", labels + ("status",), request_errors,
+    )
+    _render_histogram(
+        lines, "backchannel_request_seconds",
+        "Backchannel request latency", labels, request_latency,
+    )
+    _render_histogram(
+        lines, "backchannel_request_admin_seconds",
+        "Part of the backchannel request latency spent waiting on the agent admin API", labels, admin_latency,
+    )
+    _render_histogram(
+        lines, "backchannel_request_overhead_seconds",
+        "Part of the backchannel request latency spent in the backchannel itself", labels, overhead_latency,
+    )
+    _render_histogram(
+        lines, "backchannel_admin_request_seconds",
+        "Agent admin API call latency", ("method",), admin_request_latency,
+    )
+    _render_counter(
+        lines, "backchannel_webhooks_total",
+        "Webhooks received from the agent", ("topic",), webhook_counts,
+    )
+    _render_histogram(
+        lines, "backchannel_webhook_wait_seconds",
+        "Time webhooks spent queued before their handler ran", ("topic",), webhook_wait_latency,
+    )
+    _render_histogram(
+        lines, "backchannel_webhook_handling_seconds",
+        "Webhook handler latency", ("topic",), webhook_handling_latency,
+    )
+    lines.append("# HELP backchannel_webhook_queue_depth Webhooks received but not handled yet")
+    lines.append("# TYPE backchannel_webhook_queue_depth gauge")
+    lines.append(f"backchannel_webhook_queue_depth {webhook_queue['depth']}")
+    lines.append("# HELP backchannel_webhook_queue_max_depth Largest webhook queue depth seen")
+    lines.append("# TYPE backchannel_webhook_queue_max_depth gauge")
+    lines.append(f"backchannel_webhook_queue_max_depth {webhook_queue['max_depth']}")
+    return "\n".join(lines) + "\n"
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    """
+    Time backchannel requests, labelled by topic, HTTP method and operation.
+    """
+    if request.path.rstrip("/") in UNTIMED_PATHS:
+        return await handler(request)
+
+    match_info = request.match_info
+    if request.path.startswith("/agent/response"):
+        operation = "response"
+    else:
+        operation = match_info.get("operation")
+    topic = match_info.get("topic")
+    if topic is None and request.path.rstrip("/") == "/agent/command/batch":
+        topic = "batch"
+
+    spent = [0.0]
+    token = _admin_time.set(spent)
+    start = default_timer()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        _admin_time.reset(token)
+        observe_request(topic, request.method, operation, status, default_timer() - start, spent[0])
@@ -1,16 +1,356 @@
+import asyncio
+import json
+import os
+import sys
 import threading
+from collections import OrderedDict, deque
+from time import monotonic
 
 
+def _parse_ttls(ttl_txt):
+    # "problem-report-msg=3600,oob-inviation-msg=600"
+    ttls = {}
+    for item in (ttl_txt or "").split(","):
+        if "=" in item:
+            data_type, ttl = item.split("=", 1)
+            ttls[data_type.strip()] = float(ttl)
+    return ttls
+
+
+# Memory bounds, all may be overridden with configure_storage()
+#   STORAGE_TTL          per data_type time-to-live in seconds since last write
+#   STORAGE_DEFAULT_TTL  time-to-live for any other data_type (0 = never expire)
+#   STORAGE_MAX_ENTRIES  total resources + queued messages before LRU eviction (0 = unbounded)
+#   STORAGE_MAX_BYTES    approximate JSON size of everything stored before LRU eviction (0 = unbounded)
+storage_config = {
+    "ttls": _parse_ttls(
+        os.getenv(
+            "STORAGE_TTL",
+            "problem-report-msg=3600,revocation-registry-msg=3600,oob-inviation-msg=3600",
+        )
+    ),
+    "default_ttl": float(os.getenv("STORAGE_DEFAULT_TTL", 0)),
+    "max_entries": int(os.getenv("STORAGE_MAX_ENTRIES", 0)),
+    "max_bytes": int(os.getenv("STORAGE_MAX_BYTES", 0)),
+}
+
+# storage[data_id][data_type] holds either a single resource (store_resource)
+# or a deque of queued messages (push_resource)
 storage = {}
 storage_lock = threading.Lock()
 
+# secondary index: data_type -> OrderedDict of data_id -> last write time,
+# oldest write first, so per-type lookups and TTL sweeps never scan all of storage
+type_index = {}
+
+# (data_id, data_type) -> _Slot, least recently used first
+slots = OrderedDict()
+
+stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "entries": 0, "bytes": 0}
+
+# waiters blocked in wait_pop(), keyed on (data_id, data_type);
+# wait_pop_latest() registers under (None, data_type)
+waiters = {}
+
+# "memory" keeps everything in this process, "sqlite" also journals it to
+# STORAGE_DIR so a restarted backchannel picks up where it left off
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "memory")
+STORAGE_DIR = os.getenv("STORAGE_DIR", ".")
+
+
+class StorageBackend:
+    """
+    Persistence hooks for the resource store.
+
+    The default backend keeps everything in process memory only. A persistent
+    backend records every change (called with storage_lock held, so it must not
+    block) and hands the surviving state back from load() on restart.
+    """
+
+    def load(self):
+        """
+        Yield (kind, data_id, data_type, data) in write order, kind is "value" or "queue".
+        """
+        return ()
+
+    def record_store(self, data_id, data_type, data):
+        pass
+
+    def record_push(self, data_id, data_type, data):
+        pass
+
+    def record_pop(self, data_id, data_type):
+        pass
+
+    def record_remove(self, data_id, data_type):
+        pass
+
+    def record_clear(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+backend = StorageBackend()
+
+
+class _Slot:
+    """
+    Accounting for one (data_id, data_type): number of entries and their sizes.
+    """
+
+    __slots__ = ("count", "nbytes", "sizes")
+
+    def __init__(self):
+        self.count = 0
+        self.nbytes = 0
+        self.sizes = deque()
+
+
+def configure_storage(ttls=None, default_ttl=None, max_entries=None, max_bytes=None):
+    """
+    Override the TTL and size limits read from the environment.
+    """
+    storage_lock.acquire()
+    try:
+        if ttls is not None:
+            storage_config["ttls"] = dict(ttls)
+        if default_ttl is not None:
+            storage_config["default_ttl"] = float(default_ttl)
+        if max_entries is not None:
+            storage_config["max_entries"] = int(max_entries)
+        if max_bytes is not None:
+            storage_config["max_bytes"] = int(max_bytes)
+        _expire(monotonic())
+        _evict(None)
+    finally:
+        storage_lock.release()
+
+
+def get_storage_stats():
+    storage_lock.acquire()
+    try:
+        data_stats = dict(stats)
+        data_stats["ids"] = len(storage)
+        data_stats["waiters"] = len(waiters)
+        return data_stats
+    finally:
+        storage_lock.release()
+
+
+def _size_of(data):
+    if not storage_config["max_bytes"]:
+        return 0
+    try:
+        return len(json.dumps(data, default=str))
+    except (TypeError, ValueError):
+        return sys.getsizeof(data)
+
+
+def _account_add(key, size):
+    slot = slots.get(key)
+    if slot is None:
+        slot = slots[key] = _Slot()
+    else:
+        slots.move_to_end(key)
+    slot.count += 1
+    slot.nbytes += size
+    slot.sizes.append(size)
+    stats["entries"] += 1
+    stats["bytes"] += size
+
+
+def _account_pop(key):
+    slot = slots[key]
+    size = slot.sizes.popleft()
+    slot.count -= 1
+    slot.nbytes -= size
+    stats["entries"] -= 1
+    stats["bytes"] -= size
+
+
+def _index_add(data_id, data_type):
+    ids = type_index.get(data_type)
+    if ids is None:
+        ids = type_index[data_type] = OrderedDict()
+    elif data_id in ids:
+        ids.move_to_end(data_id)
+    ids[data_id] = monotonic()
+
+
+def _remove(data_id, data_type):
+    # called with storage_lock held, data_id/data_type must exist
+    resources = storage[data_id]
+    del resources[data_type]
+    if not resources:
+        del storage[data_id]
+    ids = type_index[data_type]
+    del ids[data_id]
+    if not ids:
+        del type_index[data_type]
+    slot = slots.pop((data_id, data_type))
+    stats["entries"] -= slot.count
+    stats["bytes"] -= slot.nbytes
+    backend.record_remove(data_id, data_type)
+    return slot
+
+
+def _expire(now):
+    # type_index is ordered by last write, so expired ids are always at the front
+    ttls = storage_config["ttls"]
+    default_ttl = storage_config["default_ttl"]
+    if not ttls and not default_ttl:
+        return
+    data_types = list(type_index) if default_ttl else [t for t in ttls if t in type_index]
+    for data_type in data_types:
+        ttl = ttls.get(data_type, default_ttl)
+        if not ttl:
+            continue
+        ids = type_index.get(data_type)
+        while ids:
+            data_id, written = next(iter(ids.items()))
+            if now - written < ttl:
+                break
+            stats["expirations"] += _remove(data_id, data_type).count
+            ids = type_index.get(data_type)
+
+
+def _evict(protect_key):
+    max_entries = storage_config["max_entries"]
+    max_bytes = storage_config["max_bytes"]
+    while slots and (
+        (max_entries and stats["entries"] > max_entries)
+        or (max_bytes and stats["bytes"] > max_bytes)
+    ):
+        key = next(iter(slots))
+        if key == protect_key:
+            break
+        stats["evictions"] += _remove(*key).count
+
+
+def _lookup(data_id, data_type):
+    # called with storage_lock held, counts the hit or miss
+    _expire(monotonic())
+    resources = storage.get(data_id)
+    data = resources.get(data_type) if resources is not None else None
+    if data is None:
+        stats["misses"] += 1
+    else:
+        stats["hits"] += 1
+        slots.move_to_end((data_id, data_type))
+    return data
+
+
+def _pop_left(data_id, data_type):
+    # called with storage_lock held
+    queue = _lookup(data_id, data_type)
+    if queue is None:
+        return None
+    data = queue.popleft()
+    _account_pop((data_id, data_type))
+    backend.record_pop(data_id, data_type)
+    if not queue:
+        _remove(data_id, data_type)
+    return data
+
+
+def _store(data_id, data_type, data):
+    # called with storage_lock held
+    _expire(monotonic())
+    if data_id in storage and data_type in storage[data_id]:
+        _remove(data_id, data_type)
+    if not data_id in storage:
+        storage[data_id] = {}
+    storage[data_id][data_type] = data
+    _index_add(data_id, data_type)
+    _account_add((data_id, data_type), _size_of(data))
+    backend.record_store(data_id, data_type, data)
+    _evict((data_id, data_type))
+
+
+def _push(data_id, data_type, data):
+    # called with storage_lock held
+    _expire(monotonic())
+    if not data_id in storage:
+        storage[data_id] = {}
+    if not data_type in storage[data_id]:
+        storage[data_id][data_type] = deque()
+    storage[data_id][data_type].append(data)
+    _index_add(data_id, data_type)
+    _account_add((data_id, data_type), _size_of(data))
+    backend.record_push(data_id, data_type, data)
+    _evict((data_id, data_type))
+
+
+def _clear():
+    # called with storage_lock held
+    storage.clear()
+    type_index.clear()
+    slots.clear()
+    stats["entries"] = 0
+    stats["bytes"] = 0
+    backend.record_clear()
+
+
+def set_storage_backend(new_backend):
+    """
+    Replace the persistence backend, reloading whatever state it holds.
+    """
+    global backend
+    storage_lock.acquire()
+    try:
+        old_backend = backend
+        # replay without journaling the restored entries a second time
+        backend = StorageBackend()
+        _clear()
+        for (kind, data_id, data_type, data) in new_backend.load():
+            if kind == "queue":
+                _push(data_id, data_type, data)
+            else:
+                _store(data_id, data_type, data)
+        # rewrite the journal from what survived TTL and size limits
+        backend = new_backend
+        backend.record_clear()
+        for (data_type, ids) in type_index.items():
+            for data_id in ids:
+                data = storage[data_id][data_type]
+                if isinstance(data, deque):
+                    for item in data:
+                        backend.record_push(data_id, data_type, item)
+                else:
+                    backend.record_store(data_id, data_type, data)
+    finally:
+        storage_lock.release()
+    old_backend.close()
+
+
+def open_storage(name):
+    """
+    Attach the backend selected by STORAGE_BACKEND for the backchannel called name.
+    """
+    if STORAGE_BACKEND == "sqlite":
+        from python.storage_sqlite import SQLiteStorageBackend
+
+        file_name = "".join(c if c.isalnum() or c in "-_" else "_" for c in name)
+        set_storage_backend(
+            SQLiteStorageBackend(os.path.join(STORAGE_DIR, file_name + ".sqlite"))
+        )
+    elif STORAGE_BACKEND != "memory":
+        raise Exception(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+
+
+def close_storage():
+    backend.close()
+
 
 def store_resource(data_id, data_type, data):
     storage_lock.acquire()
     try:
-        if not data_id in storage:
-            storage[data_id] = {}
-        storage[data_id][data_type] = data
+        _store(data_id, data_type, data)
         return data
     finally:
         storage_lock.release()
@@ -19,10 +359,7 @@ def store_resource(data_id, data_type, data):
 def get_resource(data_id, data_type):
     storage_lock.acquire()
     try:
-        if data_id in storage:
-            if data_type in storage[data_id]:
-                return storage[data_id][data_type]
-        return None
+        return _lookup(data_id, data_type)
     finally:
         storage_lock.release()
 
@@ -30,10 +367,10 @@ def get_resource(data_id, data_type):
 def get_resources(data_type):
     storage_lock.acquire()
     try:
+        _expire(monotonic())
         data_items = {}
-        for data_id in storage:
-            if data_type in storage[data_id]:
-                data_items[data_id] = storage[data_id][data_type]
+        for data_id in type_index.get(data_type, ()):
+            data_items[data_id] = storage[data_id][data_type]
         return data_items
     finally:
         storage_lock.release()
@@ -45,21 +382,26 @@ def delete_resource(data_id, data_type):
         if data_id in storage:
             if data_type in storage[data_id]:
                 stored_data = storage[data_id][data_type]
-                del storage[data_id][data_type]
+                _remove(data_id, data_type)
                 return stored_data
         return None
     finally:
         storage_lock.release()
 
 
+def clear_resource():
+    storage_lock.acquire()
+    try:
+        _clear()
+    finally:
+        storage_lock.release()
+
+
 def push_resource(data_id, data_type, data):
     storage_lock.acquire()
     try:
-        if not data_id in storage:
-            storage[data_id] = {}
-        if not data_type in storage[data_id]:
-            storage[data_id][data_type] = []
-        storage[data_id][data_type].append(data)
+        _push(data_id, data_type, data)
+        _notify_waiters(data_id, data_type)
         return data
     finally:
         storage_lock.release()
@@ -68,26 +410,97 @@ def push_resource(data_id, data_type, data):
 def pop_resource(data_id, data_type):
     storage_lock.acquire()
     try:
-        if data_id in storage:
-            if data_type in storage[data_id]:
-                if 0 < len(storage[data_id][data_type]):
-                    data = storage[data_id][data_type][0]
-                    del storage[data_id][data_type][0]
-                    return data
-        return None
+        return _pop_left(data_id, data_type)
     finally:
         storage_lock.release()
 
+
 def pop_resource_latest(data_type):
+    """
+    Pop the oldest queued message of the data_id most recently pushed to for data_type.
+    """
     storage_lock.acquire()
     try:
-        data_ids = list(storage.keys())
-        data_id = data_ids[len(data_ids) - 1]
-        if data_type in storage[data_id]:
-            if 0 < len(storage[data_id][data_type]):
-                data = storage[data_id][data_type][0]
-                del storage[data_id][data_type][0]
-                return data
-        return None
+        _expire(monotonic())
+        ids = type_index.get(data_type)
+        if not ids:
+            stats["misses"] += 1
+            return None
+        return _pop_left(next(reversed(ids)), data_type)
+    finally:
+        storage_lock.release()
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def _notify_waiters(data_id, data_type):
+    # called with storage_lock held; push_resource may run outside of the
+    # waiter's event loop (e.g. from an executor thread) so wake-ups are
+    # always scheduled through call_soon_threadsafe
+    for key in ((data_id, data_type), (None, data_type)):
+        for (loop, future) in waiters.pop(key, ()):
+            loop.call_soon_threadsafe(_wake, future)
+
+
+def _add_waiter(key, loop, future):
+    storage_lock.acquire()
+    try:
+        waiters.setdefault(key, []).append((loop, future))
     finally:
-        storage_lock.release()
\ No newline at end of file
+        storage_lock.release()
+
+
+def _remove_waiter(key, future):
+    storage_lock.acquire()
+    try:
+        if key in waiters:
+            waiters[key] = [w for w in waiters[key] if w[1] is not future]
+            if not waiters[key]:
+                del waiters[key]
+    finally:
+        storage_lock.release()
+
+
+async def _wait_for_resource(key, pop, timeout):
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while True:
+        future = loop.create_future()
+        # register before checking so a push between the check and the
+        # await can't be missed
+        _add_waiter(key, loop, future)
+        try:
+            data = pop()
+            if data is not None:
+                return data
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return None
+            try:
+                await asyncio.wait_for(future, remaining)
+            except asyncio.TimeoutError:
+                return pop()
+        finally:
+            _remove_waiter(key, future)
+
+
+async def wait_pop(data_id, data_type, timeout):
+    """
+    Pop the oldest message for data_id/data_type, waiting up to timeout
+    seconds for push_resource to deliver one. Returns None on timeout.
+    """
+    return await _wait_for_resource(
+        (data_id, data_type), lambda: pop_resource(data_id, data_type), timeout
+    )
+
+
+async def wait_pop_latest(data_type, timeout):
+    """
+    As pop_resource_latest, waiting up to timeout seconds for a message of data_type.
+    """
+    return await _wait_for_resource(
+        (None, data_type), lambda: pop_resource_latest(data_type), timeout
+    )
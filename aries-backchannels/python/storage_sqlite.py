@@ -0,0 +1,151 @@
+import atexit
+import json
+import queue
+import sqlite3
+import threading
+
+from python.storage import StorageBackend
+
+
+# most journal operations committed in one transaction
+BATCH_SIZE = 500
+
+
+class SQLiteStorageBackend(StorageBackend):
+    """
+    Journals the resource store to an SQLite database in WAL mode.
+
+    Changes are queued by the webhook/request handlers and written in batches
+    by a background thread, so ingestion never waits on the disk.
+    """
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.ops = queue.Queue()
+        self.closed = False
+
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS resources ("
+            " seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " data_id TEXT NOT NULL,"
+            " data_type TEXT NOT NULL,"
+            " kind TEXT NOT NULL,"
+            " data TEXT NOT NULL)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS resources_key ON resources (data_id, data_type, seq)"
+        )
+        conn.commit()
+        conn.close()
+
+        self.writer = threading.Thread(
+            target=self._write_loop, name="storage-sqlite-writer", daemon=True
+        )
+        self.writer.start()
+        atexit.register(self.close)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.file_name, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def load(self):
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT kind, data_id, data_type, data FROM resources WHERE kind != 'memory' ORDER BY seq"
+            ).fetchall()
+        finally:
+            conn.close()
+        for (kind, data_id, data_type, data) in rows:
+            yield (kind, data_id, data_type, json.loads(data))
+
+    def record_store(self, data_id, data_type, data):
+        self.ops.put(("store", data_id, data_type, data))
+
+    def record_push(self, data_id, data_type, data):
+        self.ops.put(("push", data_id, data_type, data))
+
+    def record_pop(self, data_id, data_type):
+        self.ops.put(("pop", data_id, data_type, None))
+
+    def record_remove(self, data_id, data_type):
+        self.ops.put(("remove", data_id, data_type, None))
+
+    def record_clear(self):
+        self.ops.put(("clear", None, None, None))
+
+    def flush(self):
+        """
+        Block until every queued change is on disk.
+        """
+        if not self.closed:
+            self.ops.join()
+
+    def close(self):
+        if self.closed:
+            return
+        self.ops.put(None)
+        self.writer.join()
+        self.closed = True
+
+    def _write_loop(self):
+        conn = self._connect()
+        try:
+            while True:
+                batch = [self.ops.get()]
+                while len(batch) < BATCH_SIZE:
+                    try:
+                        batch.append(self.ops.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = None in batch
+                try:
+                    with conn:
+                        for op in batch:
+                            if op is not None:
+                                self._apply(conn, *op)
+                except sqlite3.Error as e:
+                    print("Error writing backchannel storage:", e)
+                for _ in batch:
+                    self.ops.task_done()
+                if stop:
+                    break
+        finally:
+            conn.close()
+
+    def _apply(self, conn, op, data_id, data_type, data):
+        if op == "push" or op == "store":
+            kind = "queue" if op == "push" else "value"
+            try:
+                data_txt = json.dumps(data)
+            except (TypeError, ValueError):
+                # live objects (e.g. VCX connections) only exist in memory; a queued one
+                # still takes its place in the journal, so later pops delete the right rows
+                (kind, data_txt) = ("memory", "null")
+            if op == "store":
+                conn.execute(
+                    "DELETE FROM resources WHERE data_id = ? AND data_type = ?",
+                    (data_id, data_type),
+                )
+                if kind == "memory":
+                    return
+            conn.execute(
+                "INSERT INTO resources (data_id, data_type, kind, data) VALUES (?, ?, ?, ?)",
+                (data_id, data_type, kind, data_txt),
+            )
+        elif op == "pop":
+            conn.execute(
+                "DELETE FROM resources WHERE seq = ("
+                " SELECT MIN(seq) FROM resources WHERE data_id = ? AND data_type = ?)",
+                (data_id, data_type),
+            )
+        elif op == "remove":
+            conn.execute(
+                "DELETE FROM resources WHERE data_id = ? AND data_type = ?",
+                (data_id, data_type),
+            )
+        elif op == "clear":
+            conn.execute("DELETE FROM resources")
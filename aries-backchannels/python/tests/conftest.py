@@ -0,0 +1,71 @@
+import os
+import sys
+
+# the backchannel modules are imported as python.<module>, from the aries-backchannels folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+import asyncio
+import json
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+from python.agent_backchannel import AgentBackchannel
+from python.utils import load_operations
+
+OPERATIONS_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "data", "backchannel_operations.csv")
+
+
+class FakeBackchannel(AgentBackchannel):
+    """
+    A backchannel whose agent is a dict of records, {rec_id: record} per topic.
+
+    POST commands echo their operation, id and data, or answer with the status and text
+    queued for them in replies; GETs return the record, or the next of a list of records.
+    """
+
+    def __init__(self, tmp_path):
+        super().__init__("Fake", 0, 0)
+        (self.operations, self.operation_index) = load_operations(OPERATIONS_CSV, cache_file=str(tmp_path / "ops.json"))
+        self.records = {}
+        self.replies = {}
+        self.calls = []
+
+    async def make_agent_POST_request(self, op, rec_id=None, data=None, text=False, params=None):
+        self.calls.append(("POST", op["topic"], op["operation"], rec_id, data))
+        reply = self.replies.get((op["topic"], op["operation"]))
+        if reply is not None:
+            if callable(reply):
+                return await reply(rec_id, data)
+            return reply
+        return (200, json.dumps({"operation": op["operation"], "id": rec_id, "data": data}))
+
+    async def make_agent_GET_request(self, op, rec_id=None, text=False, params=None):
+        self.calls.append(("GET", op["topic"], op["operation"], rec_id, None))
+        record = self.records.get(op["topic"], {}).get(rec_id)
+        if record is None:
+            return (404, "404 not found")
+        if isinstance(record, list):
+            record = record.pop(0) if len(record) > 1 else record[0]
+        return (200, json.dumps(record))
+
+
+@pytest.fixture
+def backchannel_client(tmp_path):
+    """
+    run(test) runs the coroutine function test(client, backchannel) against a FakeBackchannel's routes.
+    """
+    def run(test):
+        async def scenario():
+            backchannel = FakeBackchannel(tmp_path)
+            client = TestClient(TestServer(backchannel.backchannel_app()))
+            await client.start_server()
+            try:
+                return await test(client, backchannel)
+            finally:
+                await client.close()
+                await backchannel.client_session.close()
+
+        return asyncio.run(scenario())
+
+    return run
@@ -0,0 +1,116 @@
+import asyncio
+
+from python.agent_backchannel import resolve_batch_references
+
+RESULTS = [
+    {"status": 200, "response": {"connection_id": "c1", "invitation": {"@id": "i1"}, "ids": ["a", "b"]}},
+    {"status": 200, "response": "plain text"},
+]
+
+
+def test_resolve_replaces_whole_values_and_embedded_references():
+    assert resolve_batch_references("${0.connection_id}", RESULTS) == "c1"
+    assert resolve_batch_references("${0.invitation}", RESULTS) == {"@id": "i1"}
+    assert resolve_batch_references("${0.ids.1}", RESULTS) == "b"
+    assert resolve_batch_references({"x": ["conn-${0.connection_id}"]}, RESULTS) == {"x": ["conn-c1"]}
+    assert resolve_batch_references("no references", RESULTS) == "no references"
+
+
+async def post_batch(client, commands):
+    resp = await client.post("/agent/command/batch", json={"commands": commands})
+    assert resp.status == 200, await resp.text()
+    return (await resp.json())["results"]
+
+
+def test_batch_route_takes_precedence_over_topics(backchannel_client):
+    async def test(client, backchannel):
+        for path in ("/agent/command/batch", "/agent/command/batch/"):
+            resp = await client.post(path, json={"commands": [{"topic": "status", "method": "GET"}]})
+            assert resp.status == 200
+            assert "results" in await resp.json()
+        return backchannel.calls
+
+    # no command was matched against a "batch" topic
+    assert backchannel_client(test) == [("GET", "status", "", None, None), ("GET", "status", "", None, None)]
+
+
+def test_later_commands_use_earlier_results(backchannel_client):
+    async def test(client, backchannel):
+        return await post_batch(client, [
+            {"topic": "connection", "operation": "create-invitation", "data": {"label": "Acme"}},
+            {"topic": "connection", "operation": "accept-invitation", "id": "${0.operation}", "data": {"label": "${0.data.label}"}},
+        ])
+
+    results = backchannel_client(test)
+    assert [result["status"] for result in results] == [200, 200]
+    assert results[1]["response"] == {"operation": "accept-invitation", "id": "create-invitation", "data": {"label": "Acme"}}
+
+
+def test_bad_references(backchannel_client):
+    async def test(client, backchannel):
+        return await post_batch(client, [
+            {"topic": "connection", "operation": "create-invitation", "data": {"label": "Acme"}},
+            # a path the response does not have
+            {"topic": "connection", "operation": "accept-invitation", "id": "${0.no_such_field}", "data": {"x": 1}},
+            # itself and a command after it
+            {"topic": "connection", "operation": "accept-invitation", "id": "${2.id}", "data": {"x": 1}},
+            {"topic": "connection", "operation": "accept-invitation", "id": "${9.id}", "data": {"x": 1}},
+        ])
+
+    results = backchannel_client(test)
+    assert [result["status"] for result in results] == [200, 500, 424, 424]
+
+
+def test_dependants_of_a_failed_command_get_424(backchannel_client):
+    async def test(client, backchannel):
+        backchannel.replies[("connection", "create-invitation")] = (400, "bad invitation")
+        backchannel.records["status"] = {None: {"status": "active"}}
+        results = await post_batch(client, [
+            {"topic": "connection", "operation": "create-invitation", "data": {"label": "Acme"}},
+            {"topic": "connection", "operation": "accept-invitation", "id": "${0.id}", "data": {"x": 1}},
+            {"topic": "connection", "operation": "send-ping", "id": "c1", "data": {"comment": "${1.id}"}},
+            {"topic": "status", "method": "GET"},
+        ])
+        return (results, [call[2] for call in backchannel.calls])
+
+    (results, operations) = backchannel_client(test)
+    assert [result["status"] for result in results] == [400, 424, 424, 200]
+    # the dependants never reached the agent, the command without references did
+    assert operations == ["create-invitation", ""]
+
+
+def test_malformed_batches_are_rejected(backchannel_client):
+    async def test(client, backchannel):
+        statuses = []
+        for payload in ({"commands": "status"}, {"commands": [1]}, {"commands": [{"method": "GET"}]}, {"no": "commands"}):
+            resp = await client.post("/agent/command/batch", json=payload)
+            statuses.append(resp.status)
+        return statuses
+
+    assert backchannel_client(test) == [400, 400, 400, 400]
+
+
+def test_independent_commands_only_wait_for_their_references(backchannel_client):
+    events = []
+
+    def slow(name, delay):
+        async def reply(rec_id, data):
+            events.append(f"{name} start")
+            await asyncio.sleep(delay)
+            events.append(f"{name} end")
+            return (200, '{"id": "%s"}' % name)
+        return reply
+
+    async def test(client, backchannel):
+        backchannel.replies[("connection", "create-invitation")] = slow("slow", 0.1)
+        backchannel.replies[("connection", "receive-invitation")] = slow("independent", 0.0)
+        backchannel.replies[("connection", "send-ping")] = slow("sequential", 0.0)
+        return await post_batch(client, [
+            {"topic": "connection", "operation": "create-invitation", "data": {"x": 1}},
+            {"topic": "connection", "operation": "receive-invitation", "data": {"x": 1}, "independent": True},
+            {"topic": "connection", "operation": "send-ping", "id": "c1", "data": {"x": 1}},
+        ])
+
+    results = backchannel_client(test)
+    assert [result["response"]["id"] for result in results] == ["slow", "independent", "sequential"]
+    assert events == ["slow start", "independent start", "independent end", "slow end", "sequential start", "sequential end"]
@@ -0,0 +1,126 @@
+import asyncio
+import json
+from collections import deque
+
+
+async def read_events(resp, count):
+    """
+    The next count events of a server-sent event stream.
+    """
+    events = []
+    event = {}
+    while len(events) < count:
+        line = (await asyncio.wait_for(resp.content.readline(), 2)).decode("utf8").rstrip("\n")
+        if line.startswith("id: "):
+            event["id"] = int(line[4:])
+        elif line.startswith("event: "):
+            event["event"] = line[7:]
+        elif line.startswith("data: "):
+            event["data"] = json.loads(line[6:])
+        elif not line and event:
+            events.append(event)
+            event = {}
+    return events
+
+
+def publish_records(backchannel):
+    backchannel.publish_event("connection", {"state": "invitation"}, record_id="c1")
+    backchannel.publish_event("connection", {"state": "invitation"}, record_id="c2")
+    backchannel.publish_event("issue-credential", {"state": "offer-sent"}, record_id="x1", thread_id="t1")
+    backchannel.publish_event("connection", {"state": "active"}, record_id="c1")
+
+
+def stream(query="", headers=None, count=1, setup=publish_records):
+    async def test(client, backchannel):
+        setup(backchannel)
+        resp = await client.get("/agent/events" + query, headers=headers)
+        assert resp.status == 200
+        assert resp.headers["Content-Type"] == "text/event-stream"
+        try:
+            return await read_events(resp, count)
+        finally:
+            resp.close()
+
+    return test
+
+
+def test_events_are_streamed_in_order(backchannel_client):
+    events = backchannel_client(stream(count=4))
+    assert [event["id"] for event in events] == [1, 2, 3, 4]
+    assert [event["event"] for event in events] == ["connection", "connection", "issue-credential", "connection"]
+    assert events[2]["data"]["id"] == "x1"
+    assert events[2]["data"]["thread_id"] == "t1"
+    assert events[2]["data"]["state"] == "offer-sent"
+
+
+def test_events_are_filtered_by_topic_and_id(backchannel_client):
+    events = backchannel_client(stream("?topic=connection", count=3))
+    assert [event["id"] for event in events] == [1, 2, 4]
+
+    events = backchannel_client(stream("?id=c1", count=2))
+    assert [event["id"] for event in events] == [1, 4]
+
+    # thread ids match too
+    events = backchannel_client(stream("?topic=connection,issue-credential&id=t1,c2", count=2))
+    assert [event["id"] for event in events] == [2, 3]
+
+
+def test_streams_resume_after_since_or_last_event_id(backchannel_client):
+    events = backchannel_client(stream("?since=2", count=2))
+    assert [event["id"] for event in events] == [3, 4]
+
+    events = backchannel_client(stream(headers={"Last-Event-ID": "3"}))
+    assert [event["id"] for event in events] == [4]
+
+    # since wins over the header
+    events = backchannel_client(stream("?since=1", headers={"Last-Event-ID": "3"}, count=3))
+    assert [event["id"] for event in events] == [2, 3, 4]
+
+
+def test_events_published_while_streaming_are_sent(backchannel_client):
+    async def test(client, backchannel):
+        resp = await client.get("/agent/events?since=0")
+        try:
+            backchannel.publish_event("connection", {"state": "request"}, record_id="c1")
+            return await read_events(resp, 1)
+        finally:
+            resp.close()
+
+    events = backchannel_client(test)
+    assert events[0]["data"]["state"] == "request"
+
+
+def test_resume_after_a_buffer_overrun_starts_at_the_oldest_event(backchannel_client):
+    def overrun(backchannel):
+        backchannel.events = deque(maxlen=2)
+        publish_records(backchannel)
+
+    events = backchannel_client(stream("?since=1", count=2, setup=overrun))
+    assert [event["id"] for event in events] == [3, 4]
+
+
+def test_bad_since_is_rejected(backchannel_client):
+    async def test(client, backchannel):
+        resp = await client.get("/agent/events?since=latest")
+        return resp.status
+
+    assert backchannel_client(test) == 400
+
+
+def test_states_are_translated_and_translation_errors_are_ignored(backchannel_client):
+    def translate(topic, operation, data):
+        if json.loads(data)["state"] != "invitation":
+            raise RuntimeError("no RFC state")
+        return json.dumps({"state": "invited"})
+
+    async def test(client, backchannel):
+        backchannel.agent_state_translation = translate
+        return (
+            backchannel.publish_event("connection", {"state": "invitation"}, record_id="c1"),
+            backchannel.publish_event("connection", {"state": "unknown"}, record_id="c1"),
+        )
+
+    (translated, untranslated) = backchannel_client(test)
+    assert translated["state"] == "invited"
+    assert untranslated["state"] == "unknown"
+    assert untranslated["seq"] == 2
@@ -0,0 +1,100 @@
+import atexit
+import io
+import json
+import logging
+import sys
+
+import pytest
+
+from python import utils
+from python.utils import JsonLinesFormatter, LOGGER
+
+
+def record(msg="webhook received", payload=None, exc_info=None):
+    return LOGGER.makeRecord(LOGGER.name, logging.INFO, __name__, 0, msg, None, exc_info, extra={"payload": payload})
+
+
+@pytest.fixture
+def json_logging(monkeypatch):
+    """
+    JSON lines logging to a StringIO at DEBUG; stop() flushes the writer and returns the entries.
+    """
+    monkeypatch.setattr(utils, "LOG_FORMAT", "json")
+    monkeypatch.setattr(utils.setup_json_logging, "writer", None, raising=False)
+    (handlers, level, propagate) = (list(LOGGER.handlers), LOGGER.level, LOGGER.propagate)
+    stream = io.StringIO()
+    writer = utils.setup_json_logging(stream=stream, level="DEBUG")
+
+    def stop():
+        writer.stop()
+        return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+    yield stop
+    atexit.unregister(writer.stop)
+    if writer.thread.is_alive():
+        writer.stop()
+    LOGGER.handlers = handlers
+    LOGGER.setLevel(level)
+    LOGGER.propagate = propagate
+
+
+def test_entries_have_the_record_fields():
+    entry = json.loads(JsonLinesFormatter().format(record()))
+    assert list(entry) == ["time", "level", "logger", "msg"]
+    assert entry["level"] == "INFO"
+    assert entry["logger"] == LOGGER.name
+    assert entry["msg"] == "webhook received"
+
+
+def test_exceptions_are_formatted():
+    try:
+        raise ValueError("bad webhook")
+    except ValueError:
+        entry = json.loads(JsonLinesFormatter().format(record(exc_info=sys.exc_info())))
+    assert "ValueError: bad webhook" in entry["exc"]
+
+
+def test_payloads_are_added():
+    formatter = JsonLinesFormatter()
+    assert json.loads(formatter.format(record(payload={"state": "active"})))["payload"] == {"state": "active"}
+    assert json.loads(formatter.format(record(payload="text")))["payload"] == "text"
+    assert json.loads(formatter.format(record(payload=b"bytes \xff")))["payload"] == "bytes \ufffd"
+    # objects json can't encode are logged as their str
+    assert json.loads(formatter.format(record(payload={"at": object})))["payload"]["at"] == str(object)
+
+
+def test_long_payloads_are_truncated(monkeypatch):
+    monkeypatch.setattr(utils, "LOG_MAX_PAYLOAD", 10)
+
+    entry = json.loads(JsonLinesFormatter().format(record(payload={"state": "active"})))
+    assert entry["payload"] == '{"state": '
+    assert entry["payload_truncated"] == len('{"state": "active"}') - 10
+
+
+def test_the_writer_flushes_every_queued_record_on_stop(json_logging):
+    for i in range(utils.LOG_BATCH_SIZE * 2 + 1):
+        utils.log_msg("message", i)
+    entries = json_logging()
+    assert [entry["msg"] for entry in entries] == [f"message {i}" for i in range(utils.LOG_BATCH_SIZE * 2 + 1)]
+
+
+def test_payloads_are_sampled(json_logging, monkeypatch):
+    monkeypatch.setattr(utils, "LOG_PAYLOAD_SAMPLE", 1.0)
+    utils.log_payload("sampled: ", {"state": "active"})
+    monkeypatch.setattr(utils, "LOG_PAYLOAD_SAMPLE", 0.0)
+    utils.log_payload("not sampled: ", {"state": "active"})
+
+    entries = json_logging()
+    assert [(entry["level"], entry["msg"], entry.get("payload")) for entry in entries] == [
+        ("DEBUG", "sampled", {"state": "active"}),
+        ("INFO", "not sampled", None),
+    ]
+
+
+def test_payloads_are_not_logged_at_info(json_logging):
+    LOGGER.setLevel(logging.INFO)
+    utils.log_payload("webhook: ", {"state": "active"})
+    utils.log_json({"state": "active"}, label="webhook")
+
+    entries = json_logging()
+    assert [(entry["level"], entry["msg"], entry.get("payload")) for entry in entries] == [("INFO", "webhook", None)]
@@ -0,0 +1,96 @@
+import asyncio
+import json
+import time
+
+import python.agent_backchannel as agent_backchannel
+
+
+def long_poll(query, change=None, delay=0.05):
+    """
+    GET connection c1 with query, changing its record with change(backchannel) after delay seconds.
+
+    Returns the response status, the state returned, the seconds taken and the number of agent GETs.
+    """
+    async def test(client, backchannel):
+        backchannel.records["connection"] = {"c1": {"state": "invited"}}
+
+        async def update():
+            await asyncio.sleep(delay)
+            change(backchannel)
+
+        task = asyncio.ensure_future(update()) if change else None
+        start = time.monotonic()
+        resp = await client.get("/agent/command/connection/c1" + query)
+        elapsed = time.monotonic() - start
+        if task:
+            await task
+        text = await resp.text()
+        gets = [call for call in backchannel.calls if call[0] == "GET"]
+        return (resp.status, json.loads(text).get("state") if resp.status == 200 else text, elapsed, len(gets))
+
+    return test
+
+
+def activate(backchannel, publish=True):
+    backchannel.records["connection"]["c1"] = {"state": "active"}
+    if publish:
+        backchannel.publish_event("connection", {"state": "active"}, record_id="c1")
+
+
+def test_without_wait_for_state_the_record_is_returned(backchannel_client):
+    (status, state, _, gets) = backchannel_client(long_poll(""))
+    assert (status, state, gets) == (200, "invited", 1)
+
+
+def test_a_record_already_in_the_state_is_returned_at_once(backchannel_client):
+    (status, state, _, gets) = backchannel_client(long_poll("?wait_for_state=request,invited"))
+    assert (status, state, gets) == (200, "invited", 1)
+
+
+def test_a_webhook_event_wakes_the_wait(backchannel_client):
+    (status, state, elapsed, gets) = backchannel_client(long_poll("?wait_for_state=active&timeout=10", activate))
+    assert (status, state, gets) == (200, "active", 2)
+    assert elapsed < agent_backchannel.LONG_POLL_RECHECK
+
+
+def test_events_for_other_records_are_ignored(backchannel_client):
+    def other(backchannel):
+        backchannel.publish_event("connection", {"state": "active"}, record_id="c2")
+
+    # fetched once at the start and once more at the deadline
+    (status, state, elapsed, gets) = backchannel_client(long_poll("?wait_for_state=active&timeout=0.3", other))
+    assert (status, state, gets) == (200, "invited", 2)
+    assert elapsed >= 0.3
+
+
+def test_the_record_is_rechecked_without_events(backchannel_client, monkeypatch):
+    monkeypatch.setattr(agent_backchannel, "LONG_POLL_RECHECK", 0.05)
+
+    (status, state, elapsed, gets) = backchannel_client(
+        long_poll("?wait_for_state=active&timeout=10", lambda backchannel: activate(backchannel, publish=False), delay=0.2)
+    )
+    assert (status, state) == (200, "active")
+    assert gets >= 3
+    assert elapsed < 2
+
+
+def test_the_last_response_is_returned_on_timeout(backchannel_client):
+    (status, state, elapsed, _) = backchannel_client(long_poll("?wait_for_state=active&timeout=0.2"))
+    assert (status, state) == (200, "invited")
+    assert 0.2 <= elapsed < 2
+
+
+def test_the_timeout_is_clamped(backchannel_client, monkeypatch):
+    monkeypatch.setattr(agent_backchannel, "LONG_POLL_MAX_TIMEOUT", 0.2)
+
+    (status, state, elapsed, _) = backchannel_client(long_poll("?wait_for_state=active&timeout=300"))
+    assert (status, state) == (200, "invited")
+    assert 0.2 <= elapsed < 2
+
+
+def test_missing_records_are_not_found(backchannel_client):
+    async def test(client, backchannel):
+        resp = await client.get("/agent/command/connection/c1?wait_for_state=active&timeout=0.1")
+        return resp.status
+
+    assert backchannel_client(test) == 404
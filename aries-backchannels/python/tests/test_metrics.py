@@ -0,0 +1,42 @@
+import pytest
+
+from python import metrics
+from python.metrics import (
+    observe_request,
+    observe_webhook,
+    record_webhook,
+    register_operations,
+    render_metrics,
+    reset_metrics,
+)
+
+
+@pytest.fixture(autouse=True)
+def empty_metrics():
+    reset_metrics()
+    metrics.webhook_topics.clear()
+    yield
+    reset_metrics()
+    metrics.webhook_topics.clear()
+
+
+def test_request_labels_come_from_the_operations_table():
+    register_operations([{"topic": "issue-credential", "operation": "send-offer"}])
+    observe_request("issue-credential", "POST", "send-offer", 200, 0.1)
+    observe_request("d1b4e6c2-id", "POST", "send-offer", 404, 0.1)
+    observe_request("issue-credential", "BREW", "../../etc", 404, 0.1)
+    assert set(metrics.request_counts) == {
+        ("issue-credential", "POST", "send-offer"),
+        ("other", "POST", "send-offer"),
+        ("issue-credential", "other", "other"),
+    }
+
+
+def test_webhook_topics_are_capped(monkeypatch):
+    monkeypatch.setattr(metrics, "MAX_WEBHOOK_TOPICS", 2)
+    for topic in ("connections", "present_proof", "bad topic/1", "issue_credential", "connections"):
+        record_webhook(topic)
+        observe_webhook(topic, 0.0, 0.0)
+    assert metrics.webhook_counts == {("connections",): 2, ("present_proof",): 1, ("other",): 2}
+    assert set(metrics.webhook_handling_latency) == set(metrics.webhook_counts)
+    assert 'backchannel_webhooks_total{topic="other"} 2' in render_metrics()
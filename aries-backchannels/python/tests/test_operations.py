@@ -0,0 +1,81 @@
+import os
+
+from python.benchmarks.bench_match_operation import build_requests, linear_match
+from python.utils import compile_operations, find_operation, load_operations, read_operations
+
+OPERATIONS_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "data", "backchannel_operations.csv")
+
+TABLE = """topic,method,operation,id,data
+status,GET,,,
+connection,GET,,Y,
+connection,GET,,,
+connection,POST,create-invitation,,Y
+connection,POST,accept-invitation,Y,
+connection,POST,accept-invitation,Y,Y
+issue-credential,POST,send-offer,,Y
+issue-credential,POST,send-offer,Y,Y
+"""
+
+
+def compiled():
+    operations = read_operations(str_data=TABLE)
+    return (operations, compile_operations(operations))
+
+
+def test_finds_the_row_for_a_plain_request():
+    (operations, index) = compiled()
+    assert find_operation(index, "status", "GET") is operations[0]
+
+
+def test_an_id_selects_the_row_that_takes_one():
+    (operations, index) = compiled()
+    assert find_operation(index, "connection", "GET", rec_id="conn-1") is operations[1]
+
+
+def test_first_matching_row_wins():
+    (operations, index) = compiled()
+    # both accept-invitation rows take an id, the first one does not need data
+    assert find_operation(index, "connection", "POST", "accept-invitation", rec_id="conn-1") is operations[4]
+    assert find_operation(index, "connection", "POST", "accept-invitation", "conn-1", {"a": 1}) is operations[5]
+    # rows that take an id or data also match requests without them
+    assert find_operation(index, "issue-credential", "POST", "send-offer") is operations[6]
+
+
+def test_requests_no_row_can_serve_are_not_found():
+    (_, index) = compiled()
+    assert find_operation(index, "no-such-topic", "GET") is None
+    assert find_operation(index, "status", "GET", rec_id="conn-1") is None
+    assert find_operation(index, "connection", "POST", "create-invitation", rec_id="conn-1") is None
+    assert find_operation(index, "connection", "POST", "no-such-operation") is None
+
+
+def test_empty_id_data_or_operation_never_match():
+    (_, index) = compiled()
+    assert find_operation(index, "connection", "GET", rec_id="") is None
+    assert find_operation(index, "connection", "POST", "create-invitation", data={}) is None
+    assert find_operation(index, "connection", "POST", operation="") is None
+
+
+def test_index_agrees_with_a_linear_scan_of_the_shipped_table():
+    operations = read_operations(file_name=OPERATIONS_CSV)
+    index = compile_operations(operations)
+    for request in build_requests(operations):
+        assert find_operation(index, *request) is linear_match(operations, *request), request
+
+
+def test_load_operations_reuses_the_cache_until_the_table_changes(tmp_path):
+    table = tmp_path / "operations.csv"
+    cache = str(tmp_path / "operations.json")
+    table.write_text(TABLE)
+    (operations, index) = load_operations(str(table), cache_file=cache)
+    assert os.path.exists(cache)
+
+    (cached_operations, cached_index) = load_operations(str(table), cache_file=cache)
+    assert cached_operations == operations
+    found = find_operation(cached_index, "connection", "POST", "accept-invitation", rec_id="conn-1")
+    # rows in the cached index are the same objects as in the operations list
+    assert found is cached_operations[4]
+
+    table.write_text(TABLE + "revocation,POST,revoke,,Y\n")
+    (operations, index) = load_operations(str(table), cache_file=cache)
+    assert find_operation(index, "revocation", "POST", "revoke", data={"a": 1}) is operations[-1]
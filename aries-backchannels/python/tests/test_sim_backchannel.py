@@ -0,0 +1,86 @@
+import asyncio
+import json
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from python.utils import load_operations
+from sim.sim_backchannel import SimAgentBackchannel, sim_agents
+
+from conftest import OPERATIONS_CSV
+
+
+class SimAgent:
+    """
+    A simulated agent driven through the test client for its backchannel routes.
+    """
+
+    def __init__(self, name, port, tmp_path):
+        self.backchannel = SimAgentBackchannel("sim." + name, port)
+        (self.backchannel.operations, self.backchannel.operation_index) = load_operations(
+            OPERATIONS_CSV, cache_file=str(tmp_path / "ops.json")
+        )
+        self.backchannel.activate()
+        self.client = TestClient(TestServer(self.backchannel.backchannel_app()))
+
+    async def post(self, topic, operation="", id=None, data=None):
+        payload = {"data": data} if data else {}
+        if id:
+            payload["id"] = id
+        resp = await self.client.post(f"/agent/command/{topic}/{operation}/" if operation else f"/agent/command/{topic}/", json=payload)
+        assert resp.status == 200, await resp.text()
+        return json.loads(await resp.text())
+
+    async def wait_for(self, topic, rec_id, state):
+        resp = await self.client.get(f"/agent/command/{topic}/{rec_id}", params={"wait_for_state": state, "timeout": "5"})
+        assert resp.status == 200, await resp.text()
+        record = json.loads(await resp.text())
+        assert record["state"] == state
+        return record
+
+
+def test_a_connection_and_credential_issue_through_the_http_api(tmp_path):
+    async def scenario():
+        acme = SimAgent("Acme", 9020, tmp_path)
+        bob = SimAgent("Bob", 9030, tmp_path)
+        for agent in (acme, bob):
+            await agent.client.start_server()
+        try:
+            # 0160 connection
+            invitation = await acme.post("connection", "create-invitation")
+            acme_id = invitation["connection_id"]
+            bob_id = (await bob.post("connection", "receive-invitation", data=invitation["invitation"]))["connection_id"]
+            assert (await bob.post("connection", "accept-invitation", id=bob_id))["state"] == "requested"
+            await acme.wait_for("connection", acme_id, "requested")
+            assert (await acme.post("connection", "accept-request", id=acme_id))["state"] == "responded"
+            await bob.wait_for("connection", bob_id, "responded")
+            assert (await bob.post("connection", "send-ping", id=bob_id))["state"] == "complete"
+            await acme.wait_for("connection", acme_id, "complete")
+
+            # 0036 issue credential
+            schema = await acme.post("schema", data={"schema_name": "Degree", "schema_version": "1.0", "attributes": ["name"]})
+            cred_def = await acme.post("credential-definition", data={"schema_id": schema["schema_id"], "tag": "smoke"})
+            offer = await acme.post("issue-credential", "send-offer", data={
+                "connection_id": acme_id,
+                "cred_def_id": cred_def["credential_definition_id"],
+                "credential_preview": {"attributes": [{"name": "name", "value": "Bob"}]},
+            })
+            thread_id = offer["thread_id"]
+            await bob.wait_for("issue-credential", thread_id, "offer-received")
+            await bob.post("issue-credential", "send-request", id=thread_id)
+            await acme.wait_for("issue-credential", thread_id, "request-received")
+            await acme.post("issue-credential", "issue", id=thread_id)
+            await bob.wait_for("issue-credential", thread_id, "credential-received")
+            stored = await bob.post("issue-credential", "store", id=thread_id)
+            await acme.wait_for("issue-credential", thread_id, "done")
+
+            resp = await bob.client.get(f"/agent/command/credential/{stored['credential_id']}")
+            return json.loads(await resp.text())
+        finally:
+            for agent in (acme, bob):
+                await agent.client.close()
+                await agent.backchannel.terminate()
+
+    credential = asyncio.run(scenario())
+    assert credential["attrs"] == {"name": "Bob"}
+    assert credential["cred_def_id"].endswith(":smoke")
+    assert not sim_agents
@@ -0,0 +1,241 @@
+import asyncio
+import threading
+
+import pytest
+
+from python import storage
+from python.storage import (
+    StorageBackend,
+    clear_resource,
+    configure_storage,
+    get_resource,
+    get_resources,
+    get_storage_stats,
+    pop_resource,
+    pop_resource_latest,
+    push_resource,
+    set_storage_backend,
+    store_resource,
+    wait_pop,
+    wait_pop_latest,
+)
+
+
+@pytest.fixture(autouse=True)
+def empty_storage():
+    config = dict(storage.storage_config)
+    configure_storage(ttls={}, default_ttl=0, max_entries=0, max_bytes=0)
+    clear_resource()
+    yield
+    clear_resource()
+    storage.waiters.clear()
+    storage.storage_config.update(config)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(storage, "monotonic", lambda: now[0])
+    return now
+
+
+def test_pop_returns_messages_in_push_order():
+    push_resource("t1", "credential-msg", {"n": 1})
+    push_resource("t1", "credential-msg", {"n": 2})
+    assert pop_resource("t1", "credential-msg") == {"n": 1}
+    assert pop_resource("t1", "credential-msg") == {"n": 2}
+    assert pop_resource("t1", "credential-msg") is None
+
+
+def test_pop_latest_on_empty_store_returns_none():
+    assert pop_resource_latest("credential-msg") is None
+
+
+def test_wait_pop_returns_a_message_pushed_while_waiting():
+    async def scenario():
+        asyncio.get_event_loop().call_later(0.05, push_resource, "t1", "credential-msg", {"n": 1})
+        return await wait_pop("t1", "credential-msg", 5.0)
+
+    assert asyncio.run(scenario()) == {"n": 1}
+    assert get_storage_stats()["waiters"] == 0
+
+
+def test_wait_pop_returns_a_queued_message_without_waiting():
+    push_resource("t1", "credential-msg", {"n": 1})
+    assert asyncio.run(wait_pop("t1", "credential-msg", 0.0)) == {"n": 1}
+
+
+def test_wait_pop_times_out_with_none_and_removes_its_waiter():
+    assert asyncio.run(wait_pop("t1", "credential-msg", 0.05)) is None
+    assert get_storage_stats()["waiters"] == 0
+
+
+def test_wait_pop_ignores_other_ids_and_types():
+    async def scenario():
+        loop = asyncio.get_event_loop()
+        loop.call_later(0.01, push_resource, "t2", "credential-msg", {"n": 2})
+        loop.call_later(0.01, push_resource, "t1", "connection-msg", {"n": 3})
+        return await wait_pop("t1", "credential-msg", 0.1)
+
+    assert asyncio.run(scenario()) is None
+    assert pop_resource("t2", "credential-msg") == {"n": 2}
+
+
+def test_wait_pop_latest_wakes_on_any_id():
+    async def scenario():
+        asyncio.get_event_loop().call_later(0.05, push_resource, "t9", "credential-msg", {"n": 9})
+        return await wait_pop_latest("credential-msg", 5.0)
+
+    assert asyncio.run(scenario()) == {"n": 9}
+
+
+def test_push_from_another_thread_wakes_the_waiter():
+    async def scenario():
+        timer = threading.Timer(0.05, push_resource, ("t1", "credential-msg", {"n": 1}))
+        timer.start()
+        try:
+            return await wait_pop("t1", "credential-msg", 5.0)
+        finally:
+            timer.join()
+
+    assert asyncio.run(scenario()) == {"n": 1}
+
+
+def test_concurrent_waiters_each_get_one_message():
+    async def scenario():
+        waits = [asyncio.ensure_future(wait_pop("t1", "credential-msg", 5.0)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        for n in range(3):
+            push_resource("t1", "credential-msg", {"n": n})
+        return await asyncio.gather(*waits)
+
+    results = asyncio.run(scenario())
+    assert sorted(result["n"] for result in results) == [0, 1, 2]
+    assert get_storage_stats()["waiters"] == 0
+
+
+def test_ttl_expires_only_the_configured_type(clock):
+    configure_storage(ttls={"problem-report-msg": 10})
+    push_resource("t1", "problem-report-msg", {"n": 1})
+    store_resource("t1", "connection", {"n": 2})
+    clock[0] += 11
+    assert pop_resource("t1", "problem-report-msg") is None
+    assert get_resource("t1", "connection") == {"n": 2}
+    assert get_storage_stats()["expirations"] >= 1
+
+
+def test_ttl_counts_from_the_last_write(clock):
+    configure_storage(ttls={"problem-report-msg": 10})
+    push_resource("t1", "problem-report-msg", {"n": 1})
+    clock[0] += 8
+    push_resource("t1", "problem-report-msg", {"n": 2})
+    clock[0] += 8
+    assert pop_resource("t1", "problem-report-msg") == {"n": 1}
+
+
+def test_default_ttl_applies_to_every_type(clock):
+    configure_storage(default_ttl=5)
+    store_resource("t1", "connection", {"n": 1})
+    clock[0] += 6
+    assert get_resources("connection") == {}
+
+
+def test_unbounded_store_keeps_every_mapping():
+    for i in range(1000):
+        store_resource(str(i), "connection", {"n": i})
+    assert len(get_resources("connection")) == 1000
+    assert get_storage_stats()["evictions"] == 0
+
+
+def test_max_entries_evicts_the_least_recently_used():
+    configure_storage(max_entries=2)
+    store_resource("t1", "connection", {"n": 1})
+    store_resource("t2", "connection", {"n": 2})
+    # reading t1 makes t2 the least recently used
+    assert get_resource("t1", "connection") == {"n": 1}
+    store_resource("t3", "connection", {"n": 3})
+    assert get_resource("t2", "connection") is None
+    assert get_resource("t1", "connection") == {"n": 1}
+    assert get_resource("t3", "connection") == {"n": 3}
+    assert get_storage_stats()["evictions"] == 1
+
+
+def test_queued_messages_count_towards_max_entries():
+    configure_storage(max_entries=3)
+    for n in range(3):
+        push_resource("t1", "credential-msg", {"n": n})
+    push_resource("t2", "credential-msg", {"n": 3})
+    # the whole t1 queue is evicted as one slot
+    assert pop_resource("t1", "credential-msg") is None
+    assert pop_resource("t2", "credential-msg") == {"n": 3}
+
+
+def test_max_bytes_evicts_until_under_the_limit():
+    configure_storage(max_bytes=100)
+    for i in range(10):
+        store_resource(str(i), "connection", {"payload": "x" * 30})
+    data_stats = get_storage_stats()
+    assert 0 < data_stats["bytes"] <= 100
+    assert get_resource("9", "connection") is not None
+
+
+@pytest.fixture
+def journal(tmp_path):
+    from python.storage_sqlite import SQLiteStorageBackend
+
+    file_name = str(tmp_path / "backchannel.sqlite")
+
+    def restart():
+        # what a restarted backchannel sees: an empty store reloaded from the journal
+        storage.backend.flush()
+        set_storage_backend(StorageBackend())
+        set_storage_backend(SQLiteStorageBackend(file_name))
+
+    set_storage_backend(SQLiteStorageBackend(file_name))
+    yield restart
+    set_storage_backend(StorageBackend())
+
+
+def journal_rows(file_name):
+    import sqlite3
+
+    conn = sqlite3.connect(file_name)
+    try:
+        return conn.execute("SELECT data_id, data_type, kind, data FROM resources ORDER BY seq").fetchall()
+    finally:
+        conn.close()
+
+
+def test_journal_replays_queues_and_mappings_in_order(journal):
+    for n in range(3):
+        push_resource("t1", "credential-msg", {"n": n})
+    store_resource("t1", "connection", {"connection_id": "c1"})
+    store_resource("t1", "connection", {"connection_id": "c2"})
+    journal()
+    assert get_resource("t1", "connection") == {"connection_id": "c2"}
+    assert [pop_resource("t1", "credential-msg") for _ in range(4)] == [{"n": 0}, {"n": 1}, {"n": 2}, None]
+
+
+def test_journal_deletes_the_popped_row(journal, tmp_path):
+    push_resource("t1", "credential-msg", {"n": 1})
+    push_resource("t2", "credential-msg", {"n": 2})
+    push_resource("t1", "credential-msg", {"n": 3})
+    assert pop_resource("t1", "credential-msg") == {"n": 1}
+    storage.backend.flush()
+    assert journal_rows(str(tmp_path / "backchannel.sqlite")) == [
+        ("t2", "credential-msg", "queue", '{"n": 2}'),
+        ("t1", "credential-msg", "queue", '{"n": 3}'),
+    ]
+    journal()
+    assert pop_resource("t1", "credential-msg") == {"n": 3}
+    assert pop_resource("t2", "credential-msg") == {"n": 2}
+
+
+def test_journal_skips_live_objects_without_shifting_later_pops(journal):
+    push_resource("t1", "credential-msg", object())
+    push_resource("t1", "credential-msg", {"n": 1})
+    store_resource("t1", "vcx-connection", object())
+    assert isinstance(pop_resource("t1", "credential-msg"), object)
+    journal()
+    assert pop_resource("t1", "credential-msg") == {"n": 1}
+    assert get_resource("t1", "vcx-connection") is None
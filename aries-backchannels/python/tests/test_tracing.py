@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+from python import tracing
+from python.tracing import TraceWriter, parse_traceparent, span, trace_headers, webhook_span
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+SPAN_ID = "00f067aa0ba902b7"
+
+
+@pytest.fixture
+def trace_file(tmp_path, monkeypatch):
+    file_name = tmp_path / "backchannel.trace.json"
+    writer = TraceWriter(str(file_name), "acme")
+    monkeypatch.setattr(tracing, "writer", writer)
+
+    def events():
+        # the closing bracket is never written
+        return json.loads(file_name.read_text().rstrip(",\n") + "]")
+
+    yield events
+    writer.close()
+
+
+def test_parse_traceparent():
+    assert parse_traceparent(f"00-{TRACE_ID}-{SPAN_ID}-01") == (TRACE_ID, SPAN_ID)
+    assert parse_traceparent(f" 00-{TRACE_ID.upper()}-{SPAN_ID}-01 ") == (TRACE_ID, SPAN_ID)
+    assert parse_traceparent(f"01-{TRACE_ID}-{SPAN_ID}-01") is None
+    assert parse_traceparent("garbage") is None
+    assert parse_traceparent(None) is None
+
+
+def test_trace_headers_follow_the_current_span():
+    assert trace_headers() is None
+    with span("outer", "test") as outer:
+        assert trace_headers() == {"traceparent": f"00-{outer.trace_id}-{outer.span_id}-01"}
+    assert trace_headers() is None
+
+
+def test_nested_spans_share_the_trace(trace_file):
+    with span("outer", "test") as outer:
+        with span("inner", "test") as inner:
+            pass
+    assert inner.trace_id == outer.trace_id
+    assert inner.parent_id == outer.span_id
+    events = {e["name"]: e for e in trace_file() if e["ph"] == "X"}
+    assert events["inner"]["args"]["parent_id"] == outer.span_id
+    assert events["outer"]["args"]["parent_id"] is None
+
+
+def test_remote_parent_continues_the_trace_with_a_flow_event(trace_file):
+    with span("POST /agent/command/status", "backchannel", trace_id=TRACE_ID, parent_id=SPAN_ID):
+        pass
+    events = trace_file()
+    assert [e["ph"] for e in events] == ["M", "X", "f"]
+    assert events[1]["args"]["trace_id"] == TRACE_ID
+    assert events[2]["id"] == SPAN_ID
+
+
+def test_span_records_the_error_and_lets_it_propagate(trace_file):
+    with pytest.raises(KeyError):
+        with span("failing", "test"):
+            raise KeyError("missing")
+    (event,) = [e for e in trace_file() if e["ph"] == "X"]
+    assert event["args"]["error"] == "KeyError('missing')"
+
+
+def test_webhook_spans_of_one_thread_share_a_row(trace_file):
+    with webhook_span("issue_credential", {"thread_id": "thread-1", "state": "offer_received"}):
+        pass
+    with webhook_span("issue_credential", {"thread_id": "thread-1", "state": "credential_acked"}):
+        pass
+    with webhook_span("issue_credential", {"thread_id": "thread-2", "state": "offer_received"}):
+        pass
+    rows = [e["tid"] for e in trace_file() if e["ph"] == "X"]
+    assert rows[0] == rows[1]
+    assert rows[0] != rows[2]
@@ -0,0 +1,94 @@
+import asyncio
+import json
+
+from python.webhooks import WebhookDispatcher, webhook_key
+
+
+def body(**payload):
+    return json.dumps(payload).encode("utf8")
+
+
+async def settle(dispatcher):
+    # let the dispatcher and every lane run until nothing is left to handle
+    for _ in range(100):
+        await asyncio.sleep(0)
+        if dispatcher.queue.empty() and not dispatcher.lanes:
+            return
+
+
+def test_webhook_key_prefers_the_protocol_thread():
+    assert webhook_key("issue_credential", {"thread_id": "t1", "connection_id": "c1"}) == "t1"
+    assert webhook_key("connections", {"connection_id": "c1"}) == "c1"
+    assert webhook_key("issue_credential", {"thread_id": ""}) == "issue_credential"
+    assert webhook_key("ping", ["not", "a", "dict"]) == "ping"
+
+
+def test_webhooks_of_one_thread_are_handled_one_at_a_time_in_order():
+    handled = []
+    running = {}
+
+    async def handle(topic, payload):
+        key = payload["thread_id"]
+        assert not running.get(key), "two webhooks of one thread handled at once"
+        running[key] = True
+        await asyncio.sleep(0.01)
+        running[key] = False
+        handled.append((key, payload["n"]))
+
+    async def scenario():
+        dispatcher = WebhookDispatcher(handle)
+        for n in range(5):
+            dispatcher.submit("issue_credential", body(thread_id="t1", n=n))
+        await asyncio.sleep(0.2)
+        await dispatcher.close()
+
+    asyncio.run(scenario())
+    assert handled == [("t1", n) for n in range(5)]
+
+
+def test_different_threads_are_handled_concurrently():
+    started = []
+    release = None
+
+    async def handle(topic, payload):
+        started.append(payload["thread_id"])
+        await release.wait()
+
+    async def scenario():
+        nonlocal release
+        release = asyncio.Event()
+        dispatcher = WebhookDispatcher(handle)
+        dispatcher.submit("issue_credential", body(thread_id="t1"))
+        dispatcher.submit("present_proof", body(thread_id="t2"))
+        for _ in range(10):
+            await asyncio.sleep(0)
+        # both handlers started while the first one is still blocked
+        both_started = sorted(started)
+        release.set()
+        await settle(dispatcher)
+        await dispatcher.close()
+        return both_started
+
+    assert asyncio.run(scenario()) == ["t1", "t2"]
+
+
+def test_bad_bodies_and_failing_handlers_do_not_stop_the_dispatcher():
+    handled = []
+
+    async def handle(topic, payload):
+        if payload.get("fail"):
+            raise ValueError("handler failed")
+        handled.append(payload["n"])
+
+    async def scenario():
+        dispatcher = WebhookDispatcher(handle)
+        dispatcher.submit("connections", b"{not json")
+        dispatcher.submit("connections", body(connection_id="c1", fail=True))
+        dispatcher.submit("connections", body(connection_id="c1", n=1))
+        await settle(dispatcher)
+        lanes = dict(dispatcher.lanes)
+        await dispatcher.close()
+        return lanes
+
+    assert asyncio.run(scenario()) == {}
+    assert handled == [1]
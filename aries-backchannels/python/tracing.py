@@ -0,0 +1,176 @@
+import json
+import os
+import random
+import re
+import threading
+import time
+import zlib
+from contextvars import ContextVar
+
+from aiohttp import web
+
+
+# directory for Chrome trace-event files, tracing is off when unset
+TRACE_DIR = os.getenv("TRACE_DIR")
+
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+# (trace_id, span_id) of the span being handled, propagated to admin API calls
+current_span = ContextVar("current_span", default=None)
+
+
+class TraceWriter:
+    """
+    Appends complete ("X") and flow events to a Chrome trace-event JSON array.
+
+    The closing bracket is never written, which trace viewers accept, so the
+    file stays loadable if the backchannel is killed mid-run.
+    """
+
+    def __init__(self, file_name: str, process_name: str):
+        self.file = open(file_name, "w")
+        self.lock = threading.Lock()
+        # containers all run their backchannel as pid 1, so derive a stable pid from the name
+        self.pid = zlib.crc32(process_name.encode("utf8")) & 0x7FFFFFFF
+        self.file.write("[\n")
+        self.write({"name": "process_name", "ph": "M", "pid": self.pid, "args": {"name": process_name}})
+
+    def write(self, event):
+        line = json.dumps(event) + ",\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+writer = None
+
+
+def open_trace(name):
+    """
+    Start writing spans to TRACE_DIR/<name>-<pid>.trace.json, if TRACE_DIR is set.
+    """
+    global writer
+    if not TRACE_DIR or writer:
+        return
+    os.makedirs(TRACE_DIR, exist_ok=True)
+    file_name = os.path.join(
+        TRACE_DIR, f"{re.sub(r'[^A-Za-z0-9_.-]', '_', name)}-{os.getpid()}.trace.json"
+    )
+    writer = TraceWriter(file_name, name)
+
+
+def new_trace_id():
+    return "%032x" % random.getrandbits(128)
+
+
+def new_span_id():
+    return "%016x" % random.getrandbits(64)
+
+
+def parse_traceparent(value):
+    """
+    The (trace_id, span_id) of a W3C traceparent header, or None.
+    """
+    match = TRACEPARENT.match((value or "").strip().lower())
+    return (match.group(1), match.group(2)) if match else None
+
+
+def trace_headers():
+    """
+    A traceparent header for an outgoing request made while handling the current span.
+    """
+    span = current_span.get()
+    if span is None:
+        return None
+    return {"traceparent": f"00-{span[0]}-{span[1]}-01"}
+
+
+def _row(key):
+    # one viewer row per trace (or protocol thread), so each exchange reads left to right
+    return zlib.crc32(key.encode("utf8")) & 0xFFFF if key else 0
+
+
+class span:
+    """
+    Time a block as a child of the current span (or of an explicit parent) and
+    make it the current span while the block runs.
+
+        with span("POST /connections", "admin"):
+            ...
+    """
+
+    def __init__(self, name, cat, trace_id=None, parent_id=None, row_key=None, **args):
+        # an explicit trace_id continues a span from another process
+        self.remote = trace_id is not None and parent_id is not None
+        parent = current_span.get()
+        if trace_id is None and parent is not None:
+            (trace_id, parent_id) = parent
+        self.name = name
+        self.cat = cat
+        self.trace_id = trace_id or new_trace_id()
+        self.parent_id = parent_id
+        self.span_id = new_span_id()
+        self.row_key = row_key or self.trace_id
+        self.args = args
+
+    def __enter__(self):
+        self.token = current_span.set((self.trace_id, self.span_id))
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.time()
+        current_span.reset(self.token)
+        if writer is None:
+            return False
+        tid = _row(self.row_key)
+        ts = int(self.start * 1_000_000)
+        args = dict(self.args, trace_id=self.trace_id, span_id=self.span_id, parent_id=self.parent_id)
+        if exc_type is not None:
+            args["error"] = repr(exc)
+        writer.write(
+            {
+                "name": self.name,
+                "cat": self.cat,
+                "ph": "X",
+                "ts": ts,
+                "dur": int((end - self.start) * 1_000_000),
+                "pid": writer.pid,
+                "tid": tid,
+                "args": args,
+            }
+        )
+        if self.remote:
+            # ends the flow arrow started by the caller's span in the other process
+            writer.write(
+                {"name": "request", "cat": "flow", "ph": "f", "bp": "e", "id": self.parent_id,
+                 "ts": ts, "pid": writer.pid, "tid": tid}
+            )
+        return False
+
+
+def webhook_span(topic, payload):
+    """
+    A span for handling one webhook, on the viewer row of its protocol thread.
+    """
+    thread_id = None
+    if isinstance(payload, dict):
+        thread_id = payload.get("thread_id") or payload.get("connection_id")
+    return span(f"webhook {topic}", "webhook", row_key=thread_id, thread_id=thread_id)
+
+
+@web.middleware
+async def tracing_middleware(request, handler):
+    """
+    Continue the harness's trace (from its traceparent header) for the backchannel request.
+    """
+    if writer is None:
+        return await handler(request)
+    parent = parse_traceparent(request.headers.get("traceparent"))
+    (trace_id, parent_id) = parent if parent else (None, None)
+    with span(f"{request.method} {request.path}", "backchannel", trace_id=trace_id, parent_id=parent_id):
+        return await handler(request)
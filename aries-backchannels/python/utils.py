@@ -1,70 +1,100 @@
+import atexit
 import functools
+import hashlib
 import json
+import logging
+import logging.handlers
 import os
+import queue
+import random
 import sys
 import io
 import csv
 import platform
+import tempfile
+import threading
 import uuid
 
 from timeit import default_timer
 
-import prompt_toolkit
-from prompt_toolkit.application import run_in_terminal
-from prompt_toolkit.eventloop.defaults import use_asyncio_event_loop
-from prompt_toolkit.patch_stdout import patch_stdout
-from prompt_toolkit.shortcuts import ProgressBar
-
-import pygments
-from pygments.filter import Filter
-from pygments.lexer import Lexer
-from pygments.lexers.data import JsonLdLexer
-from prompt_toolkit.formatted_text import FormattedText, PygmentsTokens
-
-
-COLORIZE = bool(os.getenv("COLORIZE", True))
-
-
-class PrefixFilter(Filter):
-    def __init__(self, **options):
-        Filter.__init__(self, **options)
-        self.prefix = options.get("prefix")
-
-    def lines(self, stream):
-        line = []
-        for ttype, value in stream:
-            if "\n" in value:
-                parts = value.split("\n")
-                value = parts.pop()
-                for part in parts:
-                    line.append((ttype, part))
-                    line.append((ttype, "\n"))
-                    yield line
-                    line = []
-            line.append((ttype, value))
-        if line:
-            yield line
-
-    def filter(self, lexer, stream):
-        if isinstance(self.prefix, str):
-            prefix = ((pygments.token.Generic, self.prefix),)
-        elif self.prefix:
-            prefix = self.prefix
-        else:
-            prefix = ()
-        for line in self.lines(stream):
-            yield from prefix
-            yield from line
+# prompt_toolkit and pygments are only imported once interactive or colorized
+# output is actually requested, so non-interactive backchannels start faster
+
+
+def env_flag(name: str, default: bool = False) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "t", "yes", "y")
+
+
+# colour only makes sense on a terminal, not in docker logs or files
+COLORIZE = env_flag("COLORIZE", sys.stdout.isatty())
+
+# "text" prints each message as it is logged, "json" queues one-line JSON records
+# for a background writer thread, see setup_json_logging
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+LOG_LEVEL = os.getenv("BACKCHANNEL_LOG_LEVEL", "INFO").upper()
+# longest payload written in a JSON record, 0 for no limit
+LOG_MAX_PAYLOAD = int(os.getenv("LOG_MAX_PAYLOAD", 2048))
+# fraction of payload carrying DEBUG records that keep their payload
+LOG_PAYLOAD_SAMPLE = float(os.getenv("LOG_PAYLOAD_SAMPLE", 1.0))
+# most records written (and flushed) in one go by the writer thread
+LOG_BATCH_SIZE = 200
+
+LOGGER = logging.getLogger("backchannel")
+
+
+@functools.lru_cache(maxsize=None)
+def prefix_filter_class():
+    from pygments.filter import Filter
+    from pygments.token import Generic
+
+    class PrefixFilter(Filter):
+        def __init__(self, **options):
+            Filter.__init__(self, **options)
+            self.prefix = options.get("prefix")
+
+        def lines(self, stream):
+            line = []
+            for ttype, value in stream:
+                if "\n" in value:
+                    parts = value.split("\n")
+                    value = parts.pop()
+                    for part in parts:
+                        line.append((ttype, part))
+                        line.append((ttype, "\n"))
+                        yield line
+                        line = []
+                line.append((ttype, value))
+            if line:
+                yield line
+
+        def filter(self, lexer, stream):
+            if isinstance(self.prefix, str):
+                prefix = ((Generic, self.prefix),)
+            elif self.prefix:
+                prefix = self.prefix
+            else:
+                prefix = ()
+            for line in self.lines(stream):
+                yield from prefix
+                yield from line
+
+    return PrefixFilter
 
 
 def print_lexer(
-    body: str, lexer: Lexer, label: str = None, prefix: str = None, indent: int = None
+    body: str, lexer, label: str = None, prefix: str = None, indent: int = None
 ):
     if COLORIZE:
+        import pygments
+        from prompt_toolkit.formatted_text import FormattedText, PygmentsTokens
+
         prefix_str = prefix + " " if prefix else ""
         if prefix_str or indent:
             prefix_body = prefix_str + " " * (indent or 0)
-            lexer.add_filter(PrefixFilter(prefix=prefix_body))
+            lexer.add_filter(prefix_filter_class()(prefix=prefix_body))
         tokens = list(pygments.lex(body, lexer=lexer))
         if label:
             fmt_label = [("fg:ansimagenta", label)]
@@ -81,10 +111,17 @@ def print_json(data, label: str = None, prefix: str = None, indent: int = 2):
         data = json.loads(data)
     data = json.dumps(data, indent=2)
     prefix_str = prefix or ""
-    print_lexer(data, JsonLdLexer(), label=label, prefix=prefix_str, indent=indent)
+    lexer = None
+    if COLORIZE:
+        from pygments.lexers.data import JsonLdLexer
+
+        lexer = JsonLdLexer()
+    print_lexer(data, lexer, label=label, prefix=prefix_str, indent=indent)
 
 
 def print_formatted(*args, **kwargs):
+    import prompt_toolkit
+
     prompt_toolkit.print_formatted_text(*args, **kwargs)
 
 
@@ -100,6 +137,8 @@ def print_ext(
     if indent:
         prefix_str += " " * indent
     if color and COLORIZE:
+        from prompt_toolkit.formatted_text import FormattedText
+
         msg = [(color, " ".join(map(str, msg)))]
         if prefix_str:
             msg.insert(0, ("", prefix_str + " "))
@@ -121,15 +160,170 @@ def output_reader(handle, callback, *args, **kwargs):
     for line in iter(handle.readline, b""):
         if not line:
             break
-        run_in_terminal(functools.partial(callback, line, *args))
+        in_terminal(functools.partial(callback, line, *args))
+
+
+def in_terminal(func):
+    """
+    Run func around the interactive prompt if there is one, directly otherwise.
+    """
+    if hasattr(prompt_init, "_called"):
+        from prompt_toolkit.application import run_in_terminal
+
+        run_in_terminal(func)
+    else:
+        func()
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    One JSON object per line, with the record's payload (if any) serialized
+    and truncated here, in the writer thread.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        line = json.dumps(entry, default=str)
+
+        payload = getattr(record, "payload", None)
+        if payload is None:
+            return line
+        if isinstance(payload, (bytes, bytearray)):
+            payload = payload.decode("utf8", "replace")
+        try:
+            text = payload if isinstance(payload, str) else json.dumps(payload, default=str)
+        except (RuntimeError, TypeError, ValueError):
+            # changed under us by the handler that logged it
+            text = repr(payload)
+        if LOG_MAX_PAYLOAD and len(text) > LOG_MAX_PAYLOAD:
+            extra = {"payload": text[:LOG_MAX_PAYLOAD], "payload_truncated": len(text) - LOG_MAX_PAYLOAD}
+            return line[:-1] + ", " + json.dumps(extra)[1:]
+        if isinstance(payload, str):
+            return line[:-1] + ', "payload": ' + json.dumps(text) + "}"
+        # already valid JSON, splice it in rather than encoding it a second time
+        return line[:-1] + ', "payload": ' + text + "}"
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue the record as is: unlike QueueHandler, leave all formatting to the writer thread.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class LogWriter:
+    """
+    Drains the log queue on a background thread, writing records in batches.
+    """
+
+    def __init__(self, records: queue.Queue, stream, formatter: logging.Formatter):
+        self.records = records
+        self.stream = stream
+        self.formatter = formatter
+        self.thread = threading.Thread(target=self._write_loop, name="log-writer", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.records.put(None)
+        self.thread.join()
+
+    def _write_loop(self):
+        while True:
+            batch = [self.records.get()]
+            while len(batch) < LOG_BATCH_SIZE:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            for record in batch:
+                if record is not None:
+                    try:
+                        lines.append(self.formatter.format(record))
+                    except Exception as e:
+                        lines.append(json.dumps({"level": "ERROR", "msg": f"Unable to format log record: {e}"}))
+            if lines:
+                self.stream.write("\n".join(lines) + "\n")
+                self.stream.flush()
+            if None in batch:
+                break
+
+
+def setup_json_logging(stream=None, level=None):
+    """
+    Send LOGGER records through a queue to a background writer of JSON lines.
+    """
+    if getattr(setup_json_logging, "writer", None):
+        return setup_json_logging.writer
+    records = queue.Queue()
+    LOGGER.addHandler(DeferredQueueHandler(records))
+    LOGGER.setLevel(level or LOG_LEVEL)
+    LOGGER.propagate = False
+    setup_json_logging.writer = LogWriter(records, stream or sys.stdout, JsonLinesFormatter())
+    atexit.register(setup_json_logging.writer.stop)
+    return setup_json_logging.writer
+
+
+def _log_record(level, msg, payload=None):
+    # skips Logger._log's caller lookup, which walks the stack for every record
+    LOGGER.handle(LOGGER.makeRecord(LOGGER.name, level, __name__, 0, msg, None, None, extra={"payload": payload}))
+
+
+def _message_text(msg, label=None, prefix=None):
+    text = " ".join(
+        m.decode("utf8", "replace") if isinstance(m, bytes) else str(m) for m in msg
+    ).rstrip("\n")
+    if label:
+        text = f"{label} {text}"
+    if prefix:
+        text = f"{prefix} {text}"
+    return text
 
 
 def log_msg(*msg, color="fg:ansimagenta", **kwargs):
-    run_in_terminal(lambda: print_ext(*msg, color=color, **kwargs))
+    if LOG_FORMAT == "json":
+        setup_json_logging()
+        if LOGGER.isEnabledFor(logging.INFO):
+            _log_record(logging.INFO, _message_text(msg, kwargs.get("label"), kwargs.get("prefix")))
+        return
+    in_terminal(lambda: print_ext(*msg, color=color, **kwargs))
 
 
 def log_json(data, **kwargs):
-    run_in_terminal(lambda: print_json(data, **kwargs))
+    if LOG_FORMAT == "json":
+        setup_json_logging()
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            payload = data if random.random() < LOG_PAYLOAD_SAMPLE else None
+            _log_record(logging.DEBUG, kwargs.get("label") or "", payload)
+        return
+    in_terminal(lambda: print_json(data, **kwargs))
+
+
+def log_payload(msg: str, payload, **kwargs):
+    """
+    Log a message about a (large) payload, such as a webhook body.
+
+    In JSON mode the message is logged at INFO and the payload only rides along
+    at DEBUG, subject to LOG_PAYLOAD_SAMPLE and LOG_MAX_PAYLOAD; in text mode
+    both are printed, as they always were.
+    """
+    if LOG_FORMAT == "json":
+        setup_json_logging()
+        if LOGGER.isEnabledFor(logging.DEBUG) and random.random() < LOG_PAYLOAD_SAMPLE:
+            _log_record(logging.DEBUG, msg.rstrip(": "), payload)
+        elif LOGGER.isEnabledFor(logging.INFO):
+            _log_record(logging.INFO, msg.rstrip(": "))
+        return
+    log_msg(msg + json.dumps(payload), **kwargs)
 
 
 def log_status(status: str, **kwargs):
@@ -147,11 +341,16 @@ def flatten(args):
 def prompt_init():
     if hasattr(prompt_init, "_called"):
         return
+    from prompt_toolkit.eventloop.defaults import use_asyncio_event_loop
+
     prompt_init._called = True
     use_asyncio_event_loop()
 
 
 async def prompt(*args, **kwargs):
+    import prompt_toolkit
+    from prompt_toolkit.patch_stdout import patch_stdout
+
     prompt_init()
     with patch_stdout():
         try:
@@ -239,6 +438,8 @@ def log_timer(label: str, show: bool = True, logger=None, **kwargs):
 
 
 def progress(*args, **kwargs):
+    from prompt_toolkit.shortcuts import ProgressBar
+
     return ProgressBar(*args, **kwargs)
 
 
@@ -293,6 +494,96 @@ def read_operations(str_data=None, file_name=None, parser=None):
     return operations
 
 
+def compile_operations(operations):
+    """
+    Build a lookup table for find_operation() from the rows returned by read_operations().
+
+    Every (topic, method, operation, has-id, has-data) key a request can produce is
+    mapped to the first row that would match it in a linear scan, so lookups keep
+    the table's precedence. Keys with no matching row are simply absent.
+    """
+    index = {}
+    for op in operations:
+        for operation in (None, op["operation"]):
+            for has_id in (None, True) if op["id"] == "Y" else (None,):
+                for has_data in (None, True) if op["data"] == "Y" else (None,):
+                    key = (op["topic"], op["method"], operation, has_id, has_data)
+                    index.setdefault(key, op)
+    return index
+
+
+def load_operations(file_name, cache_file=None):
+    """
+    read_operations() and compile_operations() for file_name, reusing a cached copy
+    of both for as long as the file's content hash is unchanged.
+    """
+    with open(file_name, "rb") as in_file:
+        raw_data = in_file.read()
+    digest = hashlib.sha256(raw_data).hexdigest()
+    if not cache_file:
+        cache_file = os.getenv("OPERATIONS_CACHE") or os.path.join(
+            tempfile.gettempdir(),
+            "aath-operations-"
+            + hashlib.sha256(os.path.abspath(file_name).encode("utf8")).hexdigest()[:16]
+            + ".json",
+        )
+
+    try:
+        with open(cache_file, "r") as in_file:
+            cached = json.load(in_file)
+        if cached["digest"] == digest:
+            operations = cached["operations"]
+            index = {tuple(entry[:-1]): operations[entry[-1]] for entry in cached["index"]}
+            return (operations, index)
+    except (OSError, ValueError, KeyError, IndexError, TypeError):
+        pass
+
+    operations = read_operations(str_data=raw_data.decode("utf8"))
+    index = compile_operations(operations)
+    rows = {id(op): i for i, op in enumerate(operations)}
+    try:
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as out_file:
+            json.dump(
+                {
+                    "digest": digest,
+                    "operations": operations,
+                    "index": [list(key) + [rows[id(op)]] for key, op in index.items()],
+                },
+                out_file,
+            )
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        # the cache is only an optimisation
+        pass
+    return (operations, index)
+
+
+def operation_key(topic, method, operation=None, rec_id=None, data=None):
+    """
+    The compile_operations() key for a request, or None if no row can match it.
+    """
+    # an id, data or operation that is present but empty never matches a row
+    if (rec_id is not None and not rec_id) or (data is not None and not data):
+        return None
+    if operation is not None and not operation:
+        return None
+    return (
+        topic,
+        method,
+        operation,
+        True if rec_id is not None else None,
+        True if data is not None else None,
+    )
+
+
+def find_operation(index, topic, method, operation=None, rec_id=None, data=None):
+    key = operation_key(topic, method, operation, rec_id, data)
+    if key is None:
+        return None
+    return index.get(key)
+
+
 EXTENSION = {"darwin": ".dylib", "linux": ".so", "win32": ".dll", 'windows': '.dll'}
 
 
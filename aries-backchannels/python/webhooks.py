@@ -0,0 +1,78 @@
+import asyncio
+import json
+import traceback
+from collections import deque
+from timeit import default_timer
+
+from python.metrics import observe_webhook, record_webhook
+from python.tracing import webhook_span
+
+
+def webhook_key(topic, payload):
+    """
+    The protocol thread a webhook belongs to; webhooks with the same key are handled in order.
+    """
+    if isinstance(payload, dict):
+        for field in ("thread_id", "connection_id", "cred_def_id", "invitation_id"):
+            if payload.get(field):
+                return payload[field]
+    return topic
+
+
+class WebhookDispatcher:
+    """
+    Take webhooks off the agent's delivery path: the webhook endpoint only queues
+    the raw body, and a dispatcher task parses it and hands it to the handler.
+
+    Webhooks for the same protocol thread are handled one at a time in arrival
+    order, different threads are handled concurrently.
+    """
+
+    def __init__(self, handle):
+        # async handle(topic, payload)
+        self.handle = handle
+        self.queue = asyncio.Queue()
+        self.lanes = {}
+        self.task = asyncio.ensure_future(self._dispatch())
+
+    def submit(self, topic: str, body: bytes):
+        record_webhook(topic)
+        self.queue.put_nowait((topic, body, default_timer()))
+
+    async def close(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+    async def _dispatch(self):
+        while True:
+            (topic, body, received) = await self.queue.get()
+            try:
+                payload = json.loads(body)
+            except ValueError as e:
+                print("Error parsing webhook on topic", topic, ":", e)
+                observe_webhook(topic, received, default_timer())
+                continue
+
+            key = webhook_key(topic, payload)
+            lane = self.lanes.get(key)
+            if lane is None:
+                lane = self.lanes[key] = deque()
+                asyncio.ensure_future(self._drain(key, lane))
+            lane.append((topic, payload, received))
+
+    async def _drain(self, key, lane):
+        while lane:
+            (topic, payload, received) = lane.popleft()
+            started = default_timer()
+            try:
+                with webhook_span(topic, payload):
+                    await self.handle(topic, payload)
+            except Exception as e:
+                print("Error handling webhook on topic", topic, ":", e)
+                traceback.print_exc()
+            observe_webhook(topic, received, started)
+        # nothing can be queued between the empty check and here, there is no await in between
+        del self.lanes[key]
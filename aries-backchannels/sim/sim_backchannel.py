@@ -0,0 +1,842 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+import traceback
+import uuid
+from urllib.parse import urlsplit
+
+from python.agent_backchannel import AgentBackchannel
+from python.utils import log_msg, prompt_loop
+from python.storage import close_storage, store_resource, get_resource, get_resources, delete_resource
+
+LOGGER = logging.getLogger(__name__)
+
+AGENT_NAME = os.getenv("AGENT_NAME", "Agent")
+
+BASE58 = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+
+
+def _parse_latency(latency_txt):
+    # "0.01,issue-credential=0.2,proof=0.05": a default and per-topic seconds per transition
+    latency = {"default": 0.0}
+    for item in (latency_txt or "").split(","):
+        if "=" in item:
+            topic, seconds = item.split("=", 1)
+            latency[topic.strip()] = float(seconds)
+        elif item.strip():
+            latency["default"] = float(item)
+    return latency
+
+
+# seconds each state transition takes, by protocol topic, see _parse_latency
+SIM_LATENCY = _parse_latency(os.getenv("SIM_LATENCY", "0"))
+
+# the simulated ledger, shared by all agents in this process
+ledger = {"schemas": {}, "cred_defs": {}, "rev_regs": {}, "seq_no": 0}
+
+# agents in this process, by ident, so they can deliver messages to each other
+sim_agents = {}
+
+
+def random_did():
+    return "".join(random.choice(BASE58) for _ in range(22))
+
+
+def find_values(data, key):
+    """
+    All values of key anywhere in a JSON structure.
+    """
+    found = []
+    if isinstance(data, dict):
+        for (k, v) in data.items():
+            if k == key:
+                found.append(v)
+            else:
+                found.extend(find_values(v, key))
+    elif isinstance(data, list):
+        for item in data:
+            found.extend(find_values(item, key))
+    return found
+
+
+def credential_terms(data):
+    """
+    The attributes, cred def and schema of a v1 or v2 credential proposal or offer.
+    """
+    data = data or {}
+    preview = data.get("credential_preview") or data.get("credential_proposal") or {}
+    filters = data.get("filter") or {}
+    indy = filters.get("indy") or data
+    return {
+        "format": "json-ld" if "json-ld" in filters else "indy",
+        "attributes": preview.get("attributes", []),
+        "cred_def_id": indy.get("cred_def_id"),
+        "schema_id": indy.get("schema_id"),
+    }
+
+
+class SimAgentBackchannel(AgentBackchannel):
+    """
+    An in-process agent that runs the protocol state machines itself instead of
+    driving a real agent: connections (0160), DID exchange (0023) with out-of-band
+    invitations, issue credential v1 and v2, present proof v1 and v2 and revocation.
+
+    Agents started in the same process talk to each other directly, every state
+    transition takes the SIM_LATENCY of its topic. Exchange records are kept in
+    python/storage.py, so the harness, the routing layer and the storage can be
+    measured without any agent, ledger or network in the way.
+    """
+
+    def __init__(self, ident: str, backchannel_port: int, params: dict = {}):
+        super().__init__(ident, backchannel_port + 1, backchannel_port + 2, params=params)
+        self.backchannel_port = backchannel_port
+        self.did = random_did()
+        self.verkey = random_did() + random_did()
+        sim_agents[ident] = self
+
+    ######################################################################
+    # records, messages and transitions
+    ######################################################################
+
+    def record_type(self, kind):
+        # one storage namespace per agent, they all share the process's storage
+        return self.ident + "/" + kind
+
+    def load(self, kind, rec_id):
+        return get_resource(rec_id, self.record_type(kind)) if rec_id else None
+
+    def save(self, kind, rec_id, record, topic=None):
+        store_resource(rec_id, self.record_type(kind), record)
+        if "state" in record:
+            self.publish_event(topic or kind, record, record_id=rec_id, thread_id=record.get("thread_id"))
+        return record
+
+    def find_by_connection(self, kind, connection_id, state):
+        for record in reversed(list(get_resources(self.record_type(kind)).values())):
+            if record.get("connection_id") == connection_id and record.get("state") == state:
+                return record
+        return None
+
+    async def delay(self, topic):
+        latency = SIM_LATENCY.get(topic, SIM_LATENCY["default"])
+        if latency > 0:
+            await asyncio.sleep(latency)
+
+    def send(self, peer_ident, handler, topic, message):
+        """
+        Deliver a message to handler of the agent peer_ident, after the topic's latency.
+        """
+        peer = sim_agents.get(peer_ident)
+        if peer is None:
+            log_msg(f"{self.ident}: no simulated agent {peer_ident} to deliver {handler} to")
+            return
+        asyncio.ensure_future(peer.receive(handler, topic, message))
+
+    async def receive(self, handler, topic, message):
+        await self.delay(topic)
+        try:
+            await getattr(self, handler)(topic, message)
+        except Exception:
+            traceback.print_exc()
+
+    def send_over_connection(self, connection_id, handler, topic, message):
+        connection = self.load("connection", connection_id)
+        if connection is None or not connection.get("their_connection_id"):
+            return False
+        message["connection_id"] = connection["their_connection_id"]
+        self.send(connection["their_label"], handler, topic, message)
+        return True
+
+    ######################################################################
+    # backchannel operations
+    ######################################################################
+
+    async def make_agent_POST_request(
+        self, op, rec_id=None, data=None, text=False, params=None
+    ) -> (int, str):
+        topic = op["topic"]
+        operation = op["operation"]
+        await self.delay(topic)
+
+        if topic == "connection":
+            return await self.connection_POST(operation, rec_id, data)
+        elif topic == "out-of-band":
+            return await self.out_of_band_POST(operation, rec_id, data)
+        elif topic == "did-exchange":
+            return await self.did_exchange_POST(operation, rec_id, data)
+        elif topic == "schema":
+            return self.create_schema(data)
+        elif topic == "credential-definition":
+            return self.create_credential_definition(data)
+        elif topic in ("issue-credential", "issue-credential-v2"):
+            return await self.issue_credential_POST(topic, operation, rec_id, data)
+        elif topic in ("proof", "proof-v2"):
+            return await self.proof_POST(topic, operation, rec_id, data)
+        elif topic == "revocation" and operation == "revoke":
+            return self.revoke_credential(data)
+
+        return (501, "501: Not Implemented\n\n")
+
+    async def make_agent_GET_request(
+        self, op, rec_id=None, text=False, params=None
+    ) -> (int, str):
+        topic = op["topic"]
+
+        if topic == "status":
+            return (200, json.dumps({"status": "active" if self.ACTIVE else "inactive"}))
+        elif topic == "version":
+            return (200, "1.0.0-sim")
+        elif topic == "did":
+            return (200, json.dumps({"did": self.did, "verkey": self.verkey}))
+        elif topic == "schema":
+            return self.ledger_GET("schemas", rec_id)
+        elif topic == "credential-definition":
+            return self.ledger_GET("cred_defs", rec_id)
+        elif topic == "credential":
+            credential = self.load("credential", rec_id)
+            if credential is None:
+                return (404, f"404 credential {rec_id} not found")
+            if op["operation"] == "revoked":
+                return (200, json.dumps({"revoked": self.is_revoked(credential, time.time())}))
+            return (200, json.dumps(credential))
+        elif topic in ("connection", "did-exchange"):
+            kind = "connection"
+        elif topic in ("issue-credential", "issue-credential-v2", "proof", "proof-v2"):
+            kind = topic
+        else:
+            return (501, "501: Not Implemented\n\n")
+
+        if rec_id is None:
+            return (200, json.dumps(list(get_resources(self.record_type(kind)).values())))
+        record = self.load(kind, rec_id)
+        if record is None:
+            return (404, f"404 {topic} {rec_id} not found")
+        return (200, json.dumps(record))
+
+    async def make_agent_DELETE_request(
+        self, op, rec_id=None, data=None, text=False, params=None
+    ) -> (int, str):
+        if op["topic"] == "credential" and rec_id:
+            if delete_resource(rec_id, self.record_type("credential")) is None:
+                return (404, f"404 credential {rec_id} not found")
+            return (200, json.dumps({}))
+        return (501, "501: Not Implemented\n\n")
+
+    async def make_agent_GET_request_response(
+        self, topic, rec_id=None, text=False, params=None
+    ) -> (int, str):
+        if topic == "did-exchange":
+            # the connection created for an out-of-band invitation or public DID request
+            invitation = self.load("invitation", rec_id)
+            return (200, json.dumps({"connection_id": invitation["connection_id"]} if invitation else {}))
+        elif topic == "revocation-registry":
+            for kind in ("issue-credential", "issue-credential-v2"):
+                record = self.load(kind, rec_id)
+                if record and record.get("revocation_id"):
+                    return (200, json.dumps(
+                        {"revocation_id": record["revocation_id"], "revoc_reg_id": record["revoc_reg_id"]}
+                    ))
+            return (404, f"404 no revocation registry entry for {rec_id}")
+        return (501, "501: Not Implemented\n\n")
+
+    ######################################################################
+    # 0160 connection protocol
+    ######################################################################
+
+    async def connection_POST(self, operation, rec_id, data):
+        if operation == "create-invitation":
+            connection_id = str(uuid.uuid4())
+            invitation = {
+                "@type": "https://didcomm.org/connections/1.0/invitation",
+                "@id": str(uuid.uuid4()),
+                "label": self.ident,
+                "recipientKeys": [connection_id],
+                "serviceEndpoint": self.endpoint,
+            }
+            store_resource(invitation["@id"], self.record_type("invitation"), {"connection_id": connection_id})
+            record = self.save("connection", connection_id, {
+                "connection_id": connection_id, "state": "invited", "their_role": "invitee",
+                "invitation_id": invitation["@id"],
+            })
+            return (200, json.dumps(dict(record, invitation=invitation)))
+
+        elif operation == "receive-invitation":
+            connection_id = str(uuid.uuid4())
+            record = self.save("connection", connection_id, {
+                "connection_id": connection_id, "state": "invited", "their_role": "inviter",
+                "their_label": data["label"], "invitation_id": data["@id"],
+            })
+            return (200, json.dumps(record))
+
+        connection = self.load("connection", rec_id)
+        if connection is None:
+            return (404, f"404 connection {rec_id} not found")
+
+        if operation == "accept-invitation":
+            if connection["state"] != "invited" or connection["their_role"] != "inviter":
+                return (400, f"connection {rec_id} is {connection['state']}, can't accept an invitation")
+            connection = self.save("connection", rec_id, dict(connection, state="requested"))
+            self.send(connection["their_label"], "receive_connection_request", "connection", {
+                "invitation_id": connection["invitation_id"], "label": self.ident, "their_connection_id": rec_id,
+            })
+        elif operation == "accept-request":
+            if connection["state"] != "requested":
+                return (406, f"connection {rec_id} is {connection['state']}, no request to accept")
+            connection = self.save("connection", rec_id, dict(connection, state="responded"))
+            self.send_over_connection(rec_id, "receive_connection_response", "connection", {"their_connection_id": rec_id})
+        elif operation == "send-ping":
+            if connection["state"] in ("responded", "complete"):
+                connection = self.save("connection", rec_id, dict(connection, state="complete"))
+                self.send_over_connection(rec_id, "receive_trust_ping", "connection", {})
+        else:
+            return (501, "501: Not Implemented\n\n")
+        return (200, json.dumps(connection))
+
+    async def receive_connection_request(self, topic, message):
+        invitation = self.load("invitation", message["invitation_id"])
+        connection = self.load("connection", invitation["connection_id"]) if invitation else None
+        if connection is None or connection["state"] != "invited":
+            log_msg(f"{self.ident}: connection request for an unknown or used invitation")
+            return
+        self.save("connection", connection["connection_id"], dict(
+            connection, state="requested", their_label=message["label"],
+            their_connection_id=message["their_connection_id"],
+        ))
+
+    async def receive_connection_response(self, topic, message):
+        connection = self.load("connection", message["connection_id"])
+        if connection and connection["state"] == "requested":
+            self.save("connection", connection["connection_id"], dict(
+                connection, state="responded", their_connection_id=message["their_connection_id"]
+            ))
+
+    async def receive_trust_ping(self, topic, message):
+        connection = self.load("connection", message["connection_id"])
+        if connection and connection["state"] == "responded":
+            self.save("connection", connection["connection_id"], dict(connection, state="complete"))
+
+    ######################################################################
+    # 0434 out of band and 0023 DID exchange
+    ######################################################################
+
+    async def out_of_band_POST(self, operation, rec_id, data):
+        if operation == "send-invitation-message":
+            connection_id = str(uuid.uuid4())
+            invitation_id = str(uuid.uuid4())
+            if data and data.get("use_public_did"):
+                services = ["did:sov:" + self.did]
+            else:
+                services = [{
+                    "id": "#inline", "type": "did-communication",
+                    "recipientKeys": [connection_id], "serviceEndpoint": self.endpoint,
+                }]
+            invitation = {
+                "@type": "https://didcomm.org/out-of-band/1.0/invitation",
+                "@id": invitation_id,
+                "label": self.ident,
+                "handshake_protocols": ["https://didcomm.org/didexchange/1.0"],
+                "services": services,
+            }
+            store_resource(invitation_id, self.record_type("invitation"), {"connection_id": connection_id})
+            record = self.save("connection", connection_id, {
+                "connection_id": connection_id, "state": "invitation-sent", "their_role": "requester",
+                "invitation_id": invitation_id,
+            }, topic="did-exchange")
+            return (200, json.dumps(dict(record, invitation=invitation)))
+
+        elif operation == "receive-invitation":
+            connection_id = str(uuid.uuid4())
+            record = self.save("connection", connection_id, {
+                "connection_id": connection_id, "state": "invitation-received", "their_role": "responder",
+                "their_label": data["label"], "invitation_id": data["@id"],
+            }, topic="did-exchange")
+            return (200, json.dumps(record))
+
+        return (501, "501: Not Implemented\n\n")
+
+    async def did_exchange_POST(self, operation, rec_id, data):
+        if operation == "create-request-resolvable-did":
+            responder = next((a for a in sim_agents.values() if a.did == data["their_public_did"]), None)
+            if responder is None:
+                return (400, f"can't resolve {data['their_public_did']}")
+            connection_id = str(uuid.uuid4())
+            request_id = str(uuid.uuid4())
+            store_resource(request_id, self.record_type("invitation"), {"connection_id": connection_id})
+            self.save("connection", connection_id, {
+                "connection_id": connection_id, "state": "request-sent", "their_role": "responder",
+                "their_label": responder.ident, "request_id": request_id,
+            }, topic="did-exchange")
+            return (200, json.dumps({
+                "@type": "https://didcomm.org/didexchange/1.0/request",
+                "@id": request_id,
+                "~thread": {"thid": request_id},
+                "label": self.ident,
+                "did": self.did,
+            }))
+
+        elif operation == "receive-request-resolvable-did":
+            requester = sim_agents.get(data["label"])
+            request = requester.load("invitation", data["@id"]) if requester else None
+            if request is None:
+                return (400, f"unknown DID exchange request {data['@id']}")
+            connection_id = str(uuid.uuid4())
+            record = self.save("connection", connection_id, {
+                "connection_id": connection_id, "state": "request-received", "their_role": "requester",
+                "their_label": data["label"], "their_connection_id": request["connection_id"],
+            }, topic="did-exchange")
+            requester_connection = requester.load("connection", request["connection_id"])
+            requester.save("connection", request["connection_id"], dict(
+                requester_connection, their_connection_id=connection_id
+            ), topic="did-exchange")
+            return (200, json.dumps(record))
+
+        connection = self.load("connection", rec_id)
+        if connection is None:
+            return (404, f"404 connection {rec_id} not found")
+
+        if operation == "send-request":
+            if connection["state"] != "invitation-received":
+                return (400, f"connection {rec_id} is {connection['state']}, can't send a request")
+            connection = self.save("connection", rec_id, dict(connection, state="request-sent"), topic="did-exchange")
+            self.send(connection["their_label"], "receive_did_exchange_request", "did-exchange", {
+                "invitation_id": connection["invitation_id"], "label": self.ident, "their_connection_id": rec_id,
+            })
+        elif operation == "send-response":
+            if connection["state"] != "request-received":
+                return (400, f"connection {rec_id} is {connection['state']}, can't send a response")
+            connection = self.save("connection", rec_id, dict(connection, state="response-sent"), topic="did-exchange")
+            self.send_over_connection(rec_id, "receive_did_exchange_response", "did-exchange", {"their_connection_id": rec_id})
+        else:
+            return (501, "501: Not Implemented\n\n")
+        return (200, json.dumps(connection))
+
+    async def receive_did_exchange_request(self, topic, message):
+        invitation = self.load("invitation", message["invitation_id"])
+        connection = self.load("connection", invitation["connection_id"]) if invitation else None
+        if connection is None:
+            log_msg(f"{self.ident}: DID exchange request for an unknown invitation")
+            return
+        if connection["state"] != "invitation-sent":
+            # a public or reused invitation, every request gets its own connection
+            connection = {"connection_id": str(uuid.uuid4()), "their_role": "requester",
+                          "invitation_id": message["invitation_id"]}
+        self.save("connection", connection["connection_id"], dict(
+            connection, state="request-received", their_label=message["label"],
+            their_connection_id=message["their_connection_id"],
+        ), topic="did-exchange")
+
+    async def receive_did_exchange_response(self, topic, message):
+        connection = self.load("connection", message["connection_id"])
+        if connection and connection["state"] == "request-sent":
+            self.save("connection", connection["connection_id"], dict(
+                connection, state="completed", their_connection_id=message["their_connection_id"]
+            ), topic="did-exchange")
+            self.send_over_connection(connection["connection_id"], "receive_did_exchange_complete", "did-exchange", {})
+
+    async def receive_did_exchange_complete(self, topic, message):
+        connection = self.load("connection", message["connection_id"])
+        if connection and connection["state"] == "response-sent":
+            self.save("connection", connection["connection_id"], dict(connection, state="completed"), topic="did-exchange")
+
+    ######################################################################
+    # ledger
+    ######################################################################
+
+    def ledger_GET(self, table, rec_id):
+        if rec_id is None:
+            return (200, json.dumps(list(ledger[table])))
+        entry = ledger[table].get(rec_id)
+        if entry is None:
+            return (404, f"404 {rec_id} not found")
+        return (200, json.dumps(entry))
+
+    def create_schema(self, data):
+        schema_id = f"{self.did}:2:{data['schema_name']}:{data['schema_version']}"
+        if schema_id not in ledger["schemas"]:
+            ledger["seq_no"] += 1
+            ledger["schemas"][schema_id] = {
+                "ver": "1.0", "id": schema_id, "name": data["schema_name"], "version": data["schema_version"],
+                "attrNames": data["attributes"], "seqNo": ledger["seq_no"],
+            }
+        return (200, json.dumps({"schema_id": schema_id, "schema": ledger["schemas"][schema_id]}))
+
+    def create_credential_definition(self, data):
+        schema = ledger["schemas"].get(data["schema_id"])
+        if schema is None:
+            return (400, f"schema {data['schema_id']} not found")
+        cred_def_id = f"{self.did}:3:CL:{schema['seqNo']}:{data.get('tag', 'default')}"
+        if cred_def_id not in ledger["cred_defs"]:
+            cred_def = {"ver": "1.0", "id": cred_def_id, "schemaId": str(schema["seqNo"]), "type": "CL",
+                        "tag": data.get("tag", "default"), "value": {}}
+            if data.get("support_revocation"):
+                cred_def["rev_reg_id"] = f"{self.did}:4:{cred_def_id}:CL_ACCUM:{uuid.uuid4()}"
+                ledger["rev_regs"][cred_def["rev_reg_id"]] = {"next": 1, "revoked": {}}
+            ledger["cred_defs"][cred_def_id] = cred_def
+        return (200, json.dumps({"credential_definition_id": cred_def_id}))
+
+    def revoke_credential(self, data):
+        rev_reg = ledger["rev_regs"].get(data["rev_registry_id"])
+        if rev_reg is None:
+            return (404, f"404 revocation registry {data['rev_registry_id']} not found")
+        rev_reg["revoked"].setdefault(str(data["cred_rev_id"]), time.time())
+        return (200, json.dumps({}))
+
+    def is_revoked(self, credential, at):
+        rev_reg = ledger["rev_regs"].get(credential.get("rev_reg_id"))
+        if rev_reg is None:
+            return False
+        revoked_at = rev_reg["revoked"].get(str(credential.get("cred_rev_id")))
+        return revoked_at is not None and revoked_at <= at
+
+    ######################################################################
+    # 0036 issue credential and 0453 issue credential v2
+    ######################################################################
+
+    def new_exchange(self, topic, connection_id, state, thread_id=None, **fields):
+        thread_id = thread_id or str(uuid.uuid4())
+        record = dict(
+            fields, thread_id=thread_id, connection_id=connection_id, state=state,
+            credential_exchange_id=str(uuid.uuid4()),
+        )
+        return self.save(topic, thread_id, record)
+
+    async def issue_credential_POST(self, topic, operation, rec_id, data):
+        if operation == "prepare-json-ld":
+            return (200, json.dumps({"did": "did:key:z6Mk" + random_did() + random_did()}))
+
+        if operation in ("send-proposal", "send") or (operation == "send-offer" and rec_id is None):
+            terms = credential_terms(data)
+            connection_id = data["connection_id"]
+            if operation == "send-proposal":
+                record = self.new_exchange(topic, connection_id, "proposal-sent", role="holder", **terms)
+                handler = "receive_credential_proposal"
+            else:
+                record = self.new_exchange(topic, connection_id, "offer-sent", role="issuer",
+                                           auto=operation == "send", **terms)
+                handler = "receive_credential_offer"
+            if not self.send_over_connection(connection_id, handler, topic, dict(record)):
+                return (404, f"404 connection {connection_id} not found")
+            return (200, json.dumps(record))
+
+        record = self.load(topic, rec_id)
+        if record is None and operation == "send-request":
+            # the holder may refer to the offer by its connection
+            record = self.find_by_connection(topic, rec_id, "offer-received")
+        if record is None:
+            return (404, f"404 {topic} {rec_id} not found")
+
+        if operation == "send-offer":
+            if record["state"] != "proposal-received":
+                return (400, f"credential exchange {rec_id} is {record['state']}, can't send an offer")
+            record = self.send_credential_offer(topic, record, data)
+        elif operation == "send-request":
+            if record["state"] != "offer-received":
+                return (400, f"credential exchange {rec_id} is {record['state']}, can't send a request")
+            record = self.send_credential_request(topic, record)
+        elif operation == "issue":
+            if record["state"] != "request-received":
+                return (400, f"credential exchange {rec_id} is {record['state']}, can't issue")
+            record = self.issue_credential(topic, record, data)
+        elif operation == "store":
+            if record["state"] != "credential-received":
+                return (400, f"credential exchange {rec_id} is {record['state']}, can't store")
+            record = self.store_credential(topic, record)
+        else:
+            return (501, "501: Not Implemented\n\n")
+        return (200, json.dumps(record))
+
+    def send_credential_offer(self, topic, record, data):
+        terms = credential_terms(data) if data else {}
+        record = self.save(topic, record["thread_id"], dict(
+            record, state="offer-sent", role="issuer", **{k: v for (k, v) in terms.items() if v}
+        ))
+        self.send_over_connection(record["connection_id"], "receive_credential_offer", topic, dict(record))
+        return record
+
+    def send_credential_request(self, topic, record):
+        record = self.save(topic, record["thread_id"], dict(record, state="request-sent"))
+        self.send_over_connection(record["connection_id"], "receive_credential_request", topic,
+                                  {"thread_id": record["thread_id"]})
+        return record
+
+    def issue_credential(self, topic, record, data):
+        record = dict(record, state="credential-issued")
+        if data and credential_terms(data)["attributes"]:
+            record["attributes"] = credential_terms(data)["attributes"]
+        cred_def = ledger["cred_defs"].get(record.get("cred_def_id")) or {}
+        rev_reg = ledger["rev_regs"].get(cred_def.get("rev_reg_id"))
+        if rev_reg is not None:
+            record["revocation_id"] = str(rev_reg["next"])
+            record["revoc_reg_id"] = cred_def["rev_reg_id"]
+            rev_reg["next"] += 1
+        record = self.save(topic, record["thread_id"], record)
+        self.send_over_connection(record["connection_id"], "receive_credential", topic, {
+            "thread_id": record["thread_id"],
+            "credential": {
+                "format": record.get("format", "indy"),
+                "schema_id": record.get("schema_id"),
+                "cred_def_id": record.get("cred_def_id"),
+                "rev_reg_id": record.get("revoc_reg_id"),
+                "cred_rev_id": record.get("revocation_id"),
+                "attrs": {a["name"]: a["value"] for a in record.get("attributes", [])},
+            },
+        })
+        return record
+
+    def store_credential(self, topic, record):
+        credential_id = str(uuid.uuid4())
+        credential = dict(record["credential"], referent=credential_id, credential_id=credential_id)
+        self.save("credential", credential_id, credential)
+        record = self.save(topic, record["thread_id"], dict(
+            record, state="done", credential_id=credential_id,
+            cred_ex_record={"state": "done", "cred_id_stored": credential_id},
+        ))
+        self.send_over_connection(record["connection_id"], "receive_credential_ack", topic,
+                                  {"thread_id": record["thread_id"]})
+        return record
+
+    async def receive_credential_proposal(self, topic, message):
+        self.new_exchange(
+            topic, message["connection_id"], "proposal-received", thread_id=message["thread_id"], role="issuer",
+            **{k: message[k] for k in ("format", "attributes", "cred_def_id", "schema_id")},
+        )
+
+    async def receive_credential_offer(self, topic, message):
+        record = self.load(topic, message["thread_id"])
+        fields = {k: message[k] for k in ("format", "attributes", "cred_def_id", "schema_id")}
+        if record is None:
+            record = self.new_exchange(topic, message["connection_id"], "offer-received",
+                                       thread_id=message["thread_id"], role="holder", **fields)
+        else:
+            record = self.save(topic, record["thread_id"], dict(record, state="offer-received", **fields))
+        if message.get("auto"):
+            self.send_credential_request(topic, dict(record, auto=True))
+
+    async def receive_credential_request(self, topic, message):
+        record = self.load(topic, message["thread_id"])
+        if record and record["state"] == "offer-sent":
+            record = self.save(topic, record["thread_id"], dict(record, state="request-received"))
+            if record.get("auto"):
+                self.issue_credential(topic, record, None)
+
+    async def receive_credential(self, topic, message):
+        record = self.load(topic, message["thread_id"])
+        if record and record["state"] == "request-sent":
+            record = self.save(topic, record["thread_id"], dict(
+                record, state="credential-received", credential=message["credential"]
+            ))
+            if record.get("auto"):
+                self.store_credential(topic, record)
+
+    async def receive_credential_ack(self, topic, message):
+        record = self.load(topic, message["thread_id"])
+        if record and record["state"] == "credential-issued":
+            self.save(topic, record["thread_id"], dict(record, state="done"))
+
+    ######################################################################
+    # 0037 present proof and 0454 present proof v2
+    ######################################################################
+
+    async def proof_POST(self, topic, operation, rec_id, data):
+        data = data or {}
+        request = data.get("presentation_proposal") or {}
+        connection_id = data.get("connection_id") or request.get("connection_id")
+
+        if operation == "send-proposal":
+            record = self.new_exchange(topic, connection_id, "proposal-sent", role="prover", proposal=request)
+            self.send_over_connection(connection_id, "receive_presentation_proposal", topic, dict(record))
+            return (200, json.dumps(record))
+
+        if operation in ("send-request", "create-send-connectionless-request"):
+            if rec_id is None:
+                record = self.new_exchange(topic, connection_id, "request-sent", role="verifier",
+                                           presentation_exchange_id=str(uuid.uuid4()), request=request)
+            else:
+                record = self.load(topic, rec_id)
+                if record is None:
+                    return (404, f"404 {topic} {rec_id} not found")
+                if record["state"] != "proposal-received":
+                    return (400, f"presentation exchange {rec_id} is {record['state']}, can't send a request")
+                record = self.save(topic, rec_id, dict(record, state="request-sent", request=request))
+            if operation == "send-request":
+                self.send_over_connection(record["connection_id"], "receive_presentation_request", topic, dict(record))
+            # a connectionless request is handed to the prover by the harness
+            return (200, json.dumps(record))
+
+        record = self.load(topic, rec_id)
+        if operation == "send-presentation":
+            service = data.get("~service")
+            if record is None and service:
+                record = self.new_exchange(topic, None, "request-received", thread_id=rec_id, role="prover")
+            if record is None:
+                return (404, f"404 {topic} {rec_id} not found")
+            if record["state"] != "request-received":
+                return (400, f"presentation exchange {rec_id} is {record['state']}, can't send a presentation")
+            credentials = []
+            for cred_id in find_values(data, "cred_id"):
+                credential = self.load("credential", cred_id)
+                if credential is None:
+                    return (400, f"credential {cred_id} not found")
+                credentials.append(credential)
+            record = dict(record, state="presentation-sent")
+            message = {"thread_id": rec_id, "presentation": data, "credentials": credentials}
+            if service:
+                verifier = self.agent_at(service["serviceEndpoint"])
+                if verifier is None:
+                    return (400, f"no simulated agent at {service['serviceEndpoint']}")
+                record["their_label"] = verifier.ident
+                self.send(verifier.ident, "receive_presentation", topic, dict(message, their_label=self.ident))
+            else:
+                self.send_over_connection(record["connection_id"], "receive_presentation", topic, message)
+            record = self.save(topic, rec_id, record)
+            return (200, json.dumps(record))
+
+        if record is None:
+            return (404, f"404 {topic} {rec_id} not found")
+        if operation == "verify-presentation":
+            if record["state"] != "presentation-received":
+                return (400, f"presentation exchange {rec_id} is {record['state']}, can't verify")
+            verified = self.verify_presentation(record)
+            record = self.save(topic, rec_id, dict(record, state="done", verified="true" if verified else "false"))
+            ack = {"thread_id": rec_id}
+            if record.get("connection_id"):
+                self.send_over_connection(record["connection_id"], "receive_presentation_ack", topic, ack)
+            elif record.get("their_label"):
+                self.send(record["their_label"], "receive_presentation_ack", topic, ack)
+            return (200, json.dumps(record))
+
+        return (501, "501: Not Implemented\n\n")
+
+    def agent_at(self, url):
+        # the harness gives the verifier's backchannel URL as the connectionless service endpoint
+        port = urlsplit(url).port
+        return next((a for a in sim_agents.values() if a.backchannel_port == port), None)
+
+    def verify_presentation(self, record):
+        """
+        A presentation fails if a credential in it was revoked by the end of the
+        requested non-revocation interval, or is unknown to the ledger.
+        """
+        intervals = find_values(record.get("request"), "non_revoked")
+        for credential in record.get("credentials", []):
+            if credential.get("format", "indy") == "indy" and credential.get("cred_def_id") not in ledger["cred_defs"]:
+                return False
+            for interval in intervals:
+                at = (interval or {}).get("to") or time.time()
+                if self.is_revoked(credential, float(at)):
+                    return False
+        return True
+
+    async def receive_presentation_proposal(self, topic, message):
+        self.new_exchange(topic, message["connection_id"], "proposal-received", thread_id=message["thread_id"],
+                          role="verifier", presentation_exchange_id=str(uuid.uuid4()), proposal=message["proposal"])
+
+    async def receive_presentation_request(self, topic, message):
+        record = self.load(topic, message["thread_id"])
+        if record is None:
+            self.new_exchange(topic, message["connection_id"], "request-received", thread_id=message["thread_id"],
+                              role="prover", request=message["request"])
+        else:
+            self.save(topic, record["thread_id"], dict(record, state="request-received", request=message["request"]))
+
+    async def receive_presentation(self, topic, message):
+        record = self.load(topic, message["thread_id"])
+        if record and record["state"] == "request-sent":
+            record = dict(record, state="presentation-received", presentation=message["presentation"],
+                          credentials=message["credentials"])
+            if message.get("their_label"):
+                record["their_label"] = message["their_label"]
+            self.save(topic, record["thread_id"], record)
+
+    async def receive_presentation_ack(self, topic, message):
+        record = self.load(topic, message["thread_id"])
+        if record and record["state"] == "presentation-sent":
+            self.save(topic, record["thread_id"], dict(record, state="done"))
+
+    async def terminate(self):
+        sim_agents.pop(self.ident, None)
+        await self.client_session.close()
+        if not sim_agents:
+            close_storage()
+
+
+async def main(start_port: int, agent_names: list, interactive: bool = True):
+    agents = []
+
+    try:
+        # agents get backchannel ports 10 apart, e.g. 9020, 9030, 9040 and 9050
+        for (index, name) in enumerate(agent_names):
+            agent = SimAgentBackchannel("sim." + name, start_port + 10 * index)
+            agents.append(agent)
+            await agent.listen_backchannel(agent.backchannel_port)
+            agent.activate()
+
+        # now wait ...
+        if interactive:
+            async for option in prompt_loop(
+                "(X) Exit? [X] "
+            ):
+                if option is None or option in "xX":
+                    break
+        else:
+            print("Press Ctrl-C to exit ...")
+            remaining_tasks = asyncio.all_tasks()
+            await asyncio.gather(*remaining_tasks)
+
+    finally:
+        for agent in agents:
+            try:
+                await agent.terminate()
+            except Exception:
+                LOGGER.exception("Error terminating agent:")
+
+
+def str2bool(v):
+    if isinstance(v, bool):
+       return v
+    if v.lower() in ('yes', 'true', 't', 'y', '1'):
+        return True
+    elif v.lower() in ('no', 'false', 'f', 'n', '0'):
+        return False
+    else:
+        raise argparse.ArgumentTypeError('Boolean value expected.')
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Runs simulated agents in one process.")
+    parser.add_argument(
+        "-p",
+        "--port",
+        type=int,
+        default=9020,
+        metavar=("<port>"),
+        help="Choose the backchannel port of the first agent, the others follow 10 apart",
+    )
+    parser.add_argument(
+        "-a",
+        "--agents",
+        type=str,
+        default=AGENT_NAME,
+        metavar=("<names>"),
+        help="Comma separated agent names, e.g. Acme,Bob,Faber,Mallory",
+    )
+    parser.add_argument(
+        "-i",
+        "--interactive",
+        type=str2bool,
+        default=True,
+        metavar=("<interactive>"),
+        help="Start agent interactively",
+    )
+    args = parser.parse_args()
+
+    try:
+        asyncio.get_event_loop().run_until_complete(
+            main(start_port=args.port, agent_names=args.agents.split(","), interactive=args.interactive)
+        )
+    except KeyboardInterrupt:
+        os._exit(1)
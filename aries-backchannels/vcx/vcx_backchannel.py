@@ -22,6 +22,7 @@ from aiohttp import (
 from python.agent_backchannel import AgentBackchannel, default_genesis_txns, RUN_MODE, START_TIMEOUT
 from python.utils import require_indy, flatten, log_json, log_msg, log_timer, output_reader, prompt_loop, file_ext, create_uuid
 from python.storage import store_resource, get_resource, delete_resource, pop_resource, get_resources
+from python.metrics import observe_admin_request
 
 from vcx.api.connection import Connection
 from vcx.api.credential_def import CredentialDef
@@ -79,6 +80,17 @@ def state_text(connection_state):
     return str(connection_state)
 
 
+async def vcx_call(method, call):
+    """
+    Await a libvcx call, timed as an agent admin request (GET for reads, POST for changes).
+    """
+    start = default_timer()
+    try:
+        return await call
+    finally:
+        observe_admin_request(method, default_timer() - start)
+
+
 class VCXAgentBackchannel(AgentBackchannel):
     def __init__(
         self, 
@@ -153,12 +165,12 @@ class VCXAgentBackchannel(AgentBackchannel):
             if operation == "create-invitation":
                 connection_id = create_uuid()
 
-                connection = await Connection.create(connection_id)
-                await connection.connect('{"use_public_did": true}')
-                invitation = await connection.invite_details(False)
+                connection = await vcx_call("POST", Connection.create(connection_id))
+                await vcx_call("POST", connection.connect('{"use_public_did": true}'))
+                invitation = await vcx_call("GET", connection.invite_details(False))
 
                 store_resource(connection_id, "connection", connection)
-                connection_dict = await connection.serialize()
+                connection_dict = await vcx_call("GET", connection.serialize())
 
                 resp_status = 200
                 resp_text = json.dumps({"connection_id": connection_id, "invitation": invitation, "connection": connection_dict})
@@ -168,11 +180,11 @@ class VCXAgentBackchannel(AgentBackchannel):
             elif operation == "receive-invitation":
                 connection_id = create_uuid()
 
-                connection = await Connection.create_with_details(connection_id, json.dumps(data))
-                await connection.connect('{"use_public_did": true}')
-                connection_state = await connection.update_state()
+                connection = await vcx_call("POST", Connection.create_with_details(connection_id, json.dumps(data)))
+                await vcx_call("POST", connection.connect('{"use_public_did": true}'))
+                connection_state = await vcx_call("POST", connection.update_state())
                 store_resource(connection_id, "connection", connection)
-                connection_dict = await connection.serialize()
+                connection_dict = await vcx_call("GET", connection.serialize())
 
                 resp_status = 200
                 resp_text = json.dumps({"connection_id": connection_id, "invitation": data, "connection": connection_dict})
@@ -191,10 +203,10 @@ class VCXAgentBackchannel(AgentBackchannel):
                     # wait for a small period just in case ...
                     await asyncio.sleep(0.1)
                     # make sure we have latest & greatest connection state
-                    await connection.update_state()
+                    await vcx_call("POST", connection.update_state())
                     store_resource(connection_id, "connection", connection)
-                    connection_dict = await connection.serialize()
-                    connection_state = await connection.get_state()
+                    connection_dict = await vcx_call("GET", connection.serialize())
+                    connection_state = await vcx_call("GET", connection.get_state())
 
                     resp_status = 200
                     resp_text = json.dumps({"connection_id": rec_id, "state": state_text(connection_state), "connection": connection_dict})
@@ -216,8 +228,8 @@ class VCXAgentBackchannel(AgentBackchannel):
                 connection = get_resource(rec_id, "connection")
 
                 if connection:
-                    connection_dict = await connection.serialize()
-                    connection_state = await connection.get_state()
+                    connection_dict = await vcx_call("GET", connection.serialize())
+                    connection_state = await vcx_call("GET", connection.get_state())
 
                     resp_status = 200
                     resp_text = json.dumps({"connection_id": rec_id, "state": state_text(connection_state), "connection": connection_dict})
@@ -230,8 +242,8 @@ class VCXAgentBackchannel(AgentBackchannel):
                 ret_connections = []
                 for connection_id in connections:
                     connection = connections[connection_id]
-                    connection_dict = await connection.serialize()
-                    connection_state = await connection.get_state()
+                    connection_dict = await vcx_call("GET", connection.serialize())
+                    connection_state = await vcx_call("GET", connection.get_state())
                     ret_connections.append({"connection_id": connection_id, "state": state_text(connection_state), "connection": connection_dict})
 
                 resp_status = 200
@@ -248,11 +260,11 @@ class VCXAgentBackchannel(AgentBackchannel):
     ) -> (int, str):
         if topic == "connection" and rec_id:
             connection = get_resource(rec_id, "connection")
-            connection_state = await connection.update_state()
+            connection_state = await vcx_call("POST", connection.update_state())
             store_resource(rec_id, "connection", connection)
 
             resp_status = 200
-            connection_dict = await connection.serialize()
+            connection_dict = await vcx_call("GET", connection.serialize())
             resp_text = json.dumps({"connection_id": rec_id, "connection": connection_dict})
 
             return (resp_status, resp_text)
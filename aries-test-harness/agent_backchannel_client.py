@@ -6,9 +6,95 @@ from aiohttp import (
     ClientResponse,
     ClientError,
     ClientTimeout,
+    ClientConnectionError,
+    TCPConnector,
 )
+import atexit
+import glob
+import gzip
 import json
-from time import sleep
+import os
+import random
+import threading
+import time
+import zlib
+from collections import deque
+from time import monotonic
+from urllib.parse import urlsplit
+
+
+######################################################################
+# tracing
+######################################################################
+
+# directory for Chrome trace-event files, shared with the backchannels; tracing is off when unset
+TRACE_DIR = os.getenv("TRACE_DIR")
+TRACE_PID = 1
+
+trace_state = {"trace_id": None, "file": None, "lock": threading.Lock()}
+
+
+def start_trace():
+    """
+    Start a new trace, e.g. one per scenario. Requests made until the next call share its trace id.
+    """
+    trace_state["trace_id"] = "%032x" % random.getrandbits(128)
+    return trace_state["trace_id"]
+
+
+def trace_row(trace_id):
+    # the backchannels put a trace's spans on the same viewer row
+    return zlib.crc32(trace_id.encode("utf8")) & 0xFFFF
+
+
+def write_trace_event(event):
+    if not TRACE_DIR:
+        return
+    with trace_state["lock"]:
+        if trace_state["file"] is None:
+            os.makedirs(TRACE_DIR, exist_ok=True)
+            trace_state["file"] = open(os.path.join(TRACE_DIR, f"harness-{os.getpid()}.trace.json"), "w")
+            trace_state["file"].write("[\n" + json.dumps(
+                {"name": "process_name", "ph": "M", "pid": TRACE_PID, "args": {"name": "test harness"}}
+            ) + ",\n")
+        trace_state["file"].write(json.dumps(event) + ",\n")
+        trace_state["file"].flush()
+
+
+def trace_span(name, cat, start, end, **args):
+    """
+    Write a complete span that ran from start to end (time.time() values) on the current trace's row.
+    """
+    trace_id = trace_state["trace_id"] or start_trace()
+    write_trace_event(
+        {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": int(start * 1_000_000),
+            "dur": int((end - start) * 1_000_000),
+            "pid": TRACE_PID,
+            "tid": trace_row(trace_id),
+            "args": dict(args, trace_id=trace_id),
+        }
+    )
+
+
+def merge_traces(file_name="trace.json"):
+    """
+    Combine the harness and backchannel trace files in TRACE_DIR into one file for a trace viewer.
+    """
+    if not TRACE_DIR:
+        return None
+    events = []
+    for trace_file in sorted(glob.glob(os.path.join(TRACE_DIR, "*.trace.json"))):
+        with open(trace_file) as f:
+            text = f.read().rstrip().rstrip(",").rstrip("]")
+        events.extend(json.loads(text + "]"))
+    merged = os.path.join(TRACE_DIR, file_name)
+    with open(merged, "w") as f:
+        json.dump(events, f)
+    return merged
 
 
 ######################################################################
@@ -40,31 +126,329 @@ def run_coroutine_with_kwargs(coroutine, *args, **kwargs):
         loop.close()
 
 
+######################################################################
+# client event loop
+######################################################################
+
+# one event loop on a background thread serves every backchannel request, with
+# a keep-alive session per agent, instead of a new loop and connection per call
+client_state = {"loop": None, "thread": None, "sessions": {}, "breakers": {}, "lock": threading.Lock()}
+
+
+def get_client_loop():
+    with client_state["lock"]:
+        if client_state["loop"] is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="backchannel-client", daemon=True)
+            thread.start()
+            client_state["loop"] = loop
+            client_state["thread"] = thread
+            atexit.register(close_client_loop)
+        return client_state["loop"]
+
+
+def run_on_client_loop(coroutine):
+    """
+    Run a coroutine on the client loop and wait for its result.
+    """
+    loop = get_client_loop()
+    if threading.current_thread() is client_state["thread"]:
+        coroutine.close()
+        raise RuntimeError("Blocking backchannel call made from the client loop, await the async API instead")
+    return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+
+def agent_origin(url):
+    (scheme, netloc, _, _, _) = urlsplit(url)
+    return scheme + "://" + netloc
+
+
+def get_client_session(url) -> ClientSession:
+    """
+    The pooled session for the agent at url, must be called on the client loop.
+    """
+    origin = agent_origin(url)
+    session = client_state["sessions"].get(origin)
+    if session is None or session.closed:
+        session = ClientSession(connector=TCPConnector(keepalive_timeout=60))
+        client_state["sessions"][origin] = session
+    return session
+
+
+async def close_client_sessions():
+    sessions = list(client_state["sessions"].values())
+    client_state["sessions"].clear()
+    for session in sessions:
+        await session.close()
+
+
+def close_client_loop():
+    with client_state["lock"]:
+        loop = client_state["loop"]
+        thread = client_state["thread"]
+        client_state["loop"] = None
+        client_state["thread"] = None
+    if loop is None:
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(close_client_sessions(), loop).result(timeout=5)
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout=5)
+        if not loop.is_running():
+            loop.close()
+
+
+######################################################################
+# timeouts, retries and circuit breakers
+######################################################################
+
+# seconds to connect to a backchannel, and to wait for its response (long-polled
+# GETs get their own timeout on top of this)
+CONNECT_TIMEOUT = float(os.getenv("BACKCHANNEL_CONNECT_TIMEOUT", 10.0))
+READ_TIMEOUT = float(os.getenv("BACKCHANNEL_READ_TIMEOUT", 120.0))
+# retries of a failed GET /agent/command/ request, drawn from a per-agent budget of
+# RETRY_BUDGET_MIN plus RETRY_BUDGET_RATIO of the requests made to the agent; other
+# requests aren't retried: a GET /agent/response/ pops the response it returns
+GET_RETRIES = int(os.getenv("BACKCHANNEL_GET_RETRIES", 2))
+RETRY_BUDGET_MIN = 10
+RETRY_BUDGET_RATIO = 0.1
+# consecutive failed requests after which the agent's health is checked, and how
+# long a failed agent is skipped before it is checked again
+BREAKER_THRESHOLD = int(os.getenv("BACKCHANNEL_BREAKER_THRESHOLD", 3))
+BREAKER_COOLDOWN = float(os.getenv("BACKCHANNEL_BREAKER_COOLDOWN", 30.0))
+HEALTH_CHECK_TIMEOUT = 5.0
+
+
+class AgentUnavailableError(Exception):
+    """
+    The agent's backchannel failed its health check, so requests to it fail fast.
+    """
+
+
+class CircuitBreaker:
+    """
+    Tracks failed requests to one agent. After BREAKER_THRESHOLD consecutive
+    failures the agent's status endpoint is checked; if that fails too the
+    breaker opens and requests fail immediately with the reason, until a
+    health check passes again after BREAKER_COOLDOWN.
+    """
+
+    def __init__(self, origin):
+        self.origin = origin
+        self.failures = 0
+        self.last_error = None
+        self.reason = None
+        self.opened_at = None
+        self.requests = 0
+        self.retries = 0
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def take_retry(self):
+        if self.retries >= RETRY_BUDGET_MIN + RETRY_BUDGET_RATIO * self.requests:
+            return False
+        self.retries += 1
+        return True
+
+    async def before_request(self):
+        self.requests += 1
+        if not self.is_open:
+            return
+        if monotonic() - self.opened_at < BREAKER_COOLDOWN:
+            raise AgentUnavailableError(f"{self.origin} is unavailable: {self.reason}")
+        await self.check_health()
+
+    def record_success(self):
+        self.failures = 0
+
+    async def record_failure(self, error):
+        self.failures += 1
+        self.last_error = f"{type(error).__name__}: {error}" if str(error) else type(error).__name__
+        if self.failures >= BREAKER_THRESHOLD:
+            await self.check_health()
+
+    async def check_health(self):
+        try:
+            async with get_client_session(self.origin).get(
+                self.origin + "/agent/command/status/",
+                timeout=ClientTimeout(total=HEALTH_CHECK_TIMEOUT),
+            ) as resp:
+                await resp.read()
+                if resp.status >= 500:
+                    raise ClientConnectionError(f"status check returned {resp.status}")
+        except (ClientConnectionError, asyncio.TimeoutError) as e:
+            if not self.is_open:
+                print(f"Agent {self.origin} failed its health check after {self.failures} failed requests ({self.last_error}),",
+                      "failing further requests to it fast")
+            self.reason = f"status check failed with {type(e).__name__}: {e}"
+            self.opened_at = monotonic()
+            raise AgentUnavailableError(f"{self.origin} is unavailable: {self.reason}")
+        self.failures = 0
+        self.opened_at = None
+
+
+def get_breaker(url) -> CircuitBreaker:
+    origin = agent_origin(url)
+    breaker = client_state["breakers"].get(origin)
+    if breaker is None:
+        breaker = client_state["breakers"][origin] = CircuitBreaker(origin)
+    return breaker
+
+
+######################################################################
+# record and replay
+######################################################################
+
+# with BACKCHANNEL_RECORD set every request and its response is written to that
+# cassette file; with BACKCHANNEL_REPLAY set responses are served from the cassette
+# instead of the agents, delayed by their recorded time times BACKCHANNEL_REPLAY_TIME_SCALE
+# (0, the default, serves them straight away)
+RECORD_FILE = os.getenv("BACKCHANNEL_RECORD")
+REPLAY_FILE = os.getenv("BACKCHANNEL_REPLAY")
+REPLAY_TIME_SCALE = float(os.getenv("BACKCHANNEL_REPLAY_TIME_SCALE", 0.0))
+
+# file: the open cassette being recorded
+# responses: (scenario, method, url) -> recorded (status, body, elapsed) not served yet
+# last: (scenario, method, url) -> the last one served, repeated once they run out
+cassette_state = {"scenario": "", "file": None, "responses": None, "last": {}}
+
+
+class CassetteMissError(Exception):
+    """
+    A replayed request that was never made while the cassette was recorded.
+    """
+
+
+def open_cassette(file_name, mode):
+    # ".gz" cassettes are compressed
+    if file_name.endswith(".gz"):
+        return gzip.open(file_name, mode + "t", encoding="utf8")
+    return open(file_name, mode, encoding="utf8")
+
+
+def start_cassette_scenario(name):
+    """
+    Key the requests that follow to a scenario, so a replay can run any subset
+    of the recorded scenarios in any order.
+    """
+    cassette_state["scenario"] = name
+    cassette_state["last"].clear()
+
+
+def record_interaction(method, url, params, data, status, body, elapsed):
+    cassette = cassette_state["file"]
+    if cassette is None:
+        cassette = cassette_state["file"] = open_cassette(RECORD_FILE, "w")
+        atexit.register(cassette.close)
+    entry = {"s": cassette_state["scenario"], "m": method, "u": url, "c": status, "b": body, "t": round(elapsed, 4)}
+    if params:
+        entry["q"] = params
+    if data:
+        entry["d"] = data
+    cassette.write(json.dumps(entry, separators=(",", ":")) + "\n")
+    cassette.flush()
+
+
+def load_cassette(file_name):
+    """
+    The responses of a cassette, by (scenario, method, url) in recorded order.
+    """
+    responses = {}
+    with open_cassette(file_name, "r") as cassette:
+        for line in cassette:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            key = (entry["s"], entry["m"], entry["u"])
+            if key not in responses:
+                responses[key] = deque()
+            responses[key].append((entry["c"], entry["b"], entry["t"]))
+    return responses
+
+
+async def replay_request(method, url) -> (int, str):
+    if cassette_state["responses"] is None:
+        cassette_state["responses"] = load_cassette(REPLAY_FILE)
+    key = (cassette_state["scenario"], method, url)
+    recorded = cassette_state["responses"].get(key)
+    if recorded:
+        cassette_state["last"][key] = recorded.popleft()
+    elif key not in cassette_state["last"]:
+        raise CassetteMissError(
+            f"{method} {url} was not recorded in {REPLAY_FILE} for scenario {cassette_state['scenario']!r}"
+        )
+    # a replay that polls more often than the recording keeps seeing the last state
+    (status, body, elapsed) = cassette_state["last"][key]
+    if REPLAY_TIME_SCALE > 0:
+        await asyncio.sleep(elapsed * REPLAY_TIME_SCALE)
+    return (status, body)
+
+
+async def client_sleep(delay):
+    # pauses between probes are compressed along with the replayed responses
+    await asyncio.sleep(delay * REPLAY_TIME_SCALE if REPLAY_FILE else delay)
+
+
 async def make_agent_backchannel_request(
     method, path, data=None, text=False, params=None
 ) -> (int, str):
     params = {k: v for (k, v) in (params or {}).items() if v is not None}
-    client_session: ClientSession = ClientSession()
-    async with client_session.request(
-        method, path, json=data, params=params
-    ) as resp:
-        resp_status = resp.status
-        resp_text = await resp.text()
-        await client_session.close()
-        return (resp_status, resp_text)
+    if REPLAY_FILE:
+        return await replay_request(method, path)
+    trace_id = trace_state["trace_id"] or start_trace()
+    span_id = "%016x" % random.getrandbits(64)
+    headers = {"traceparent": f"00-{trace_id}-{span_id}-01"}
+    start = time.time()
+    client_session = get_client_session(path)
+    breaker = get_breaker(path)
+    # a long-polled GET may legitimately take its whole wait timeout
+    timeout = ClientTimeout(
+        sock_connect=CONNECT_TIMEOUT,
+        sock_read=READ_TIMEOUT + float(params.get("timeout", 0)),
+    )
+    attempts = 1 + (GET_RETRIES if method == "GET" and "/agent/command/" in path else 0)
+    try:
+        await breaker.before_request()
+        for attempt in range(attempts):
+            try:
+                async with client_session.request(
+                    method, path, json=data, params=params, headers=headers, timeout=timeout
+                ) as resp:
+                    resp_status = resp.status
+                    resp_text = await resp.text()
+                breaker.record_success()
+                if RECORD_FILE:
+                    record_interaction(method, path, params, data, resp_status, resp_text, time.time() - start)
+                return (resp_status, resp_text)
+            except (ClientConnectionError, asyncio.TimeoutError) as e:
+                await breaker.record_failure(e)
+                if attempt + 1 == attempts or not breaker.take_retry():
+                    raise
+                await asyncio.sleep(0.1 * 2 ** attempt)
+    finally:
+        if TRACE_DIR:
+            trace_span(f"{method} {path}", "harness", start, time.time(), span_id=span_id)
+            # starts the flow arrow ended by the backchannel's span for this request
+            write_trace_event(
+                {"name": "request", "cat": "flow", "ph": "s", "id": span_id,
+                 "ts": int(start * 1_000_000), "pid": TRACE_PID, "tid": trace_row(trace_id)}
+            )
 
 
-def agent_backchannel_GET(url, topic, operation=None, id=None) -> (int, str):
+async def async_agent_backchannel_GET(url, topic, operation=None, id=None, params=None) -> (int, str):
     agent_url = url + topic + "/"
     if operation:
         agent_url = agent_url + operation + "/"
     if id:
         agent_url = agent_url + id
-    (resp_status, resp_text) = run_coroutine_with_kwargs(make_agent_backchannel_request, "GET", agent_url)
+    (resp_status, resp_text) = await make_agent_backchannel_request("GET", agent_url, params=params)
     return (resp_status, resp_text)
 
 
-def agent_backchannel_POST(url, topic, operation=None, id=None, data=None) -> (int, str):
+async def async_agent_backchannel_POST(url, topic, operation=None, id=None, data=None) -> (int, str):
     agent_url = url + topic + "/"
     payload = {}
     if data:
@@ -76,32 +460,156 @@ def agent_backchannel_POST(url, topic, operation=None, id=None, data=None) -> (i
             payload["cred_ex_id"] = id
         else:
             payload["id"] = id
-    (resp_status, resp_text) = run_coroutine_with_kwargs(make_agent_backchannel_request, "POST", agent_url, data=payload)
+    (resp_status, resp_text) = await make_agent_backchannel_request("POST", agent_url, data=payload)
     return (resp_status, resp_text)
 
-def agent_backchannel_DELETE(url, topic, id=None, data=None) -> (int, str):
+async def async_agent_backchannel_DELETE(url, topic, id=None, data=None) -> (int, str):
     agent_url = url + topic + "/"
     if id:
         agent_url = agent_url + id
-    (resp_status, resp_text) = run_coroutine_with_kwargs(make_agent_backchannel_request, "DELETE", agent_url)
+    (resp_status, resp_text) = await make_agent_backchannel_request("DELETE", agent_url)
     return (resp_status, resp_text)
 
-def expected_agent_state(agent_url, protocol_txt, thread_id, status_txt, wait_time=2.0, sleep_time=0.5):
-    sleep(sleep_time)
+async def async_agent_backchannel_batch(url, commands) -> (int, str):
+    """
+    Run a list of {topic, operation, id, data} commands on one agent in a single request,
+    see AgentBackchannel._post_batch_backchannel for the command format.
+    """
+    agent_url = url + "batch"
+    (resp_status, resp_text) = await make_agent_backchannel_request("POST", agent_url, data={"commands": commands})
+    return (resp_status, resp_text)
+
+# states from which an exchange can no longer reach the expected state
+TERMINAL_STATES = ("abandoned", "problem-report", "error")
+# first pause between state probes, doubled (with jitter) up to sleep_time
+WAIT_FIRST_DELAY = 0.005
+
+
+class WaitResult:
+    """
+    Outcome of expected_agent_state: true if the expected state was reached, along
+    with the last state seen and how long and how many probes it took.
+    """
+
+    __slots__ = ("reached", "state", "status", "elapsed", "probes")
+
+    def __init__(self, reached, state, status, elapsed, probes):
+        self.reached = reached
+        self.state = state
+        self.status = status
+        self.elapsed = elapsed
+        self.probes = probes
+
+    def __bool__(self):
+        return self.reached
+
+    def __repr__(self):
+        return (f"WaitResult(reached={self.reached}, state={self.state!r}, status={self.status}, "
+                f"elapsed={self.elapsed:.3f}, probes={self.probes})")
+
+
+async def async_expected_agent_state(agent_url, protocol_txt, thread_id, status_txt, wait_time=2.0, sleep_time=0.5):
+    """
+    Probe the record until it reaches one of the expected states, reaches a terminal
+    state or wait_time seconds have passed.
+
+    The first probe is made straight away (and long-polls on backchannels that support it),
+    later probes back off exponentially from WAIT_FIRST_DELAY to sleep_time.
+    """
     state = "None"
     if type(status_txt) != list:
         status_txt = [status_txt]
     # "N/A" means that the backchannel can't determine the state - we'll treat this as a successful response
-    status_txt.append("N/A")
-    for i in range(int(wait_time/sleep_time)):
-        (resp_status, resp_text) = agent_backchannel_GET(agent_url + "/agent/command/", protocol_txt, id=thread_id)
+    # (copied, the steps share their state lists between concurrent checks)
+    status_txt = status_txt + ["N/A"]
+    stop_states = status_txt + [s for s in TERMINAL_STATES if s not in status_txt]
+
+    start = monotonic()
+    started_at = time.time()
+    deadline = start + wait_time
+    delay = WAIT_FIRST_DELAY
+    probes = 0
+    reached = False
+
+    # backchannels that support it hold the first request until a stop state is reached,
+    # the others ignore the parameters and answer straight away
+    params = {"wait_for_state": ",".join(stop_states), "timeout": wait_time}
+    while True:
+        probes += 1
+        (resp_status, resp_text) = await async_agent_backchannel_GET(
+            agent_url + "/agent/command/", protocol_txt, id=thread_id, params=params
+        )
+        params = None
         if resp_status == 200:
             resp_json = json.loads(resp_text)
             state = resp_json["state"]
             if state in status_txt:
-                return True
-        sleep(sleep_time)
+                reached = True
+                break
+            if state in TERMINAL_STATES:
+                break
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            break
+        await client_sleep(min(delay * random.uniform(0.5, 1.0), remaining))
+        delay = min(delay * 2, sleep_time)
+
+    result = WaitResult(reached, state, resp_status, monotonic() - start, probes)
+    if TRACE_DIR:
+        trace_span(f"wait for {protocol_txt} {status_txt[:-1]}", "wait", started_at, time.time(),
+                   thread_id=thread_id, state=state, probes=probes)
+    if not reached:
+        print("From", agent_url, "Expected state", status_txt, "but received", state, ", with a response status of", resp_status,
+              f"({probes} probes in {result.elapsed:.2f}s)")
+    return result
+
+
+######################################################################
+# synchronous API for the step files
+######################################################################
 
-    print("From", agent_url, "Expected state", status_txt, "but received", state, ", with a response status of", resp_status)
-    return False
+def gather_agent_requests(*coroutines) -> list:
+    """
+    Run async client calls, typically to different agents, concurrently and return
+    all of their results in order, e.g.
 
+        (inviter_ok, invitee_ok) = gather_agent_requests(
+            async_expected_agent_state(inviter_url, "connection", inviter_id, "responded"),
+            async_expected_agent_state(invitee_url, "connection", invitee_id, "complete"),
+        )
+
+    so a multi-agent check takes as long as the slowest agent rather than the sum.
+    """
+    async def gather():
+        return await asyncio.gather(*coroutines)
+
+    return list(run_on_client_loop(gather()))
+
+
+def agent_backchannel_GET(url, topic, operation=None, id=None, params=None) -> (int, str):
+    return run_on_client_loop(async_agent_backchannel_GET(url, topic, operation=operation, id=id, params=params))
+
+
+def agent_backchannel_POST(url, topic, operation=None, id=None, data=None) -> (int, str):
+    return run_on_client_loop(async_agent_backchannel_POST(url, topic, operation=operation, id=id, data=data))
+
+def agent_backchannel_DELETE(url, topic, id=None, data=None) -> (int, str):
+    return run_on_client_loop(async_agent_backchannel_DELETE(url, topic, id=id, data=data))
+
+def agent_backchannel_batch(url, commands) -> (int, str):
+    """
+    Run a list of {topic, operation, id, data} commands on one agent in a single request,
+    see AgentBackchannel._post_batch_backchannel for the command format.
+    """
+    return run_on_client_loop(async_agent_backchannel_batch(url, commands))
+
+def client_pause(delay):
+    """
+    time.sleep for the step files: compressed along with the replayed responses, like client_sleep.
+    """
+    time.sleep(delay * REPLAY_TIME_SCALE if REPLAY_FILE else delay)
+
+def expected_agent_state(agent_url, protocol_txt, thread_id, status_txt, wait_time=2.0, sleep_time=0.5):
+    return run_on_client_loop(
+        async_expected_agent_state(agent_url, protocol_txt, thread_id, status_txt, wait_time=wait_time, sleep_time=sleep_time)
+    )
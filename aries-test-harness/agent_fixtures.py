@@ -0,0 +1,478 @@
+"""
+Fixtures that live for the whole behave run instead of a single scenario.
+
+Schemas and credential definitions can be created on the ledger once per
+issuer and reused by every later scenario asking for the same schema, see
+"is ready to issue a credential" in 0036-issue-credential.py. Revocable
+credential definitions are never cached, the scenarios revoke credentials in
+their revocation registries. The cache is opt-in with FIXTURE_CACHE:
+
+    off     create a new schema and credential definition in every scenario (default)
+    on      create on first use, reuse afterwards
+    eager   also create the fixtures of the selected scenarios' @Schema_ tags,
+            concurrently, in before_all
+
+Connections between two agents can be reused the same way, opt-in with
+CONNECTION_POOL=on, see "have an existing connection" in 0160-connection.py.
+
+Credentials that proof scenarios need the prover to hold can be issued once
+per issuer, prover, credential definition and credential data, opt-in with
+CREDENTIAL_POOL=on (on first use) or eager (the selected scenarios' credentials,
+concurrently, in before_all), see 0037-present-proof.py and
+0454-present-proof-v2.py.
+"""
+import asyncio
+import json
+import os
+import re
+from time import time
+from timeit import default_timer
+
+from agent_backchannel_client import (
+    async_agent_backchannel_GET,
+    async_agent_backchannel_POST,
+    async_expected_agent_state,
+    gather_agent_requests,
+    run_on_client_loop,
+)
+from agent_test_data import get_test_data, render_test_data
+
+FIXTURE_CACHE = os.getenv("FIXTURE_CACHE", "off").lower()
+# fixtures created at the same time on one issuer in eager mode
+FIXTURE_CONCURRENCY = int(os.getenv("FIXTURE_CONCURRENCY", 4))
+
+CONNECTION_POOL = os.getenv("CONNECTION_POOL", "off").lower() == "on"
+
+CREDENTIAL_POOL = os.getenv("CREDENTIAL_POOL", "off").lower()
+
+CRED_DEF_TAG = "default"
+
+# steps naming the issuer of a scenario, once the outline placeholders are filled in
+ISSUER_STEPS = (
+    re.compile(r'^"(\w+)" is ready to issue'),
+    re.compile(r'has an issued credential (?:with formats )?from "?(\w+)"?'),
+)
+
+# (issuer url, schema name, schema version, attributes, support revocation) ->
+#   {"schema_id", "schema", "cred_def_id", "cred_def", "created"}
+issuer_fixtures = {}
+
+
+def use_issuer_fixture(support_revocation) -> bool:
+    return FIXTURE_CACHE != "off" and not support_revocation
+
+
+def issuer_fixture_key(issuer_url, schema, support_revocation):
+    return (
+        issuer_url,
+        schema["schema_name"],
+        schema["schema_version"],
+        tuple(sorted(schema["attributes"])),
+        bool(support_revocation),
+    )
+
+
+async def create_issuer_fixture(issuer_url, schema, support_revocation) -> dict:
+    """
+    Create a schema and credential definition on the issuer and read them back.
+    """
+    command_url = issuer_url + "/agent/command/"
+    (resp_status, resp_text) = await async_agent_backchannel_POST(command_url, "schema", data=schema)
+    assert resp_status == 200, f'resp_status {resp_status} is not 200; {resp_text}'
+    schema_id = json.loads(resp_text)["schema_id"]
+
+    cred_def = {"support_revocation": bool(support_revocation), "schema_id": schema_id, "tag": CRED_DEF_TAG}
+    (resp_status, resp_text) = await async_agent_backchannel_POST(command_url, "credential-definition", data=cred_def)
+    assert resp_status == 200, f'resp_status {resp_status} is not 200; {resp_text}'
+    cred_def_id = json.loads(resp_text)["credential_definition_id"]
+    created = time()
+
+    (schema_status, schema_text), (cred_def_status, cred_def_text) = await asyncio.gather(
+        async_agent_backchannel_GET(command_url, "schema", id=schema_id),
+        async_agent_backchannel_GET(command_url, "credential-definition", id=cred_def_id),
+    )
+    assert schema_status == 200, f'resp_status {schema_status} is not 200; {schema_text}'
+    assert cred_def_status == 200, f'resp_status {cred_def_status} is not 200; {cred_def_text}'
+
+    return {
+        "schema_id": schema_id,
+        "schema": json.loads(schema_text),
+        "cred_def_id": cred_def_id,
+        "cred_def": json.loads(cred_def_text),
+        "created": created,
+    }
+
+
+def get_issuer_fixture(issuer_url, schema, support_revocation) -> dict:
+    """
+    The schema and credential definition for schema on the issuer, created on first use.
+    """
+    key = issuer_fixture_key(issuer_url, schema, support_revocation)
+    fixture = issuer_fixtures.get(key)
+    if fixture is None:
+        fixture = run_on_client_loop(create_issuer_fixture(issuer_url, schema, support_revocation))
+        issuer_fixtures[key] = fixture
+    return fixture
+
+
+def scenario_issuers(scenario):
+    issuers = set()
+    row = getattr(scenario, "_row", None)
+    if row is not None and "issuer" in row.headings:
+        issuers.add(row["issuer"])
+    for step in scenario.all_steps:
+        for pattern in ISSUER_STEPS:
+            match = pattern.search(step.name)
+            if match:
+                issuers.add(match.group(1))
+    return issuers
+
+
+def selected_issuer_fixtures(context) -> dict:
+    """
+    The fixtures named by the @Schema_ tags and issuers of the scenarios selected for this run.
+    """
+    fixtures = {}
+    for feature in context._runner.features:
+        for scenario in feature.walk_scenarios():
+            if not scenario.should_run(context.config):
+                continue
+            schema_tags = [tag for tag in scenario.effective_tags if tag.startswith("Schema_")]
+            if not schema_tags:
+                continue
+            for issuer in scenario_issuers(scenario):
+                issuer_url = context.config.userdata.get(issuer)
+                if not issuer_url:
+                    continue
+                for tag in schema_tags:
+                    schema_json = get_test_data(tag.lower())
+                    (schema, support_revocation) = (schema_json["schema"], schema_json["cred_def_support_revocation"])
+                    if support_revocation:
+                        continue
+                    key = issuer_fixture_key(issuer_url, schema, support_revocation)
+                    fixtures[key] = (issuer_url, schema, support_revocation)
+    return fixtures
+
+
+def prepare_issuer_fixtures(context):
+    """
+    Create the schemas and credential definitions of the selected scenarios up front,
+    concurrently across issuers, FIXTURE_CONCURRENCY at a time on each issuer.
+    """
+    fixtures = {
+        key: args for (key, args) in selected_issuer_fixtures(context).items() if key not in issuer_fixtures
+    }
+    if not fixtures:
+        return
+    limits = {}
+
+    async def create(key, issuer_url, schema, support_revocation):
+        limit = limits.setdefault(issuer_url, asyncio.Semaphore(FIXTURE_CONCURRENCY))
+        async with limit:
+            try:
+                issuer_fixtures[key] = await create_issuer_fixture(issuer_url, schema, support_revocation)
+            except Exception as e:
+                # left to the scenarios, which create it on first use and report the error there
+                print(f"Could not create the {schema['schema_name']} fixture on {issuer_url}: {e}")
+
+    async def create_all():
+        await asyncio.gather(*(create(key, *args) for (key, args) in fixtures.items()))
+
+    start = default_timer()
+    run_on_client_loop(create_all())
+    created = sum(1 for key in fixtures if key in issuer_fixtures)
+    print(f"Created {created} of {len(fixtures)} schema and credential definition fixtures in {default_timer() - start:.1f}s")
+
+
+######################################################################
+# connection pool
+######################################################################
+
+# connection and DID exchange scenarios always make their own connections, the
+# connection is what they test; @DIDExchangeConnection scenarios of other features are pooled
+CONNECTION_FEATURE_TAGS = ("RFC0160", "RFC0023")
+
+# protocol -> states of a connection that can be used for other protocols
+ESTABLISHED_STATES = {
+    "connection": ("responded", "complete", "active"),
+    "did-exchange": ("completed",),
+}
+
+# (sender url, receiver url, protocol) -> (sender connection id, receiver connection id)
+connection_pool = {}
+
+
+def use_connection_pool(tags) -> bool:
+    return CONNECTION_POOL and not any(tag in tags for tag in CONNECTION_FEATURE_TAGS)
+
+
+def connection_established(resp_status, resp_text, protocol) -> bool:
+    return resp_status == 200 and json.loads(resp_text).get("state") in ESTABLISHED_STATES[protocol]
+
+
+def get_pooled_connection(sender_url, receiver_url, protocol):
+    """
+    The (sender, receiver) connection ids of a pooled connection that both agents still
+    have established, or None. A connection that fails the check is dropped from the pool.
+    """
+    key = (sender_url, receiver_url, protocol)
+    pooled = connection_pool.get(key)
+    if pooled is None:
+        return None
+    (sender_connection_id, receiver_connection_id) = pooled
+    responses = gather_agent_requests(
+        async_agent_backchannel_GET(sender_url + "/agent/command/", protocol, id=sender_connection_id),
+        async_agent_backchannel_GET(receiver_url + "/agent/command/", protocol, id=receiver_connection_id),
+    )
+    if all(connection_established(resp_status, resp_text, protocol) for (resp_status, resp_text) in responses):
+        return pooled
+    del connection_pool[key]
+    return None
+
+
+def pool_connection(sender_url, receiver_url, protocol, sender_connection_id, receiver_connection_id):
+    connection_pool[(sender_url, receiver_url, protocol)] = (sender_connection_id, receiver_connection_id)
+
+
+######################################################################
+# credential pool
+######################################################################
+
+# proof features, and the issue credential protocol used to pre-issue their credentials
+CREDENTIAL_POOL_FEATURES = {"RFC0037": "issue-credential", "RFC0454": "issue-credential-v2"}
+
+CREDENTIAL_STEP = re.compile(r'^"(\w+)" has an issued credential (?:with formats )?from "?(\w+)"? with (\S+)$')
+
+# (issuer url, holder url, cred def id, credential data) -> credential id in the holder's wallet
+credential_pool = {}
+
+
+def use_credential_pool(tags) -> bool:
+    return CREDENTIAL_POOL != "off" and any(tag in tags for tag in CREDENTIAL_POOL_FEATURES)
+
+
+def get_pooled_credential(issuer_url, holder_url, cred_def_id, credential_data):
+    """
+    The id of a pooled credential that is still in the holder's wallet, or None.
+
+    Revocable credentials are never pooled, a scenario may revoke them.
+    """
+    key = (issuer_url, holder_url, cred_def_id, credential_data)
+    credential_id = credential_pool.get(key)
+    if credential_id is None:
+        return None
+    (resp_status, resp_text) = run_on_client_loop(
+        async_agent_backchannel_GET(holder_url + "/agent/command/", "credential", id=credential_id)
+    )
+    if resp_status == 200:
+        return credential_id
+    del credential_pool[key]
+    return None
+
+
+def pool_credential(issuer_url, holder_url, cred_def_id, credential_data, credential_id):
+    credential_pool[(issuer_url, holder_url, cred_def_id, credential_data)] = credential_id
+
+
+def credential_pool_key(context, schema, topic):
+    """
+    The credential pool key of the credential a proof scenario needs for schema, or None
+    if the scenario issues it itself. topic is the issue credential protocol of the scenario.
+    """
+    # revocable credentials, those without a credential data profile and non-indy formats are always issued in the scenario
+    if (
+        not use_credential_pool(context.tags)
+        or (topic == "issue-credential-v2" and context.current_cred_format != "indy")
+        or "credential_data_name" not in context
+        or context.support_revocation_dict[schema]
+    ):
+        return None
+    cred_def_id = context.credential_definition_id_dict[context.schema['schema_name']]
+    return (context.issuer_url, context.holder_url, cred_def_id, context.credential_data_name)
+
+
+def pooled_credential(context, schema, topic) -> bool:
+    """
+    Hand the scenario a matching credential the holder already has from the credential pool, if there is one.
+    """
+    pool_key = credential_pool_key(context, schema, topic)
+    credential_id = get_pooled_credential(*pool_key) if pool_key else None
+    if credential_id is None:
+        return False
+    if 'credential_id_dict' not in context:
+        context.credential_id_dict = {}
+    context.credential_id_dict.setdefault(context.schema['schema_name'], []).append(credential_id)
+    return True
+
+
+def add_credential_to_pool(context, schema, topic):
+    """
+    Pool the credential the scenario has just issued for schema, if it can be pooled.
+    """
+    pool_key = credential_pool_key(context, schema, topic)
+    if pool_key:
+        pool_credential(*pool_key, context.credential_id_dict[context.schema['schema_name']][-1])
+
+
+async def connect_agents(inviter_url, invitee_url) -> (str, str):
+    """
+    Establish a connection protocol connection, the steps of "have an existing connection".
+    """
+    inviter_command_url = inviter_url + "/agent/command/"
+    invitee_command_url = invitee_url + "/agent/command/"
+    (resp_status, resp_text) = await async_agent_backchannel_POST(inviter_command_url, "connection", operation="create-invitation")
+    assert resp_status == 200, f'resp_status {resp_status} is not 200; {resp_text}'
+    resp_json = json.loads(resp_text)
+    inviter_connection_id = resp_json["connection_id"]
+
+    (resp_status, resp_text) = await async_agent_backchannel_POST(invitee_command_url, "connection", operation="receive-invitation", data=resp_json["invitation"])
+    assert resp_status == 200, f'resp_status {resp_status} is not 200; {resp_text}'
+    invitee_connection_id = json.loads(resp_text)["connection_id"]
+
+    (resp_status, resp_text) = await async_agent_backchannel_POST(invitee_command_url, "connection", operation="accept-invitation", id=invitee_connection_id)
+    assert resp_status == 200, f'resp_status {resp_status} is not 200; {resp_text}'
+    assert await async_expected_agent_state(inviter_url, "connection", inviter_connection_id, "requested", wait_time=60.0)
+
+    (resp_status, resp_text) = await async_agent_backchannel_POST(inviter_command_url, "connection", operation="accept-request", id=inviter_connection_id)
+    assert resp_status == 200, f'resp_status {resp_status} is not 200; {resp_text}'
+    assert await async_expected_agent_state(invitee_url, "connection", invitee_connection_id, "responded", wait_time=60.0)
+
+    data = {"comment": "acknowledgement from the credential pool"}
+    (resp_status, resp_text) = await async_agent_backchannel_POST(invitee_command_url, "connection", operation="send-ping", id=invitee_connection_id, data=data)
+    assert resp_status == 200, f'resp_status {resp_status} is not 200; {resp_text}'
+    assert await async_expected_agent_state(inviter_url, "connection", inviter_connection_id, ["responded", "complete"], wait_time=60.0)
+
+    return (inviter_connection_id, invitee_connection_id)
+
+
+async def issue_credential(topic, issuer_url, holder_url, issuer_connection_id, attributes, filters) -> str:
+    """
+    Issue an indy credential from an offer with issue-credential v1 or v2, the steps
+    of "has an issued credential from", and return its id in the holder's wallet.
+    """
+    issuer_command_url = issuer_url + "/agent/command/"
+    holder_command_url = holder_url + "/agent/command/"
+    if topic == "issue-credential":
+        preview = {
+            "@type": "did:sov:BzCbsNYhMrjHiqZDTUASHg;spec/issue-credential/1.0/credential-preview",
+            "attributes": attributes,
+        }
+        offer = {"cred_def_id": filters["indy"]["cred_def_id"], "credential_preview": preview, "connection_id": issuer_connection_id}
+        issue = {"credential_preview": preview, "comment": "issuing credential"}
+    else:
+        preview = {"@type": "issue-credential/2.0/credential-preview", "attributes": attributes}
+        offer = {"connection_id": issuer_connection_id, "credential_preview": preview, "filter": filters}
+        issue = {"comment": "issuing credential"}
+
+    (resp_status, resp_text) = await async_agent_backchannel_POST(issuer_command_url, topic, operation="send-offer", data=offer)
+    assert resp_status == 200, f'resp_status {resp_status} is not 200; {resp_text}'
+    thread_id = json.loads(resp_text)["thread_id"]
+    assert await async_expected_agent_state(holder_url, topic, thread_id, "offer-received")
+
+    (resp_status, resp_text) = await async_agent_backchannel_POST(holder_command_url, topic, operation="send-request", id=thread_id)
+    assert resp_status == 200, f'resp_status {resp_status} is not 200; {resp_text}'
+    assert await async_expected_agent_state(issuer_url, topic, thread_id, "request-received", wait_time=60.0)
+
+    (resp_status, resp_text) = await async_agent_backchannel_POST(issuer_command_url, topic, operation="issue", id=thread_id, data=issue)
+    assert resp_status == 200, f'resp_status {resp_status} is not 200; {resp_text}'
+    assert await async_expected_agent_state(holder_url, topic, thread_id, "credential-received")
+
+    if topic == "issue-credential":
+        store = {"credential_id": thread_id}
+    else:
+        store = {"comment": "storing credential"}
+    (resp_status, resp_text) = await async_agent_backchannel_POST(holder_command_url, topic, operation="store", id=thread_id, data=store)
+    assert resp_status == 200, f'resp_status {resp_status} is not 200; {resp_text}'
+    resp_json = json.loads(resp_text)
+    if topic == "issue-credential":
+        return resp_json["credential_id"]
+    return resp_json["cred_ex_record"]["cred_id_stored"]
+
+
+def selected_credentials(context) -> dict:
+    """
+    The non revocable indy credentials the selected proof scenarios have the prover hold,
+    (issuer, holder, schema tag, credential data) -> issue credential topic.
+    """
+    credentials = {}
+    for feature in context._runner.features:
+        topic = next((CREDENTIAL_POOL_FEATURES[tag] for tag in feature.tags if tag in CREDENTIAL_POOL_FEATURES), None)
+        if topic is None:
+            continue
+        for scenario in feature.walk_scenarios():
+            tags = scenario.effective_tags
+            if not scenario.should_run(context.config) or any(tag.startswith("CredFormat_JSON-LD") for tag in tags):
+                continue
+            schema_tags = [tag for tag in tags if tag.startswith("Schema_")]
+            for step in scenario.all_steps:
+                match = CREDENTIAL_STEP.search(step.name)
+                if match is None:
+                    continue
+                (holder, issuer, credential_data) = match.groups()
+                for tag in schema_tags:
+                    credentials.setdefault((issuer, holder, tag, credential_data), topic)
+    return credentials
+
+
+def prepare_credentials(context):
+    """
+    Issue the credentials of the selected proof scenarios up front, concurrently across
+    issuer and holder pairs, each pair over one new connection.
+    """
+    if FIXTURE_CACHE == "off":
+        print("CREDENTIAL_POOL=eager needs the schema and credential definition fixtures, FIXTURE_CACHE is off")
+        return
+
+    # (issuer url, holder url) -> [(topic, schema tag, credential data)]
+    pairs = {}
+    for ((issuer, holder, tag, credential_data), topic) in selected_credentials(context).items():
+        (issuer_url, holder_url) = (context.config.userdata.get(issuer), context.config.userdata.get(holder))
+        if issuer_url and holder_url:
+            pairs.setdefault((issuer_url, holder_url), []).append((topic, tag, credential_data))
+    if not pairs:
+        return
+
+    async def issue_all(issuer_url, holder_url, credentials):
+        try:
+            (issuer_connection_id, _) = await connect_agents(issuer_url, holder_url)
+            (resp_status, resp_text) = await async_agent_backchannel_GET(issuer_url + "/agent/command/", "did")
+            assert resp_status == 200, f'resp_status {resp_status} is not 200; {resp_text}'
+            issuer_did = json.loads(resp_text)["did"]
+        except Exception as e:
+            print(f"Could not connect {issuer_url} and {holder_url} for the credential pool: {e}")
+            return
+        for (topic, tag, credential_data) in credentials:
+            try:
+                schema_json = get_test_data(tag.lower())
+                if schema_json["cred_def_support_revocation"]:
+                    continue
+                credential_data_json = get_test_data("cred_data_" + tag.lower())[credential_data]
+                key = issuer_fixture_key(issuer_url, schema_json["schema"], False)
+                if key not in issuer_fixtures:
+                    issuer_fixtures[key] = await create_issuer_fixture(issuer_url, schema_json["schema"], False)
+                fixture = issuer_fixtures[key]
+                runtime = {
+                    "cred_def_id": fixture["cred_def_id"],
+                    "schema_id": fixture["schema_id"],
+                    "issuer_did": issuer_did,
+                    "schema_issuer_did": issuer_did,
+                }
+                if "indy" in credential_data_json.get("filters", {}):
+                    indy_filter = render_test_data(credential_data_json["filters"]["indy"], lambda name, _: runtime[name])
+                else:
+                    indy_filter = dict(runtime)
+                credential_id = await issue_credential(
+                    topic, issuer_url, holder_url, issuer_connection_id, credential_data_json["attributes"], {"indy": indy_filter}
+                )
+                pool_credential(issuer_url, holder_url, fixture["cred_def_id"], credential_data, credential_id)
+            except Exception as e:
+                # left to the scenarios, which issue the credential themselves
+                print(f"Could not pre-issue {credential_data} ({tag}) from {issuer_url} to {holder_url}: {e}")
+
+    async def issue_pairs():
+        await asyncio.gather(*(issue_all(issuer_url, holder_url, credentials) for ((issuer_url, holder_url), credentials) in pairs.items()))
+
+    start = default_timer()
+    run_on_client_loop(issue_pairs())
+    wanted = sum(len(credentials) for credentials in pairs.values())
+    print(f"Pre-issued {len(credential_pool)} of {wanted} credentials in {default_timer() - start:.1f}s")
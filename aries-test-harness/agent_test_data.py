@@ -0,0 +1,436 @@
+"""
+Registry of the test data in features/data: schemas, credential data, proof
+requests, presentations and proposals.
+
+Every file is loaded and checked once, in before_all, and the problems found
+are reported before the first scenario runs: files that are not valid JSON or
+do not have the shape the steps expect, and files or credential data the
+selected scenarios refer to that do not exist.
+
+Steps get the data with get_test_data, which hands out a copy-on-write view:
+nested dicts and lists are copied the first time they are read through the
+view, so a step can change what it got (e.g. fill in "replace_me" filters)
+without changing the data of later scenarios, and only pays for the parts it
+reads.
+
+The data files are also templates: fields that depend on the scenario, such as
+"replace_me" ids and DIDs, the credential of a "cred_type_name" or a relative
+"timestamp", are compiled into a list of slots when the file is loaded, and
+render_test_data fills the slots of a view without walking the rest of the data.
+"""
+import json
+import os
+import re
+from collections import namedtuple
+
+from agent_test_utils import get_relative_timestamp_to_epoch
+
+DATA_FOLDER = "features/data"
+
+# data file names in step text once the outline placeholders are filled in
+DATA_NAME = re.compile(r"\b((?:proof_request|presentation|proposal)_[\w.\-]*\w)")
+# credential data profiles in step text, e.g. Data_DL_MaxValues
+CREDENTIAL_DATA_NAME = re.compile(r"\b(Data_\w+)")
+
+# file name (without .json) -> data
+test_data = {}
+# file name -> problems with the file
+data_problems = {}
+# file name -> slots of the file by path, see compile_template
+templates = {}
+
+
+class DataView(dict):
+    """
+    A dict of test data that copies its nested dicts and lists when they are first read.
+
+    Reads through dict(view) see the nested data as loaded, which is the same
+    until it is changed through the view.
+    """
+
+    def __init__(self, data=(), origin=None):
+        super().__init__(data)
+        # the nested data still shared with the registry
+        self._shared = {id(value) for value in super().values() if type(value) in (dict, list)}
+        # (file name, path) of the data in the registry, for render_test_data
+        self._origin = origin
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        if id(value) in self._shared:
+            value = _view(value, _child_origin(self, key))
+            super().__setitem__(key, value)
+        return value
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            super().__setitem__(key, default)
+        return self[key]
+
+    def pop(self, key, *default):
+        value = super().pop(key, *default)
+        return _view(value, _child_origin(self, key)) if id(value) in self._shared else value
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def copy(self):
+        return DataView(self, self._origin)
+
+
+class DataList(list):
+    """
+    A list of test data that copies its nested dicts and lists when they are first read.
+    """
+
+    def __init__(self, data=(), origin=None):
+        super().__init__(data)
+        self._shared = {id(value) for value in super().__iter__() if type(value) in (dict, list)}
+        self._origin = origin
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return DataList(self[i] for i in range(*index.indices(len(self))))
+        value = super().__getitem__(index)
+        if id(value) in self._shared:
+            value = _view(value, _child_origin(self, index % len(self)))
+            super().__setitem__(index, value)
+        return value
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def pop(self, index=-1):
+        value = super().pop(index)
+        return _view(value) if id(value) in self._shared else value
+
+    def copy(self):
+        return DataList(self, self._origin)
+
+
+def _view(value, origin=None):
+    if type(value) is dict:
+        return DataView(value, origin)
+    if type(value) is list:
+        return DataList(value, origin)
+    return value
+
+
+def _child_origin(view, key):
+    if view._origin is None:
+        return None
+    (name, path) = view._origin
+    return (name, path + (key,))
+
+
+######################################################################
+# validation
+######################################################################
+
+def _check_keys(data, required, where):
+    if not isinstance(data, dict):
+        return [f"{where} is not an object"]
+    problems = []
+    for (key, kind) in required.items():
+        if key not in data:
+            problems.append(f"{where} has no {key}")
+        elif not isinstance(data[key], kind):
+            problems.append(f"{where}.{key} is not {'an object' if kind is dict else 'a list' if kind is list else 'a ' + kind.__name__}")
+    return problems
+
+
+def check_schema(data):
+    problems = _check_keys(data, {"schema": dict, "cred_def_support_revocation": bool}, "the file")
+    if isinstance(data, dict) and isinstance(data.get("schema"), dict):
+        problems.extend(_check_keys(data["schema"], {"schema_name": str, "schema_version": str, "attributes": list}, "schema"))
+    return problems
+
+
+def check_credential_data(data, schema=None):
+    if not isinstance(data, dict):
+        return ["the file is not an object"]
+    problems = []
+    attributes = None
+    if isinstance(schema, dict) and isinstance(schema.get("schema"), dict):
+        attributes = set(schema["schema"].get("attributes") or ())
+    for (name, profile) in data.items():
+        problems.extend(_check_keys(profile, {"attributes": list}, name))
+        if not isinstance(profile, dict) or not isinstance(profile.get("attributes"), list):
+            continue
+        if not all(isinstance(attribute, dict) and "name" in attribute and "value" in attribute for attribute in profile["attributes"]):
+            problems.append(f"{name}.attributes are not all name and value pairs")
+        elif attributes is not None:
+            names = {attribute["name"] for attribute in profile["attributes"]}
+            if names != attributes:
+                problems.append(f"{name}.attributes {sorted(names)} are not the schema attributes {sorted(attributes)}")
+        if "filters" in profile and not isinstance(profile["filters"], dict):
+            problems.append(f"{name}.filters is not an object")
+    return problems
+
+
+def check_proof_request(data):
+    problems = _check_keys(data, {"presentation_proposal": dict}, "the file")
+    if not problems:
+        problems.extend(_check_keys(data["presentation_proposal"], {"requested_attributes": dict}, "presentation_proposal"))
+    return problems
+
+
+def check_presentation(data):
+    problems = _check_keys(data, {"presentation": dict}, "the file")
+    if not problems:
+        problems.extend(_check_keys(data["presentation"], {"requested_attributes": dict}, "presentation"))
+    return problems
+
+
+def check_proposal(data):
+    problems = _check_keys(data, {"presentation_proposal": dict}, "the file")
+    if not problems:
+        problems.extend(_check_keys(data["presentation_proposal"], {"requested_attributes": list}, "presentation_proposal"))
+    return problems
+
+
+# file name prefix -> check of the file's data
+DATA_CHECKS = {
+    "schema_": check_schema,
+    "proof_request_": check_proof_request,
+    "presentation_": check_presentation,
+    "proposal_": check_proposal,
+}
+
+
+def load_test_data(folder=DATA_FOLDER) -> dict:
+    """
+    Load and check every file in the data folder, once; returns the problems found.
+    """
+    if test_data or data_problems:
+        return data_problems
+    for file_name in sorted(os.listdir(folder)):
+        (name, ext) = os.path.splitext(file_name)
+        if ext != ".json":
+            continue
+        try:
+            with open(os.path.join(folder, file_name)) as data_file:
+                test_data[name] = json.load(data_file)
+        except (OSError, ValueError) as e:
+            data_problems[name] = [f"could not be read: {e}"]
+
+    for (name, data) in test_data.items():
+        if name.startswith("cred_data_"):
+            problems = check_credential_data(data, test_data.get(name[len("cred_data_"):]))
+        else:
+            check = next((check for (prefix, check) in DATA_CHECKS.items() if name.startswith(prefix)), None)
+            problems = check(data) if check else []
+        if problems:
+            data_problems[name] = problems
+        templates[name] = compile_template(name, data)
+    return data_problems
+
+
+def get_test_data(name) -> DataView:
+    """
+    A copy-on-write view of the data in features/data/<name>.json.
+    """
+    load_test_data()
+    if name not in test_data:
+        path = os.path.join(DATA_FOLDER, name + ".json")
+        if name in data_problems:
+            raise ValueError(f"{path} {'; '.join(data_problems[name])}")
+        raise FileNotFoundError(f"No test data file {path}")
+    return _view(test_data[name], (name, ()))
+
+
+######################################################################
+# templates
+######################################################################
+
+# a field to fill in at path (a tuple of keys and list indexes) with the value of
+# the slot name for arg, or to remove from the data when name is None
+Slot = namedtuple("Slot", "path key name arg")
+
+REPLACE_ME = ("replace_me", "replace me")
+
+# field -> slot, for fields that are "replace_me"
+REPLACE_ME_SLOTS = {
+    "cred_def_id": "cred_def_id",
+    "schema_id": "schema_id",
+    "issuer_did": "issuer_did",
+    "schema_issuer_did": "issuer_did",
+    "issuer": "issuer_did",
+    "proofType": "proof_type",
+    "cred_id": "cred_id",
+}
+
+# fields of an object with a cred_type_name that are filled in for the credential of that type
+CRED_TYPE_SLOTS = ("cred_def_id", "cred_id")
+
+# file name prefix -> slots filled in when they have a value, e.g. the non-revoked interval of a proof request
+OPTIONAL_SLOTS = {
+    "proof_request_": (Slot(("presentation_proposal",), "non_revoked", "non_revoked", None),),
+}
+
+
+def compile_template(name, data) -> list:
+    """
+    The slots of the data of a features/data file, as (path, slots at path) in the order they are filled in.
+    """
+    slots = [slot for (prefix, optional) in OPTIONAL_SLOTS.items() if name.startswith(prefix) for slot in optional]
+
+    def walk(value, path):
+        if type(value) is list:
+            for (index, item) in enumerate(value):
+                walk(item, path + (index,))
+            return
+        if type(value) is not dict:
+            return
+        cred_type_name = value.get("cred_type_name")
+        for (key, item) in value.items():
+            if cred_type_name is not None and key in CRED_TYPE_SLOTS:
+                slots.append(Slot(path, key, key, cred_type_name))
+            elif key == "timestamp" and isinstance(item, str):
+                slots.append(Slot(path, key, "timestamp", item))
+            elif item in REPLACE_ME and key in REPLACE_ME_SLOTS:
+                slots.append(Slot(path, key, REPLACE_ME_SLOTS[key], None))
+            elif item in REPLACE_ME and key == "id" and path[-1:] == ("issuer",):
+                slots.append(Slot(path, key, "issuer_did", None))
+            else:
+                walk(item, path + (key,))
+        if cred_type_name is not None:
+            slots.append(Slot(path, "cred_type_name", None, None))
+
+    walk(data, ())
+    paths = {}
+    for slot in slots:
+        paths.setdefault(slot.path, []).append(slot)
+    return list(paths.items())
+
+
+def _schema_name(context):
+    return context.schema["schema_name"]
+
+
+def _cred_def_id(context, cred_type_name):
+    if cred_type_name is not None:
+        return context.credential_definition_id_dict[cred_type_name]
+    return context.issuer_credential_definition_dict[_schema_name(context)]["id"]
+
+
+def _cred_id(context, cred_type_name):
+    return context.credential_id_dict[cred_type_name or _schema_name(context)][-1]
+
+
+def _non_revoked(context, _):
+    if "non_revoked_timeframe" in context:
+        return context.non_revoked_timeframe["non_revoked"]
+    return None
+
+
+# slot name -> value of the slot in a scenario, from the context and the slot's arg
+SLOT_VALUES = {
+    "issuer_did": lambda context, _: context.issuer_did_dict[_schema_name(context)],
+    "cred_def_id": _cred_def_id,
+    "schema_id": lambda context, _: context.issuer_schema_dict[_schema_name(context)]["id"],
+    "cred_id": _cred_id,
+    "proof_type": lambda context, _: context.proof_type,
+    "timestamp": lambda context, timestamp: get_relative_timestamp_to_epoch(timestamp),
+    "non_revoked": _non_revoked,
+}
+
+
+def scenario_values(context):
+    """
+    The slot values of the scenario, for render_test_data.
+    """
+    return lambda name, arg: SLOT_VALUES[name](context, arg)
+
+
+def _container(containers, path):
+    container = containers.get(path)
+    if container is None:
+        container = containers[path] = _container(containers, path[:-1])[path[-1]]
+    return container
+
+
+def render_test_data(data, values):
+    """
+    Fill in the slots of a view from get_test_data, in place, with values(slot name, arg);
+    slots whose value is None are left out. Only the objects on the way to a slot
+    are copied from the registry.
+    """
+    if not isinstance(data, (DataView, DataList)):
+        # the slots are found from where the data was loaded, which a plain dict or list doesn't record
+        raise TypeError(f"render_test_data needs data from get_test_data, not a {type(data).__name__}")
+    if data._origin is None:
+        return data
+    (name, path) = data._origin
+    depth = len(path)
+    # path -> the view of the object at path
+    containers = {path: data}
+    for (slot_path, slots) in templates.get(name, ()):
+        if slot_path[:depth] != path:
+            continue
+        container = _container(containers, slot_path)
+        for slot in slots:
+            if slot.name is None:
+                container.pop(slot.key, None)
+                continue
+            value = values(slot.name, slot.arg)
+            if value is not None:
+                container[slot.key] = value
+    return data
+
+
+def scenario_data_problems(scenario) -> list:
+    """
+    The missing or broken data files and credential data the scenario refers to.
+    """
+    names = set()
+    credential_data = set()
+    for tag in scenario.effective_tags:
+        if tag.startswith("Schema_"):
+            names.add(tag.lower())
+    for step in scenario.all_steps:
+        names.update(DATA_NAME.findall(step.name))
+        credential_data.update(CREDENTIAL_DATA_NAME.findall(step.name))
+    if credential_data:
+        names.update("cred_data_" + name for name in list(names) if name.startswith("schema_"))
+
+    problems = []
+    for name in sorted(names):
+        if name in data_problems:
+            problems.extend(f"{name}.json: {problem}" for problem in data_problems[name])
+        elif name not in test_data:
+            problems.append(f"{name}.json does not exist")
+        elif name.startswith("cred_data_"):
+            problems.extend(
+                f"{name}.json has no {profile}" for profile in sorted(credential_data) if profile not in test_data[name]
+            )
+    return problems
+
+
+def report_data_problems(context):
+    """
+    Load the test data and print its problems, and those of the selected scenarios' data.
+    """
+    load_test_data()
+    selected = {}
+    for feature in context._runner.features:
+        for scenario in feature.walk_scenarios():
+            if scenario.should_run(context.config):
+                for problem in scenario_data_problems(scenario):
+                    selected.setdefault(problem, []).append(f"{scenario.location.filename}:{scenario.location.line}")
+
+    for (name, problems) in data_problems.items():
+        for problem in problems:
+            if f"{name}.json: {problem}" not in selected:
+                print(f"Test data problem: {name}.json: {problem}")
+    for (problem, locations) in selected.items():
+        print(f"Test data problem: {problem}, needed by {', '.join(locations[:3])}{' and others' if len(locations) > 3 else ''}")
+    if selected:
+        print(f"{len(selected)} test data problems in the selected scenarios, which will fail")
@@ -56,8 +56,6 @@ def format_cred_proposal_by_aip_version(context, aip_version, cred_data, connect
 
     if aip_version == "AIP20":
 
-        filters = amend_filters_with_runtime_data(context, filters)
-
         # credential_proposal = {
         #     "connection_id": connection_id,
         #     "credential_preview": {
@@ -76,35 +74,3 @@ def format_cred_proposal_by_aip_version(context, aip_version, cred_data, connect
         }
 
     return credential_proposal
-
-def amend_filters_with_runtime_data(context, filters):
-    # This method will need comdification as new types of filters are used. Intially "indy" is used.
-    if "indy" in filters:
-        if "schema_issuer_did" in filters["indy"] and filters["indy"]["schema_issuer_did"] == "replace_me":
-            filters["indy"]["schema_issuer_did"] = context.issuer_did_dict[context.schema['schema_name']]
-        if "issuer_did" in filters["indy"] and filters["indy"]["issuer_did"] == "replace_me":
-            filters["indy"]["issuer_did"] = context.issuer_did_dict[context.schema['schema_name']]
-        if "cred_def_id" in filters["indy"] and filters["indy"]["cred_def_id"] == "replace_me":
-            filters["indy"]["cred_def_id"] = context.issuer_credential_definition_dict[context.schema['schema_name']]["id"]
-        if "schema_id" in filters["indy"] and filters["indy"]["schema_id"] == "replace_me":
-            filters["indy"]["schema_id"] = context.issuer_schema_dict[context.schema['schema_name']]["id"]
-
-    if "json-ld" in filters:
-        json_ld = filters.get("json-ld")
-        credential = json_ld.get("credential")
-        options = json_ld.get("options")
-
-        issuer = context.issuer_did_dict[context.schema['schema_name']]
-
-        if "issuer" in credential:
-            # "issuer": "replace_me"
-            if credential.get("issuer") == "replace_me":
-                credential["issuer"] = issuer
-            # "issuer": { "id": "replace_me" }
-            elif credential.get("issuer", {}).get("id") == "replace_me":
-                credential["issuer"]["id"] = issuer
-        if options.get("proofType") == "replace_me":
-            options["proofType"] = context.proof_type
-
-
-    return filters
@@ -0,0 +1,98 @@
+"""
+Per-call latency of the harness backchannel client against a local stub
+backchannel: a new event loop, session and connection per call (as the
+client used to work) versus the shared client loop with a pooled keep-alive
+session per agent.
+
+Run from the aries-test-harness folder:
+
+    python -m benchmarks.bench_client [--calls 500]
+"""
+import argparse
+import asyncio
+import socket
+import statistics
+import threading
+from timeit import default_timer
+
+from aiohttp import ClientSession, web
+
+from agent_backchannel_client import agent_backchannel_GET, close_client_loop, run_coroutine_with_kwargs
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_stub_backchannel(port):
+    async def get_command(request):
+        return web.json_response({"connection_id": request.match_info["id"], "state": "complete"})
+
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+
+    async def serve():
+        app = web.Application()
+        app.add_routes([web.get("/agent/command/{topic}/{id}", get_command)])
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        ready.set()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(serve())
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait()
+
+
+async def unpooled_request(method, path):
+    # the request path before the shared client loop
+    client_session = ClientSession()
+    async with client_session.request(method, path) as resp:
+        resp_status = resp.status
+        resp_text = await resp.text()
+        await client_session.close()
+        return (resp_status, resp_text)
+
+
+def unpooled_GET(url, topic, id):
+    return run_coroutine_with_kwargs(unpooled_request, "GET", url + topic + "/" + id)
+
+
+def time_calls(call, calls):
+    samples = []
+    for i in range(calls):
+        start = default_timer()
+        (status, _) = call()
+        samples.append(default_timer() - start)
+        assert status == 200, status
+    return samples
+
+
+def report(label, samples):
+    samples = sorted(samples)
+    p95 = samples[int(len(samples) * 0.95)]
+    print(f"{label:<36} median {statistics.median(samples) * 1000:7.3f} ms  p95 {p95 * 1000:7.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the harness backchannel client")
+    parser.add_argument("--calls", type=int, default=500, help="Calls per measurement")
+    args = parser.parse_args()
+
+    port = free_port()
+    start_stub_backchannel(port)
+    url = f"http://127.0.0.1:{port}/agent/command/"
+
+    report("new loop + session per call", time_calls(lambda: unpooled_GET(url, "connection", "c1"), args.calls))
+    report("client loop + pooled session", time_calls(lambda: agent_backchannel_GET(url, "connection", id="c1"), args.calls))
+    close_client_loop()
+
+
+if __name__ == "__main__":
+    main()
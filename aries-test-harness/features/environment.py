@@ -6,8 +6,27 @@
 #  
 # -----------------------------------------------------------
 import json
+import time
+from agent_backchannel_client import start_trace, trace_span, merge_traces, start_cassette_scenario, TRACE_DIR
+from agent_fixtures import FIXTURE_CACHE, CREDENTIAL_POOL, prepare_issuer_fixtures, prepare_credentials
+from agent_test_data import get_test_data, report_data_problems
+
+def before_all(context):
+    # Load and check the files in features/data once, reporting missing or malformed data before the first scenario
+    report_data_problems(context)
+    # Schemas and credential definitions of the selected scenarios, created before the first scenario, see agent_fixtures.py
+    if FIXTURE_CACHE == "eager":
+        prepare_issuer_fixtures(context)
+    # Credentials the selected proof scenarios need the prover to hold
+    if CREDENTIAL_POOL == "eager":
+        prepare_credentials(context)
 
 def before_scenario(context, scenario):
+
+    # Requests to the backchannels during this scenario share one trace id, see TRACE_DIR
+    start_trace()
+    # Recorded or replayed backchannel traffic is keyed by scenario, see BACKCHANNEL_RECORD
+    start_cassette_scenario(scenario.name)
     
     # Check if the scenario has an issue associated
     for tag in context.tags:
@@ -48,8 +67,7 @@ def before_scenario(context, scenario):
                 if 'Schema_' in tag:
                     # Get and assign the scehma to the context
                     try:
-                        schema_json_file = open('features/data/' + tag.lower() + '.json')
-                        schema_json = json.load(schema_json_file)
+                        schema_json = get_test_data(tag.lower())
 
                         # If this is issue credential then you can't created multiple credential defs at the same time, like Proof uses
                         # mulitple crdential types in the proof. So just set the context.schema here to be used in the issue cred test.
@@ -68,11 +86,24 @@ def before_scenario(context, scenario):
                             context.schema_dict = {tag: schema_json["schema"]}
                             context.support_revocation_dict = {tag: schema_json["cred_def_support_revocation"]}
 
-                    except FileNotFoundError:
-                        print('FileNotFoundError: features/data/' + tag.lower + '.json')
-                    
-                    
+                    except FileNotFoundError as e:
+                        print(e)
+
+
+def after_step(context, step):
+    if TRACE_DIR:
+        end = time.time()
+        trace_span(step.keyword + " " + step.name, "step", end - step.duration, end, status=str(step.status))
 
 
+def after_scenario(context, scenario):
+    if TRACE_DIR:
+        end = time.time()
+        trace_span(scenario.name, "scenario", end - scenario.duration, end, status=str(scenario.status))
 
 
+def after_all(context):
+    # one file with the harness and backchannel spans of the whole run, for chrome://tracing or Perfetto
+    merged = merge_traces()
+    if merged:
+        print("Trace written to", merged)
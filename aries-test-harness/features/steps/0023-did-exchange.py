@@ -6,12 +6,16 @@
 #
 # Current AIP version level of test coverage: N/A
 # Current DID Exchange version level of test coverage 1.0
+#
+# These steps are the exchange under test, so they never take a connection
+# from the CONNECTION_POOL. Other features get a pooled DID exchange
+# connection from "have an existing connection" in 0160-connection.py.
 #  
 # -----------------------------------------------------------
 
 from behave import given, when, then
-import json, time
-from agent_backchannel_client import agent_backchannel_GET, agent_backchannel_POST, expected_agent_state
+import json
+from agent_backchannel_client import agent_backchannel_GET, agent_backchannel_POST, expected_agent_state, client_pause
 
 
 @when('"{responder}" sends an explicit invitation')
@@ -216,7 +220,7 @@ def step_impl(context, responder):
     if context.requester_name not in context.connection_id_dict[responder]:
         # One way (maybe preferred) to get the connection id is to get it from the probable webhook that the controller gets because of the previous step
         invitation_id = context.responder_invitation["@id"]
-        time.sleep(0.5) # delay for webhook to execute
+        client_pause(0.5) # delay for webhook to execute
         (resp_status, resp_text) = agent_backchannel_GET(responder_url + "/agent/response/", "did-exchange", id=invitation_id) # {}
         assert resp_status == 200, f'resp_status {resp_status} is not 200; {resp_text}'
         resp_json = json.loads(resp_text)
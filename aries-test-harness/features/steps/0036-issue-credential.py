@@ -1,8 +1,8 @@
 from behave import *
 import json
-from agent_backchannel_client import agent_backchannel_GET, agent_backchannel_POST, expected_agent_state
+from agent_backchannel_client import agent_backchannel_GET, agent_backchannel_POST, expected_agent_state, client_pause
 from agent_test_utils import format_cred_proposal_by_aip_version
-from time import sleep
+from agent_fixtures import get_issuer_fixture, use_issuer_fixture
 import time
 
 # This step is defined in another feature file
@@ -53,12 +53,38 @@ def step_impl(context, issuer):
 def step_impl(context, issuer):
     # TODO remove these references to schema and cred def, move them to one call to the API and let the Backchannel take care of
     # what to do to be ready to issie a credential
-    context.execute_steps('''
-      When "''' + issuer + '''" creates a new schema
-       And "''' + issuer + '''" creates a new credential definition
-      Then "''' + issuer + '''" has an existing schema
-       And "''' + issuer + '''" has an existing credential definition
-    ''')
+    support_revocation = context.support_revocation if "support_revocation" in context else CRED_DEF_TEMPLATE["support_revocation"]
+    if not use_issuer_fixture(support_revocation):
+        context.execute_steps('''
+          When "''' + issuer + '''" creates a new schema
+           And "''' + issuer + '''" creates a new credential definition
+          Then "''' + issuer + '''" has an existing schema
+           And "''' + issuer + '''" has an existing credential definition
+        ''')
+        return
+
+    # the schema and credential definition are created once per run and issuer, see agent_fixtures.py
+    issuer_url = context.config.userdata.get(issuer)
+    if "schema" not in context:
+        context.schema = SCHEMA_TEMPLATE.copy()
+        context.schema["schema_name"] = context.schema["schema_name"] + issuer
+
+    fixture = get_issuer_fixture(issuer_url, context.schema, support_revocation)
+    if "support_revocation" in context:
+        # as when the scenario creates its own credential definition, non_revoked intervals start from here
+        context.cred_rev_creation_time = time.time()
+
+    schema_name = context.schema['schema_name']
+    for (dict_name, value) in (
+        ("issuer_schema_id_dict", fixture["schema_id"]),
+        ("credential_definition_id_dict", fixture["cred_def_id"]),
+        ("issuer_schema_dict", fixture["schema"]),
+        ("issuer_credential_definition_dict", fixture["cred_def"]),
+    ):
+        if dict_name in context:
+            getattr(context, dict_name)[schema_name] = value
+        else:
+            setattr(context, dict_name, {schema_name: value})
 
 @when('"{issuer}" creates a new schema')
 def step_impl(context, issuer):
@@ -266,12 +292,12 @@ def step_impl(context, holder):
     # reveived the thread_id.
     #if "Indy" in context.tags:
     if "cred_thread_id" in context:
-        sleep(1)
+        client_pause(1)
         (resp_status, resp_text) = agent_backchannel_POST(holder_url + "/agent/command/", "issue-credential", operation="send-request", id=context.cred_thread_id)
 
     # If we are starting from here in the protocol you won't have the cred_ex_id or the thread_id
     else:
-        sleep(1)
+        client_pause(1)
         (resp_status, resp_text) = agent_backchannel_POST(holder_url + "/agent/command/", "issue-credential", operation="send-request", id=context.connection_id_dict[holder][context.issuer_name])
     
     assert resp_status == 200, f'resp_status {resp_status} is not 200; {resp_text}'
@@ -307,7 +333,7 @@ def step_impl(context, issuer):
     assert resp_json["state"] == "credential-issued"
 
     # Verify holder status
-    sleep(1.0)
+    client_pause(1.0)
     assert expected_agent_state(context.holder_url, "issue-credential", context.cred_thread_id, "credential-received")
 
 
@@ -322,7 +348,7 @@ def step_impl(context, holder):
     }
 
     # (resp_status, resp_text) = agent_backchannel_POST(holder_url + "/agent/command/", "credential", operation="store", id=context.holder_cred_ex_id)
-    sleep(1)
+    client_pause(1)
     (resp_status, resp_text) = agent_backchannel_POST(holder_url + "/agent/command/", "issue-credential", operation="store", id=context.cred_thread_id, data=credential_id)
     assert resp_status == 200, f'resp_status {resp_status} is not 200; {resp_text}'
     resp_json = json.loads(resp_text)
@@ -1,7 +1,8 @@
 from behave import *
 import json
 from agent_backchannel_client import agent_backchannel_GET, agent_backchannel_POST, expected_agent_state
-from agent_test_utils import get_relative_timestamp_to_epoch
+from agent_fixtures import add_credential_to_pool, pooled_credential
+from agent_test_data import get_test_data, render_test_data, scenario_values
 from time import sleep
 
 @when('{issuer} issues a new credential to "{prover}" with {credential_data}')
@@ -21,17 +22,9 @@ def step_impl(context, prover, issuer, credential_data):
         if "schema_dict" in context:
             for schema in context.schema_dict:
                 if 'credential_data_dict' in context:
-                    try:
-                        credential_data_json_file = open('features/data/cred_data_' + schema.lower() + '.json')
-                        context.credential_data_dict[schema] = json.load(credential_data_json_file)[credential_data]['attributes']
-                    except FileNotFoundError:
-                        print(FileNotFoundError + ': features/data/cred_data_' + schema.lower() + '.json')
+                    context.credential_data_dict[schema] = get_test_data('cred_data_' + schema.lower())[credential_data]['attributes']
                 else:
-                    try:
-                        credential_data_json_file = open('features/data/cred_data_' + schema.lower() + '.json')
-                        context.credential_data_dict = {schema: json.load(credential_data_json_file)[credential_data]['attributes']}
-                    except FileNotFoundError:
-                        print(FileNotFoundError + ': features/data/cred_data_' + schema.lower() + '.json')
+                    context.credential_data_dict = {schema: get_test_data('cred_data_' + schema.lower())[credential_data]['attributes']}
 
         #         context.schema_dict[tag] = schema_json["schema"]
         #         context.support_revocation_dict[tag] = schema_json["cred_def_support_revocation"]
@@ -40,6 +33,9 @@ def step_impl(context, prover, issuer, credential_data):
         #     context.support_revocation_dict = {tag: schema_json["cred_def_support_revocation"]}
 
 
+    # Credentials with the same data from the same issuer can be pooled, see CREDENTIAL_POOL in agent_fixtures.py
+    context.credential_data_name = credential_data
+
     # Call the step below to get the credential issued.
     context.execute_steps('''
         Given "''' + prover + '''" has an issued credential from {issuer}
@@ -62,10 +58,7 @@ def step_impl(context, prover, issuer):
     if 'schema_dict' not in context:
         context.execute_steps('''
         Given "''' + issuer + '''" has a public did
-        When "''' + issuer + '''" creates a new schema
-        And "''' + issuer + '''" creates a new credential definition
-        Then "''' + issuer + '''" has an existing schema
-        And "''' + issuer + '''" has an existing credential definition
+        And "''' + issuer + '''" is ready to issue a credential
         ''')
     else:
         for schema in context.schema_dict:
@@ -73,10 +66,7 @@ def step_impl(context, prover, issuer):
             context.schema = context.schema_dict[schema]
             context.execute_steps('''
             Given "''' + issuer + '''" has a public did
-            When "''' + issuer + '''" creates a new schema
-            And "''' + issuer + '''" creates a new credential definition
-            Then "''' + issuer + '''" has an existing schema
-            And "''' + issuer + '''" has an existing credential definition
+            And "''' + issuer + '''" is ready to issue a credential
             ''')
 
     # setup the holder and issuer for the issue cred sceneario below. The data table in the tests does not setup a holder.
@@ -111,6 +101,8 @@ def step_impl(context, prover, issuer):
         for schema in context.schema_dict:
             context.credential_data = context.credential_data_dict[schema]
             context.schema = context.schema_dict[schema]
+            if pooled_credential(context, schema, "issue-credential"):
+                continue
             context_steps = context_steps_start + ''' "''' + issuer + '''" offers a credential
                 And "''' + prover + '''" requests the credential
                 And  "''' + issuer + '''" issues the credential
@@ -118,6 +110,7 @@ def step_impl(context, prover, issuer):
                 Then "''' + prover + '''" has the credential issued
             '''
             context.execute_steps(context_steps)
+            add_credential_to_pool(context, schema, "issue-credential")
     
 
 @when('"{verifier}" sends a request for proof presentation to "{prover}"')
@@ -125,9 +118,8 @@ def step_impl(context, verifier, prover):
 
     # check for a schema template already loaded in the context. If it is, it was loaded from an external Schema, so use it.
     if "request_for_proof" in context:
-        data = context.request_for_proof
-        if "non_revoked_timeframe" in context:
-             data["non_revoked"] = context.non_revoked_timeframe["non_revoked"]
+        # add the non-revoked interval of a revocation scenario, see agent_test_data.py
+        data = render_test_data(context.request_for_proof, scenario_values(context))
     else:   
         data = {
                     "requested_attributes": {
@@ -204,13 +196,7 @@ def step_impl(context, verifier, prover):
 @when('"{verifier}" agrees with the proposal so sends a {request_for_proof} presentation to "{prover}"')
 @when('"{verifier}" sends a {request_for_proof} presentation to "{prover}"')
 def step_impl(context, verifier, request_for_proof, prover):
-    try:
-        request_for_proof_json_file = open('features/data/' + request_for_proof + '.json')
-        request_for_proof_json = json.load(request_for_proof_json_file)
-        context.request_for_proof = request_for_proof_json["presentation_proposal"]
-
-    except FileNotFoundError:
-        print(FileNotFoundError + ': features/data/' + request_for_proof + '.json')
+    context.request_for_proof = get_test_data(request_for_proof)["presentation_proposal"]
 
     # Call the step below to get send rhe request for presentation.
     context.execute_steps('''
@@ -223,35 +209,8 @@ def step_impl(context, prover):
 
     if "presentation" in context:
         presentation = context.presentation
-        # Find the cred ids and add the actual cred id into the presentation
-        # TODO: There is probably a better way to get access to the specific requested attributes and predicates. Revisit this later.
-        try:
-            for i in range(json.dumps(presentation["requested_attributes"]).count("cred_id")):
-                # Get the schema name from the loaded presentation for each requested attributes
-                cred_type_name = presentation["requested_attributes"][list(presentation["requested_attributes"])[i]]["cred_type_name"]
-                presentation["requested_attributes"][list(presentation["requested_attributes"])[i]]["cred_id"] = context.credential_id_dict[cred_type_name][len(context.credential_id_dict[cred_type_name])-1]
-                # If there is a timestamp, calculate it from the instruction in the file. Can be 'now' or + - relative to now.
-                if ("timestamp" in presentation["requested_attributes"][list(presentation["requested_attributes"])[i]]):
-                    relative_timestamp = presentation["requested_attributes"][list(presentation["requested_attributes"])[i]]["timestamp"]
-                    presentation["requested_attributes"][list(presentation["requested_attributes"])[i]]["timestamp"] = get_relative_timestamp_to_epoch(relative_timestamp)
-                # Remove the cred_type_name from this part of the presentation since it won't be needed in the actual request.
-                presentation["requested_attributes"][list(presentation["requested_attributes"])[i]].pop("cred_type_name")
-        except KeyError:
-            pass
-        
-        try:
-            for i in range(json.dumps(presentation["requested_predicates"]).count("cred_id")):
-                # Get the schema name from the loaded presentation for each requested predicates
-                cred_type_name = presentation["requested_predicates"][list(presentation["requested_predicates"])[i]]["cred_type_name"]
-                presentation["requested_predicates"][list(presentation["requested_predicates"])[i]]["cred_id"] = context.credential_id_dict[cred_type_name][len(context.credential_id_dict[cred_type_name])-1] 
-                # If there is a timestamp, calculate it from the instruction in the file. Can be 'now' or + - relative to now.
-                if ("timestamp" in presentation["requested_predicates"][list(presentation["requested_predicates"])[i]]):
-                    relative_timestamp = presentation["requested_predicates"][list(presentation["requested_predicates"])[i]]["timestamp"]
-                    presentation["requested_predicates"][list(presentation["requested_predicates"])[i]]["timestamp"] = get_relative_timestamp_to_epoch(relative_timestamp)
-                # Remove the cred_type_name from this part of the presentation since it won't be needed in the actual request.
-                presentation["requested_predicates"][list(presentation["requested_predicates"])[i]].pop("cred_type_name")
-        except KeyError:
-            pass
+        # Fill in the cred ids of the cred_type_names and the relative timestamps, see agent_test_data.py
+        render_test_data(presentation, scenario_values(context))
 
     else:   
         presentation = {
@@ -284,13 +243,7 @@ def step_impl(context, prover):
 
 @when('"{prover}" makes the {presentation} of the proof')
 def step_impl(context, prover, presentation):
-    try:
-        presentation_json_file = open('features/data/' + presentation + '.json')
-        presentation_json = json.load(presentation_json_file)
-        context.presentation = presentation_json["presentation"]
-
-    except FileNotFoundError:
-        print(FileNotFoundError + ': features/data/' + presentation + '.json')
+    context.presentation = get_test_data(presentation)["presentation"]
 
     # Call the step below to get send rhe request for presentation.
     context.execute_steps('''
@@ -428,34 +381,10 @@ def step_impl(context, verifier):
 @when('"{prover}" doesn’t want to reveal what was requested so makes a {proposal}')
 @when('"{prover}" makes a {proposal} to "{verifier}"')
 def step_impl(context, prover, proposal, verifier=None):
-    try:
-        proposal_json_file = open('features/data/' + proposal + '.json')
-        proposal_json = json.load(proposal_json_file)
-        context.presentation_proposal = proposal_json["presentation_proposal"]
-
-        # replace the cred_def_id with the actual id based on the cred type name
-        try:
-            for i in range(json.dumps(context.presentation_proposal["requested_attributes"]).count("cred_def_id")):
-                # Get the cred type name from the loaded presentation for each requested attributes
-                cred_type_name = context.presentation_proposal["requested_attributes"][i]["cred_type_name"]
-                context.presentation_proposal["requested_attributes"][i]["cred_def_id"] = context.credential_definition_id_dict[cred_type_name]
-                # Remove the cred_type_name from this part of the presentation since it won't be needed in the actual request.
-                context.presentation_proposal["requested_attributes"][i].pop("cred_type_name")
-        except KeyError:
-            pass
-        
-        try:
-            for i in range(json.dumps(context.presentation_proposal["requested_predicates"]).count("cred_def_id")):
-                # Get the schema name from the loaded presentation for each requested predicates
-                cred_type_name = context.presentation_proposal["requested_predicates"][i]["cred_type_name"]
-                context.presentation_proposal["requested_predicates"][i]["cred_def_id"] = context.credential_definition_id_dict[cred_type_name] 
-                # Remove the cred_type_name from this part of the presentation since it won't be needed in the actual request.
-                context.presentation_proposal["requested_predicates"][i].pop("cred_type_name")
-        except KeyError:
-            pass
-
-    except FileNotFoundError:
-        print(FileNotFoundError + ': features/data/' + proposal + '.json')
+    context.presentation_proposal = get_test_data(proposal)["presentation_proposal"]
+
+    # replace the cred_def_id with the actual id based on the cred type name
+    render_test_data(context.presentation_proposal, scenario_values(context))
 
     # Call the existing proposal step to make the proposal.
     context.execute_steps('''
@@ -468,13 +397,7 @@ def step_impl(context, prover, proposal, verifier=None):
 #
 @when(u'"{prover}" makes the {presentation} of the proof incorrectly so "{verifier}" rejects the proof')
 def step_impl(context, prover, presentation, verifier):
-    try:
-        presentation_json_file = open('features/data/' + presentation + '.json')
-        presentation_json = json.load(presentation_json_file)
-        context.presentation = presentation_json["presentation"]
-
-    except FileNotFoundError:
-        print(FileNotFoundError + ': features/data/' + presentation + '.json')
+    context.presentation = get_test_data(presentation)["presentation"]
 
     presentation = context.presentation
     # Find the cred ids and add the actual cred id into the presentation
@@ -10,7 +10,8 @@
 
 from behave import given, when, then
 import json
-from agent_backchannel_client import agent_backchannel_GET, agent_backchannel_POST, expected_agent_state
+from agent_backchannel_client import agent_backchannel_GET, agent_backchannel_POST, expected_agent_state, async_expected_agent_state, gather_agent_requests
+from agent_fixtures import get_pooled_connection, pool_connection, use_connection_pool
 
 @given('{n} agents')
 @given(u'we have {n} agents')
@@ -115,13 +116,12 @@ def step_impl(context, invitee):
 
     if not hasattr(context, 'connection_id_dict'):
         context.connection_id_dict = {}
-        context.connection_id_dict[invitee] = {}
     
-    context.connection_id_dict[invitee][context.inviter_name] = resp_json["connection_id"]
+    context.connection_id_dict.setdefault(invitee, {})[context.inviter_name] = resp_json["connection_id"]
 
     # Also add the inviter into the main connection_id_dict. if the len is 0 that means its already been cleared and this may be Mallory.
     if len(context.temp_connection_id_dict) != 0:
-        context.connection_id_dict[context.inviter_name] = {invitee: context.temp_connection_id_dict[context.inviter_name]}
+        context.connection_id_dict.setdefault(context.inviter_name, {})[invitee] = context.temp_connection_id_dict[context.inviter_name]
         #clear the temp connection id dict used in the initial step. We don't need it anymore.
         context.temp_connection_id_dict.clear()
 
@@ -144,8 +144,12 @@ def step_impl(context, inviter, invitee):
     invitee_connection_id = context.connection_id_dict[invitee][inviter]
 
     # get connection and verify status
-    assert expected_agent_state(inviter_url, "connection", inviter_connection_id, "requested", wait_time=60.0)
-    assert expected_agent_state(invitee_url, "connection", invitee_connection_id, "requested", wait_time=60.0)
+    (inviter_ok, invitee_ok) = gather_agent_requests(
+        async_expected_agent_state(inviter_url, "connection", inviter_connection_id, "requested", wait_time=60.0),
+        async_expected_agent_state(invitee_url, "connection", invitee_connection_id, "requested", wait_time=60.0),
+    )
+    assert inviter_ok
+    assert invitee_ok
 
     (resp_status, resp_text) = agent_backchannel_POST(inviter_url + "/agent/command/", "connection", operation="accept-request", id=inviter_connection_id)
     assert resp_status == 200, f'resp_status {resp_status} is not 200; {resp_text}'
@@ -171,8 +175,12 @@ def step_impl(context, invitee, inviter):
     inviter_connection_id = context.connection_id_dict[inviter][invitee]
 
     # get connection and verify status
-    assert expected_agent_state(invitee_url, "connection", invitee_connection_id, "invited")
-    assert expected_agent_state(inviter_url, "connection", inviter_connection_id, "invited")
+    (invitee_ok, inviter_ok) = gather_agent_requests(
+        async_expected_agent_state(invitee_url, "connection", invitee_connection_id, "invited"),
+        async_expected_agent_state(inviter_url, "connection", inviter_connection_id, "invited"),
+    )
+    assert invitee_ok
+    assert inviter_ok
 
     (resp_status, resp_text) = agent_backchannel_POST(invitee_url + "/agent/command/", "connection", operation="accept-invitation", id=invitee_connection_id)
     assert resp_status == 200, f'resp_status {resp_status} is not 200; {resp_text}'
@@ -199,15 +207,23 @@ def step_impl(context, inviter, invitee):
     invitee_connection_id = context.connection_id_dict[invitee][inviter]
 
     # get connection and verify status
-    assert expected_agent_state(inviter_url, "connection", inviter_connection_id, "requested")
-    assert expected_agent_state(invitee_url, "connection", invitee_connection_id, "requested")
+    (inviter_ok, invitee_ok) = gather_agent_requests(
+        async_expected_agent_state(inviter_url, "connection", inviter_connection_id, "requested"),
+        async_expected_agent_state(invitee_url, "connection", invitee_connection_id, "requested"),
+    )
+    assert inviter_ok
+    assert invitee_ok
 
     (resp_status, resp_text) = agent_backchannel_POST(inviter_url + "/agent/command/", "connection", operation="accept-request", id=inviter_connection_id)
     assert resp_status == 200, f'resp_status {resp_status} is not 200; {resp_text}'
 
     # get connection and verify status
-    assert expected_agent_state(inviter_url, "connection", inviter_connection_id, "responded")
-    assert expected_agent_state(invitee_url, "connection", invitee_connection_id, "complete")
+    (inviter_ok, invitee_ok) = gather_agent_requests(
+        async_expected_agent_state(inviter_url, "connection", inviter_connection_id, "responded"),
+        async_expected_agent_state(invitee_url, "connection", invitee_connection_id, "complete"),
+    )
+    assert inviter_ok
+    assert invitee_ok
 
 @when('"{invitee}" sends a response ping')
 def step_impl(context, invitee):
@@ -253,11 +269,13 @@ def step_impl(context, inviter, invitee):
         state_to_assert = ["responded", "complete",]
         topic = "connection"
 
-    # get connection and verify status for inviter
-    assert expected_agent_state(inviter_url, topic, inviter_connection_id, state_to_assert, wait_time=60.0)
-
-    # get connection and verify status for invitee
-    assert expected_agent_state(invitee_url, topic, invitee_connection_id, state_to_assert, wait_time=60.0)
+    # get connection and verify status for inviter and invitee
+    (inviter_ok, invitee_ok) = gather_agent_requests(
+        async_expected_agent_state(inviter_url, topic, inviter_connection_id, state_to_assert, wait_time=60.0),
+        async_expected_agent_state(invitee_url, topic, invitee_connection_id, state_to_assert, wait_time=60.0),
+    )
+    assert inviter_ok
+    assert invitee_ok
 
 @then('"{invitee}" is connected to "{inviter}"')
 def step_impl(context, inviter, invitee):
@@ -266,14 +284,31 @@ def step_impl(context, inviter, invitee):
     invitee_url = context.config.userdata.get(invitee)
     invitee_connection_id = context.connection_id_dict[invitee][inviter]
 
-    # get connection and verify status for inviter
-    assert expected_agent_state(inviter_url, "connection", inviter_connection_id, "responded")
-
-    # get connection and verify status for invitee
-    assert expected_agent_state(invitee_url, "connection", invitee_connection_id, "complete")
+    # get connection and verify status for inviter and invitee
+    (inviter_ok, invitee_ok) = gather_agent_requests(
+        async_expected_agent_state(inviter_url, "connection", inviter_connection_id, "responded"),
+        async_expected_agent_state(invitee_url, "connection", invitee_connection_id, "complete"),
+    )
+    assert inviter_ok
+    assert invitee_ok
 
 @given('"{sender}" and "{receiver}" have an existing connection')
 def step_impl(context, sender, receiver):
+    sender_url = context.config.userdata.get(sender)
+    receiver_url = context.config.userdata.get(receiver)
+    protocol = "did-exchange" if "DIDExchangeConnection" in context.tags else "connection"
+
+    # With CONNECTION_POOL=on scenarios that are not about connections reuse one connection per pair of agents, see agent_fixtures.py
+    use_pool = use_connection_pool(context.tags)
+    if use_pool:
+        pooled = get_pooled_connection(sender_url, receiver_url, protocol)
+        if pooled:
+            if not hasattr(context, 'connection_id_dict'):
+                context.connection_id_dict = {}
+            context.connection_id_dict.setdefault(sender, {})[receiver] = pooled[0]
+            context.connection_id_dict.setdefault(receiver, {})[sender] = pooled[1]
+            return
+
     if "DIDExchangeConnection" in context.tags:
         context.execute_steps(u'''
             When "''' + sender + '''" sends an explicit invitation
@@ -298,6 +333,9 @@ def step_impl(context, sender, receiver):
             Then "''' + sender + '''" and "''' + receiver + '''" have a connection
         ''')
 
+    if use_pool:
+        pool_connection(sender_url, receiver_url, protocol, context.connection_id_dict[sender][receiver], context.connection_id_dict[receiver][sender])
+
 @when(u'"{sender}" sends a trust ping')
 def step_impl(context, sender):
     sender_url = context.config.userdata.get(sender)
@@ -1,8 +1,8 @@
 from behave import *
 import json
-from agent_backchannel_client import agent_backchannel_GET, agent_backchannel_POST, expected_agent_state
+from agent_backchannel_client import agent_backchannel_GET, agent_backchannel_POST, expected_agent_state, client_pause
 from agent_test_utils import format_cred_proposal_by_aip_version
-from time import sleep
+from agent_test_data import get_test_data, render_test_data, scenario_values
 
 CRED_FORMAT_INDY = "indy"
 CRED_FORMAT_JSON_LD = "json-ld"
@@ -41,11 +41,7 @@ def step_impl(context, holder, cred_format, issuer, credential_data):
 
     if "schema_dict" in context:
         for schema in context.schema_dict:
-            try:
-                credential_data_json_file = open('features/data/cred_data_' + schema.lower() + '.json')
-                credential_data_json = json.load(credential_data_json_file)
-            except FileNotFoundError:
-                print(FileNotFoundError + ': features/data/cred_data_' + schema.lower() + '.json')
+            credential_data_json = get_test_data('cred_data_' + schema.lower())
 
             if 'credential_data_dict' in context:
                 context.credential_data_dict[schema] = credential_data_json[credential_data]['attributes']
@@ -74,8 +70,9 @@ def step_impl(context, holder, cred_format, issuer, credential_data):
     if "AIP20" in context.tags:
         # We only want to send data for the cred format being used
         assert cred_format in context.filters, f"credential data has no filter for cred format {cred_format}"
+        # fill in the issuer, schema and credential definition of the "replace_me" fields
         filters = {
-            cred_format: context.filters[cred_format]
+            cred_format: render_test_data(context.filters[cred_format], scenario_values(context))
         }
 
          # This call may need to be formated by cred_format instead of version. Reassess when more types are used.
@@ -107,8 +104,9 @@ def step_impl(context, issuer, cred_format):
 
         # We only want to send data for the cred format being used
         assert cred_format in context.filters, f"credential data has no filter for cred format {cred_format}"
+        # fill in the issuer, schema and credential definition of the "replace_me" fields
         filters = {
-            cred_format: context.filters[cred_format]
+            cred_format: render_test_data(context.filters[cred_format], scenario_values(context))
         }
 
         credential_offer = format_cred_proposal_by_aip_version(context, "AIP20", cred_data, context.connection_id_dict[issuer][context.holder_name], filters)
@@ -183,7 +181,7 @@ def step_impl(context, holder, cred_format):
         "comment": "storing credential"
     }
 
-    sleep(1)
+    client_pause(1)
     (resp_status, resp_text) = agent_backchannel_POST(holder_url + "/agent/command/", "issue-credential-v2", operation="store", id=context.cred_thread_id, data=credential_id)
     assert resp_status == 200, f'resp_status {resp_status} is not 200; {resp_text}'
     resp_json = json.loads(resp_text)
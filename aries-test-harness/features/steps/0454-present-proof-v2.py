@@ -1,7 +1,8 @@
 from behave import *
 import json
 from agent_backchannel_client import agent_backchannel_GET, agent_backchannel_POST, expected_agent_state
-from agent_test_utils import get_relative_timestamp_to_epoch
+from agent_fixtures import add_credential_to_pool, pooled_credential
+from agent_test_data import get_test_data, render_test_data, scenario_values
 from time import sleep
 
 
@@ -9,20 +10,14 @@ from time import sleep
 def step_impl(context, prover, issuer, credential_data):
     #assign the credential data to the context for use in the credential offer or proposal. 
     if credential_data != None:
+        # Credentials with the same data from the same issuer can be pooled, see CREDENTIAL_POOL in agent_fixtures.py
+        context.credential_data_name = credential_data
         if "schema_dict" in context:
             for schema in context.schema_dict:
                 if 'credential_data_dict' in context:
-                    try:
-                        credential_data_json_file = open('features/data/cred_data_' + schema.lower() + '.json')
-                        context.credential_data_dict[schema] = json.load(credential_data_json_file)[credential_data]['attributes']
-                    except FileNotFoundError:
-                        print(FileNotFoundError + ': features/data/cred_data_' + schema.lower() + '.json')
+                    context.credential_data_dict[schema] = get_test_data('cred_data_' + schema.lower())[credential_data]['attributes']
                 else:
-                    try:
-                        credential_data_json_file = open('features/data/cred_data_' + schema.lower() + '.json')
-                        context.credential_data_dict = {schema: json.load(credential_data_json_file)[credential_data]['attributes']}
-                    except FileNotFoundError:
-                        print(FileNotFoundError + ': features/data/cred_data_' + schema.lower() + '.json')
+                    context.credential_data_dict = {schema: get_test_data('cred_data_' + schema.lower())[credential_data]['attributes']}
 
     # Check if a connection between the players has already been established in this test. 
     if prover not in context.connection_id_dict or issuer not in context.connection_id_dict[prover]:
@@ -77,6 +72,8 @@ def step_impl(context, prover, issuer, credential_data):
         for schema in context.schema_dict:
             context.credential_data = context.credential_data_dict[schema]
             context.schema = context.schema_dict[schema]
+            if pooled_credential(context, schema, "issue-credential-v2"):
+                continue
             context_steps = context_steps_start + f''' "{issuer}" offers the "{context.current_cred_format}" credential
                 And "{prover}" requests the "{context.current_cred_format}" credential
                 And  "{issuer}" issues the "{context.current_cred_format}" credential
@@ -84,23 +81,17 @@ def step_impl(context, prover, issuer, credential_data):
                 Then "{prover}" has the "{context.current_cred_format}" credential issued
             '''
             context.execute_steps(context_steps)
+            add_credential_to_pool(context, schema, "issue-credential-v2")
 
 
 @when('"{verifier}" sends a {request_for_proof} presentation with formats to "{prover}"')
 def step_impl(context, verifier, request_for_proof, prover):
-    try:
-        request_for_proof_json_file = open('features/data/' + request_for_proof + '.json')
-        request_for_proof_json = json.load(request_for_proof_json_file)
-        context.request_for_proof = request_for_proof_json["presentation_proposal"]
-
-    except FileNotFoundError:
-        print(FileNotFoundError + ': features/data/' + request_for_proof + '.json')
+    context.request_for_proof = get_test_data(request_for_proof)["presentation_proposal"]
 
     # check for a schema template already loaded in the context. If it is, it was loaded from an external Schema, so use it.
     if "request_for_proof" in context:
-        data = context.request_for_proof
-        if "non_revoked_timeframe" in context:
-             data["non_revoked"] = context.non_revoked_timeframe["non_revoked"]
+        # add the non-revoked interval of a revocation scenario, see agent_test_data.py
+        data = render_test_data(context.request_for_proof, scenario_values(context))
 
     presentation_proposal = {
         "presentation_proposal": {
@@ -138,48 +129,14 @@ def step_impl(context, verifier, request_for_proof, prover):
 
 @when('"{prover}" makes the {presentation} of the proof with formats')
 def step_impl(context, prover, presentation):
-    # Open the presentation json file
-    try:
-        presentation_json_file = open('features/data/' + presentation + '.json')
-        presentation_json = json.load(presentation_json_file)
-        context.presentation = presentation_json["presentation"]
-
-    except FileNotFoundError:
-        print(FileNotFoundError + ': features/data/' + presentation + '.json')
+    context.presentation = get_test_data(presentation)["presentation"]
 
     prover_url = context.prover_url
 
     if "presentation" in context:
         presentation = context.presentation
-        # Find the cred ids and add the actual cred id into the presentation
-        # TODO: There is probably a better way to get access to the specific requested attributes and predicates. Revisit this later.
-        try:
-            for i in range(json.dumps(presentation["requested_attributes"]).count("cred_id")):
-                # Get the schema name from the loaded presentation for each requested attributes
-                cred_type_name = presentation["requested_attributes"][list(presentation["requested_attributes"])[i]]["cred_type_name"]
-                presentation["requested_attributes"][list(presentation["requested_attributes"])[i]]["cred_id"] = context.credential_id_dict[cred_type_name][len(context.credential_id_dict[cred_type_name])-1]
-                # If there is a timestamp, calculate it from the instruction in the file. Can be 'now' or + - relative to now.
-                if ("timestamp" in presentation["requested_attributes"][list(presentation["requested_attributes"])[i]]):
-                    relative_timestamp = presentation["requested_attributes"][list(presentation["requested_attributes"])[i]]["timestamp"]
-                    presentation["requested_attributes"][list(presentation["requested_attributes"])[i]]["timestamp"] = get_relative_timestamp_to_epoch(relative_timestamp)
-                # Remove the cred_type_name from this part of the presentation since it won't be needed in the actual request.
-                presentation["requested_attributes"][list(presentation["requested_attributes"])[i]].pop("cred_type_name")
-        except KeyError:
-            pass
-        
-        try:
-            for i in range(json.dumps(presentation["requested_predicates"]).count("cred_id")):
-                # Get the schema name from the loaded presentation for each requested predicates
-                cred_type_name = presentation["requested_predicates"][list(presentation["requested_predicates"])[i]]["cred_type_name"]
-                presentation["requested_predicates"][list(presentation["requested_predicates"])[i]]["cred_id"] = context.credential_id_dict[cred_type_name][len(context.credential_id_dict[cred_type_name])-1] 
-                # If there is a timestamp, calculate it from the instruction in the file. Can be 'now' or + - relative to now.
-                if ("timestamp" in presentation["requested_predicates"][list(presentation["requested_predicates"])[i]]):
-                    relative_timestamp = presentation["requested_predicates"][list(presentation["requested_predicates"])[i]]["timestamp"]
-                    presentation["requested_predicates"][list(presentation["requested_predicates"])[i]]["timestamp"] = get_relative_timestamp_to_epoch(relative_timestamp)
-                # Remove the cred_type_name from this part of the presentation since it won't be needed in the actual request.
-                presentation["requested_predicates"][list(presentation["requested_predicates"])[i]].pop("cred_type_name")
-        except KeyError:
-            pass
+        # Fill in the cred ids of the cred_type_names and the relative timestamps, see agent_test_data.py
+        render_test_data(presentation, scenario_values(context))
 
         presentation["format"] = context.current_cred_format
 
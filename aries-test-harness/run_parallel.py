@@ -0,0 +1,373 @@
+"""
+Run the behave tests sharded across parallel workers, each with its own set
+of Acme, Bob, Faber and Mallory backchannels.
+
+Worker n talks to the agents at BASE_PORT + n * PORT_STRIDE (Acme), +10 (Bob),
++20 (Faber) and +30 (Mallory), so worker 0 uses the usual 9020-9050. The
+agents are either already running (e.g. started by "./manage run -w N"), or
+started per worker from --agent-command, or the simulated agents (--sim).
+
+The selected scenarios are found with a behave dry run and split across the
+workers, longest first when the durations of a previous run are given. Feature
+paths among the behave args only select scenarios for the dry run, the workers
+are given the locations of their own scenarios. Each worker's behave output goes
+to its own files in the output folder, and the JSON results are merged into one
+report; allure results are written by all the workers to the same folder.
+
+The dry run and the workers use the behave.ini settings except for its
+formatters, which would have them all write the same output file at once.
+
+Run from the aries-test-harness folder:
+
+    python run_parallel.py --workers 4 --sim -- --tags=@AcceptanceTest --tags=~@wip
+"""
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+import urllib.request
+from timeit import default_timer
+
+BASE_PORT = int(os.getenv("BASE_PORT", "9020"))
+PORT_STRIDE = int(os.getenv("PORT_STRIDE", "100"))
+AGENT_TIMEOUT = int(os.getenv("AGENT_TIMEOUT", "30"))
+
+# role -> backchannel port offset within a worker's port range
+ROLES = {"Acme": 0, "Bob": 10, "Faber": 20, "Mallory": 30}
+
+SIM_COMMAND = "python sim/sim_backchannel.py -p {port} -a " + ",".join(ROLES) + " -i false"
+SIM_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "aries-backchannels")
+
+
+# runs behave without the behave.ini formatters, see run_behave()
+BEHAVE = [sys.executable, os.path.abspath(__file__), "--behave"]
+
+
+def worker_port(worker, role="Acme"):
+    return BASE_PORT + worker * PORT_STRIDE + ROLES[role]
+
+
+def worker_userdata(worker, host="0.0.0.0"):
+    args = []
+    for role in ROLES:
+        args.extend(["-D", f"{role}=http://{host}:{worker_port(worker, role)}"])
+    return args
+
+
+def run_behave(args):
+    """
+    Run behave with the behave.ini settings, except for its formatters and their output files.
+    """
+    from behave.__main__ import run_behave
+    from behave.configuration import Configuration, load_configuration
+
+    defaults = {}
+    load_configuration(defaults)
+    defaults.pop("format", None)
+    defaults.pop("outfiles", None)
+    return run_behave(Configuration(args, load_config=False, **defaults))
+
+
+def split_paths(behave_args):
+    """
+    Split the behave args into (options, paths); paths are the DIRECTORY, FILE,
+    FILE:LINE or @FILE arguments that select the features to run.
+    """
+    from behave.configuration import OPTIONS
+
+    # options that take the next argument as their value
+    value_options = {}
+    for (fixed, keywords) in OPTIONS:
+        if fixed and keywords.get("action", "store") in ("store", "append"):
+            value_options.update((option, keywords.get("nargs")) for option in fixed)
+
+    (options, paths) = ([], [])
+    args = iter(behave_args)
+    for arg in args:
+        if arg == "--":
+            paths.extend(args)
+        elif arg.startswith("-"):
+            options.append(arg)
+            if arg in value_options:
+                value = next(args, None)
+                # an optional value (--color) is only taken when it is not a path, as behave does
+                if value is not None and value_options[arg] == "?" and os.path.exists(value):
+                    paths.append(value)
+                elif value is not None:
+                    options.append(value)
+        else:
+            paths.append(arg)
+    return (options, paths)
+
+
+def select_scenarios(behave_args, out_dir):
+    """
+    Locations ("features/x.feature:12") of the scenarios the behave args select, in file order.
+    """
+    dry_run = os.path.join(out_dir, "dry-run.json")
+    result = subprocess.run(
+        BEHAVE + ["--dry-run", "--no-summary", "-f", "json", "-o", dry_run] + behave_args,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    if result.returncode != 0 and not os.path.exists(dry_run):
+        sys.exit("Could not list the scenarios:\n" + result.stderr)
+    with open(dry_run) as f:
+        features = json.load(f)
+    os.remove(dry_run)
+
+    locations = []
+    for feature in features:
+        for element in feature.get("elements", []):
+            if element["type"] == "scenario" and element.get("status") != "skipped":
+                locations.append(element["location"])
+    return locations
+
+
+def scenario_durations(results_file):
+    """
+    Scenario location -> seconds, from the JSON results of an earlier run.
+    """
+    durations = {}
+    if not results_file or not os.path.exists(results_file):
+        return durations
+    with open(results_file) as f:
+        features = json.load(f)
+    for feature in features:
+        for element in feature.get("elements", []):
+            steps = element.get("steps", [])
+            durations[element["location"]] = sum(step.get("result", {}).get("duration", 0.0) for step in steps)
+    return durations
+
+
+def shard_scenarios(locations, workers, durations):
+    """
+    Split the scenarios into one list per worker.
+
+    With known durations the longest scenarios are handed out first, each to the
+    least loaded worker; scenarios without a duration count as the mean.
+    Otherwise they are dealt round robin, which spreads each feature file across
+    the workers.
+    """
+    shards = [[] for _ in range(workers)]
+    if not durations:
+        for (i, location) in enumerate(locations):
+            shards[i % workers].append(location)
+        return shards
+
+    mean = sum(durations.values()) / len(durations)
+    loads = [0.0] * workers
+    for location in sorted(locations, key=lambda location: -durations.get(location, mean)):
+        worker = loads.index(min(loads))
+        shards[worker].append(location)
+        loads[worker] += durations.get(location, mean)
+    # behave runs the locations in the order given; keep file order within a worker
+    order = {location: i for (i, location) in enumerate(locations)}
+    for shard in shards:
+        shard.sort(key=order.get)
+    return shards
+
+
+def agent_ready(port):
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/agent/command/status/", timeout=2) as resp:
+            return resp.status == 200
+    except Exception:
+        return False
+
+
+def wait_for_agents(workers, processes):
+    deadline = time.monotonic() + AGENT_TIMEOUT
+    waiting = [(worker, worker_port(worker, role)) for worker in range(workers) for role in ROLES]
+    while waiting:
+        waiting = [(worker, port) for (worker, port) in waiting if not agent_ready(port)]
+        for (worker, process) in processes.items():
+            if process.poll() is not None:
+                sys.exit(f"The agents for worker {worker} exited with {process.returncode}, see agents-{worker}.log")
+        if waiting and time.monotonic() > deadline:
+            ports = ", ".join(str(port) for (_, port) in waiting)
+            sys.exit(f"The agents on ports {ports} did not respond within {AGENT_TIMEOUT} seconds")
+        if waiting:
+            time.sleep(0.5)
+
+
+def start_agents(command, workers, out_dir, cwd=None, env=None):
+    processes = {}
+    for worker in range(workers):
+        log = open(os.path.join(out_dir, f"agents-{worker}.log"), "w")
+        processes[worker] = subprocess.Popen(
+            shlex.split(command.format(port=worker_port(worker), worker=worker)),
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            cwd=cwd,
+            env=env,
+        )
+    return processes
+
+
+def stop_agents(processes):
+    for process in processes.values():
+        process.terminate()
+    for process in processes.values():
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def worker_env(worker):
+    env = dict(os.environ)
+    # each worker records its own cassette, e.g. run.jsonl.gz -> run-1.jsonl.gz
+    record = env.get("BACKCHANNEL_RECORD")
+    if record and worker > 0:
+        (folder, name) = os.path.split(record)
+        (stem, dot, ext) = name.partition(".")
+        env["BACKCHANNEL_RECORD"] = os.path.join(folder, f"{stem}-{worker}{dot}{ext}")
+    return env
+
+
+def start_worker(worker, locations, behave_options, out_dir, allure_dir):
+    formats = ["-f", "json", "-o", os.path.join(out_dir, f"worker-{worker}.json"), "-f", "plain"]
+    if allure_dir:
+        formats.extend(["-f", "allure_behave.formatter:AllureFormatter", "-o", allure_dir])
+    log = open(os.path.join(out_dir, f"worker-{worker}.log"), "w")
+    return subprocess.Popen(
+        BEHAVE + formats + behave_options + worker_userdata(worker) + locations,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+        env=worker_env(worker),
+    )
+
+
+def merge_results(out_dir, shards):
+    """
+    Merge the workers' JSON results into one list of features, in file order.
+    Returns (features, workers without results).
+
+    A worker reports the scenarios it did not run as skipped, only those in its
+    own shard are kept.
+    """
+    features = {}
+    missing = []
+    for (worker, shard) in enumerate(shards):
+        selected = set(shard)
+        results_file = os.path.join(out_dir, f"worker-{worker}.json")
+        try:
+            with open(results_file) as f:
+                results = json.load(f)
+        except (OSError, ValueError):
+            # the worker failed before writing its results, or stopped halfway through
+            missing.append(worker)
+            continue
+        for feature in results:
+            feature["elements"] = [
+                element for element in feature.get("elements", [])
+                if element["type"] != "scenario" or element["location"] in selected
+            ]
+            merged = features.get(feature["location"])
+            if merged is None:
+                features[feature["location"]] = feature
+            else:
+                merged["elements"].extend(feature["elements"])
+                if feature.get("status") == "failed":
+                    merged["status"] = "failed"
+
+    def line(element):
+        return int(element["location"].rsplit(":", 1)[1])
+
+    for feature in features.values():
+        feature["elements"].sort(key=line)
+    return ([features[location] for location in sorted(features)], missing)
+
+
+def count_statuses(features):
+    counts = {}
+    for feature in features:
+        for element in feature.get("elements", []):
+            if element["type"] == "scenario":
+                status = element.get("status", "untested")
+                counts[status] = counts.get(status, 0) + 1
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the behave tests in parallel workers, each with its own agents.",
+        epilog="Arguments after -- are passed to behave, e.g. -- --tags=@AcceptanceTest",
+    )
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="Number of workers")
+    parser.add_argument("-o", "--output", default="results/parallel", help="Folder for the worker output and merged results")
+    parser.add_argument("--allure", metavar="DIR", help="Also write allure results to DIR")
+    parser.add_argument("--durations", metavar="JSON", help="JSON results of an earlier run, to balance the workers")
+    agents = parser.add_mutually_exclusive_group()
+    agents.add_argument(
+        "--agent-command",
+        metavar="COMMAND",
+        help="Command that starts one worker's agents; {port} is the worker's Acme port and {worker} its number",
+    )
+    agents.add_argument("--sim", action="store_true", help="Start simulated agents for each worker")
+    (args, behave_args) = parser.parse_known_args()
+    if behave_args[:1] == ["--"]:
+        behave_args = behave_args[1:]
+
+    (behave_options, paths) = split_paths(behave_args)
+
+    os.makedirs(args.output, exist_ok=True)
+    locations = select_scenarios(behave_options + paths, args.output)
+    if not locations:
+        sys.exit("No scenarios selected")
+    workers = max(1, min(args.workers, len(locations)))
+    shards = shard_scenarios(locations, workers, scenario_durations(args.durations))
+    print(f"Running {len(locations)} scenarios in {workers} workers")
+
+    agent_processes = {}
+    try:
+        if args.sim:
+            env = dict(os.environ, PYTHONPATH=".")
+            agent_processes = start_agents(SIM_COMMAND, workers, os.path.abspath(args.output), cwd=SIM_FOLDER, env=env)
+        elif args.agent_command:
+            agent_processes = start_agents(args.agent_command, workers, args.output)
+        wait_for_agents(workers, agent_processes)
+
+        start = default_timer()
+        processes = {
+            worker: start_worker(worker, shard, behave_options, args.output, args.allure)
+            for (worker, shard) in enumerate(shards)
+        }
+        returncode = 0
+        for (worker, process) in processes.items():
+            process.wait()
+            print(f"  worker {worker}: {len(shards[worker])} scenarios, exit code {process.returncode}, see worker-{worker}.log")
+            returncode = returncode or process.returncode
+        elapsed = default_timer() - start
+    finally:
+        stop_agents(agent_processes)
+
+    (features, missing) = merge_results(args.output, shards)
+    results_file = os.path.join(args.output, "results.json")
+    with open(results_file, "w") as f:
+        json.dump(features, f, indent=2)
+
+    counts = count_statuses(features)
+    for worker in missing:
+        print(f"  worker {worker} wrote no results, its {len(shards[worker])} scenarios did not run; see worker-{worker}.log")
+        counts["not run"] = counts.get("not run", 0) + len(shards[worker])
+        returncode = returncode or 1
+    summary = ", ".join(f"{count} {status}" for (status, count) in sorted(counts.items()))
+    print(f"{summary} in {elapsed:.1f}s; results written to {results_file}")
+
+    if os.getenv("TRACE_DIR"):
+        from agent_backchannel_client import merge_traces
+        print("Trace written to", merge_traces())
+
+    sys.exit(returncode)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--behave"]:
+        sys.exit(run_behave(sys.argv[2:]))
+    main()
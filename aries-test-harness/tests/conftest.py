@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the harness modules are imported from the aries-test-harness folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
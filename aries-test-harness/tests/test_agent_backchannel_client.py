@@ -0,0 +1,400 @@
+import asyncio
+import atexit
+import json
+import threading
+import time
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import agent_backchannel_client as client
+from agent_backchannel_client import (
+    AgentUnavailableError,
+    CassetteMissError,
+    CircuitBreaker,
+    agent_backchannel_GET,
+    async_agent_backchannel_GET,
+    agent_backchannel_POST,
+    WaitResult,
+    cassette_state,
+    client_pause,
+    client_state,
+    close_client_loop,
+    expected_agent_state,
+    get_breaker,
+    gather_agent_requests,
+    get_client_loop,
+    get_client_session,
+    run_on_client_loop,
+    start_cassette_scenario,
+)
+
+
+@pytest.fixture
+def client_loop():
+    yield get_client_loop()
+    close_client_loop()
+    client_state["breakers"].clear()
+
+
+@pytest.fixture
+def agent(client_loop):
+    """
+    start(routes) serves the routes on the client loop and returns their /agent/command/ url.
+    """
+    servers = []
+
+    def start(routes):
+        app = web.Application()
+        app.add_routes(routes)
+        server = TestServer(app)
+        run_on_client_loop(server.start_server())
+        servers.append(server)
+        return str(server.make_url("/agent/command/"))
+
+    yield start
+    for server in servers:
+        run_on_client_loop(server.close())
+
+
+def test_every_call_runs_on_the_one_client_loop(client_loop):
+    async def current_loop():
+        return (asyncio.get_event_loop(), threading.current_thread())
+
+    assert get_client_loop() is client_loop
+    (loop, thread) = run_on_client_loop(current_loop())
+    assert loop is client_loop
+    assert thread is client_state["thread"]
+    assert run_on_client_loop(current_loop()) == (loop, thread)
+
+
+def test_blocking_calls_from_the_client_loop_are_refused(client_loop):
+    async def blocking_call():
+        async def nested():
+            pass
+
+        run_on_client_loop(nested())
+
+    with pytest.raises(RuntimeError, match="await the async API"):
+        run_on_client_loop(blocking_call())
+
+
+def test_closing_the_loop_starts_a_new_one_on_the_next_call(client_loop):
+    thread = client_state["thread"]
+    close_client_loop()
+    assert not thread.is_alive()
+    assert client_loop.is_closed()
+    assert get_client_loop() is not client_loop
+
+
+def test_requests_to_an_agent_share_a_session_and_connection(agent):
+    peers = []
+
+    async def status(request):
+        peers.append(request.transport.get_extra_info("peername"))
+        return web.json_response({"status": "active"})
+
+    async def create_invitation(request):
+        peers.append(request.transport.get_extra_info("peername"))
+        return web.json_response(await request.json())
+
+    url = agent([web.get("/agent/command/status/", status), web.post("/agent/command/connection/create-invitation/", create_invitation)])
+    assert agent_backchannel_GET(url, "status") == (200, '{"status": "active"}')
+    assert agent_backchannel_POST(url, "connection", operation="create-invitation", data={"label": "Acme"}) == (
+        200, '{"data": {"label": "Acme"}}'
+    )
+    assert agent_backchannel_GET(url, "status")[0] == 200
+    assert len(peers) == 3
+    assert len(set(peers)) == 1
+
+    async def sessions():
+        return (get_client_session(url), get_client_session(url + "connection/"), get_client_session("http://localhost:1/"))
+
+    (session, same, other) = run_on_client_loop(sessions())
+    assert session is same
+    assert session is not other
+
+
+def test_gathered_requests_run_concurrently_and_keep_their_order(agent):
+    async def slow(request):
+        await asyncio.sleep(0.3)
+        return web.json_response({"state": "slow"})
+
+    async def fast(request):
+        return web.json_response({"state": "fast"})
+
+    slow_url = agent([web.get("/agent/command/connection/c1", slow)])
+    fast_url = agent([web.get("/agent/command/connection/c1", fast)])
+    start = time.monotonic()
+    results = gather_agent_requests(
+        async_agent_backchannel_GET(slow_url, "connection", id="c1"),
+        async_agent_backchannel_GET(fast_url, "connection", id="c1"),
+        async_agent_backchannel_GET(slow_url, "connection", id="c1"),
+    )
+    assert results == [(200, '{"state": "slow"}'), (200, '{"state": "fast"}'), (200, '{"state": "slow"}')]
+    assert time.monotonic() - start < 0.6
+
+
+def test_gathered_request_errors_are_raised(client_loop):
+    async def ok():
+        return "ok"
+
+    async def failed():
+        raise ValueError("agent failed")
+
+    assert gather_agent_requests() == []
+    assert gather_agent_requests(ok(), ok()) == ["ok", "ok"]
+    with pytest.raises(ValueError, match="agent failed"):
+        gather_agent_requests(ok(), failed())
+
+
+def record_states(agent, states):
+    """
+    Serve connection c1 in each of states in turn, staying in the last one.
+
+    Returns the agent url and the list of (time, query) of the probes made.
+    """
+    probes = []
+
+    async def connection(request):
+        probes.append((time.monotonic(), dict(request.query)))
+        state = states.pop(0) if len(states) > 1 else states[0]
+        return web.json_response({"connection_id": "c1", "state": state})
+
+    url = agent([web.get("/agent/command/connection/c1", connection)])
+    return (url[:-len("/agent/command/")], probes)
+
+
+def test_wait_results_are_true_when_the_state_was_reached():
+    assert WaitResult(True, "active", 200, 0.1, 1)
+    assert not WaitResult(False, "invited", 200, 2.0, 7)
+    assert repr(WaitResult(False, "invited", 200, 2.0, 7)) == (
+        "WaitResult(reached=False, state='invited', status=200, elapsed=2.000, probes=7)"
+    )
+
+
+def test_the_first_probe_asks_the_backchannel_to_wait(agent):
+    (url, probes) = record_states(agent, ["active"])
+
+    result = expected_agent_state(url, "connection", "c1", ["response", "active"], wait_time=5)
+    assert (result.reached, result.state, result.status, result.probes) == (True, "active", 200, 1)
+    assert probes[0][1] == {"wait_for_state": "response,active,N/A,abandoned,problem-report,error", "timeout": "5"}
+
+
+def test_probes_back_off_until_the_state_is_reached(agent):
+    (url, probes) = record_states(agent, ["invited"] * 6 + ["active"])
+
+    result = expected_agent_state(url, "connection", "c1", "active", wait_time=5, sleep_time=0.04)
+    assert (result.reached, result.state, result.probes) == (True, "active", 7)
+    # only the first probe long-polls
+    assert [query for (_, query) in probes[1:]] == [{}] * 6
+    pauses = [later - earlier for ((earlier, _), (later, _)) in zip(probes, probes[1:])]
+    # doubling from WAIT_FIRST_DELAY, with up to half taken off as jitter, capped at sleep_time
+    for (pause, delay) in zip(pauses, (0.005, 0.01, 0.02, 0.04, 0.04, 0.04)):
+        assert delay * 0.5 <= pause < delay + 0.1
+
+
+def test_waiting_stops_at_the_deadline(agent):
+    (url, probes) = record_states(agent, ["invited"])
+
+    result = expected_agent_state(url, "connection", "c1", "active", wait_time=0.3, sleep_time=0.05)
+    assert (result.reached, result.state, result.status) == (False, "invited", 200)
+    assert result.probes == len(probes) > 2
+    assert 0.3 <= result.elapsed < 0.6
+
+
+def test_waiting_stops_at_a_terminal_state(agent):
+    (url, _) = record_states(agent, ["invited", "abandoned", "active"])
+
+    result = expected_agent_state(url, "connection", "c1", "active", wait_time=5, sleep_time=0.01)
+    assert (result.reached, result.state, result.probes) == (False, "abandoned", 2)
+
+
+def test_unknown_states_count_as_reached(agent):
+    (url, _) = record_states(agent, ["N/A"])
+
+    assert expected_agent_state(url, "connection", "c1", "active").reached
+
+
+def test_retries_are_limited_by_the_budget():
+    breaker = CircuitBreaker("http://localhost:9020")
+    assert [breaker.take_retry() for _ in range(client.RETRY_BUDGET_MIN + 1)] == [True] * client.RETRY_BUDGET_MIN + [False]
+    # every request adds RETRY_BUDGET_RATIO of a retry
+    breaker.requests = 20
+    assert [breaker.take_retry() for _ in range(3)] == [True, True, False]
+    assert breaker.retries == client.RETRY_BUDGET_MIN + 2
+
+
+def slow_agent(agent, delays, status=200):
+    """
+    An agent whose command, response and status handlers take the next of delays seconds.
+
+    Returns its url and the list of paths requested.
+    """
+    requests = []
+
+    async def handler(request):
+        requests.append(request.path)
+        await asyncio.sleep(delays.pop(0) if len(delays) > 1 else delays[0])
+        return web.json_response({"state": "active"}, status=status if request.path.endswith("/status/") else 200)
+
+    url = agent([
+        web.get("/agent/command/{topic}/{id}", handler),
+        web.post("/agent/command/{topic}/{operation}/", handler),
+        web.get("/agent/response/{topic}/{id}", handler),
+        web.get("/agent/command/status/", handler),
+    ])
+    return (url, requests)
+
+
+def test_timed_out_command_gets_are_retried(agent, monkeypatch):
+    monkeypatch.setattr(client, "READ_TIMEOUT", 0.1)
+    (url, requests) = slow_agent(agent, [0.5, 0.5, 0])
+
+    assert agent_backchannel_GET(url, "connection", id="c1") == (200, '{"state": "active"}')
+    assert requests == ["/agent/command/connection/c1"] * 3
+    breaker = get_breaker(url)
+    assert (breaker.requests, breaker.retries, breaker.failures) == (1, 2, 0)
+
+
+def test_requests_that_are_not_idempotent_are_not_retried(agent, monkeypatch):
+    monkeypatch.setattr(client, "READ_TIMEOUT", 0.1)
+    (url, requests) = slow_agent(agent, [0.5])
+
+    with pytest.raises(asyncio.TimeoutError):
+        agent_backchannel_POST(url, "connection", operation="send-ping", id="c1", data={})
+    response_url = url.replace("/agent/command/", "/agent/response/")
+    with pytest.raises(asyncio.TimeoutError):
+        agent_backchannel_GET(response_url, "connection", id="c1")
+    assert requests == ["/agent/command/connection/send-ping/", "/agent/response/connection/c1"]
+    assert get_breaker(url).retries == 0
+
+
+def test_long_polls_get_their_wait_added_to_the_read_timeout(agent, monkeypatch):
+    monkeypatch.setattr(client, "READ_TIMEOUT", 0.1)
+    (url, requests) = slow_agent(agent, [0.3])
+
+    assert agent_backchannel_GET(url, "connection", id="c1", params={"wait_for_state": "active", "timeout": 1})[0] == 200
+    assert len(requests) == 1
+
+
+def test_the_breaker_opens_when_the_health_check_fails(agent, monkeypatch):
+    monkeypatch.setattr(client, "READ_TIMEOUT", 0.1)
+    (url, requests) = slow_agent(agent, [0.5, 0.5, 0.5, 0], status=503)
+
+    # the third failed attempt checks the agent's status
+    with pytest.raises(AgentUnavailableError, match="status check returned 503"):
+        agent_backchannel_GET(url, "connection", id="c1")
+    assert requests == ["/agent/command/connection/c1"] * 3 + ["/agent/command/status/"]
+    breaker = get_breaker(url)
+    assert breaker.is_open
+    assert breaker.last_error.endswith("TimeoutError: Timeout on reading data from socket")
+
+    # open, requests fail without reaching the agent
+    with pytest.raises(AgentUnavailableError, match="is unavailable"):
+        agent_backchannel_POST(url, "connection", operation="send-ping", id="c1", data={})
+    assert len(requests) == 4
+
+
+def test_the_breaker_closes_when_the_health_check_passes_after_the_cooldown(agent, monkeypatch):
+    (url, requests) = slow_agent(agent, [0])
+    breaker = get_breaker(url)
+    breaker.opened_at = time.monotonic()
+    breaker.reason = "status check failed"
+
+    with pytest.raises(AgentUnavailableError):
+        agent_backchannel_GET(url, "connection", id="c1")
+    assert requests == []
+
+    monkeypatch.setattr(client, "BREAKER_COOLDOWN", 0)
+    assert agent_backchannel_GET(url, "connection", id="c1")[0] == 200
+    assert requests == ["/agent/command/status/", "/agent/command/connection/c1"]
+    assert not breaker.is_open
+
+
+@pytest.fixture
+def cassette(tmp_path, monkeypatch):
+    """
+    record() starts recording to a cassette, replay() stops the recording and replays it.
+    """
+    file_name = str(tmp_path / "agents.jsonl.gz")
+    monkeypatch.setitem(cassette_state, "file", None)
+    monkeypatch.setitem(cassette_state, "responses", None)
+    monkeypatch.setitem(cassette_state, "last", {})
+
+    class Cassette:
+        def record(self):
+            monkeypatch.setattr(client, "RECORD_FILE", file_name)
+
+        def replay(self):
+            if cassette_state["file"]:
+                atexit.unregister(cassette_state["file"].close)
+                cassette_state["file"].close()
+                cassette_state["file"] = None
+            monkeypatch.setattr(client, "RECORD_FILE", None)
+            monkeypatch.setattr(client, "REPLAY_FILE", file_name)
+
+    yield Cassette()
+    if cassette_state["file"]:
+        atexit.unregister(cassette_state["file"].close)
+        cassette_state["file"].close()
+    start_cassette_scenario("")
+
+
+def test_replays_serve_the_recorded_responses(agent, cassette):
+    (url, probes) = record_states(agent, ["invited", "request", "active"])
+
+    def scenario():
+        return [
+            agent_backchannel_GET(url + "/agent/command/", "connection", id="c1"),
+            agent_backchannel_GET(url + "/agent/command/", "connection", id="c1"),
+            agent_backchannel_GET(url + "/agent/command/", "connection", id="c1"),
+        ]
+
+    cassette.record()
+    start_cassette_scenario("Establish a connection")
+    recorded = scenario()
+    start_cassette_scenario("Another scenario")
+    other = agent_backchannel_GET(url + "/agent/command/", "connection", id="c1")
+
+    cassette.replay()
+    start_cassette_scenario("Establish a connection")
+    assert scenario() == recorded
+    assert [json.loads(text)["state"] for (_, text) in recorded] == ["invited", "request", "active"]
+    # polling more often than the recording repeats the last response
+    assert agent_backchannel_GET(url + "/agent/command/", "connection", id="c1") == recorded[-1]
+    start_cassette_scenario("Another scenario")
+    assert agent_backchannel_GET(url + "/agent/command/", "connection", id="c1") == other
+    # the agent only saw the recording
+    assert len(probes) == 4
+
+
+def test_requests_that_were_not_recorded_fail(agent, cassette):
+    (url, _) = record_states(agent, ["active"])
+    cassette.record()
+    start_cassette_scenario("Establish a connection")
+    agent_backchannel_GET(url + "/agent/command/", "connection", id="c1")
+
+    cassette.replay()
+    start_cassette_scenario("Establish a connection")
+    with pytest.raises(CassetteMissError, match="connection/c2 was not recorded"):
+        agent_backchannel_GET(url + "/agent/command/", "connection", id="c2")
+    start_cassette_scenario("Another scenario")
+    with pytest.raises(CassetteMissError, match="for scenario 'Another scenario'"):
+        agent_backchannel_GET(url + "/agent/command/", "connection", id="c1")
+
+
+def test_step_pauses_are_compressed_when_replaying(cassette, monkeypatch):
+    start = time.monotonic()
+    client_pause(0.1)
+    assert time.monotonic() - start >= 0.1
+
+    cassette.replay()
+    start = time.monotonic()
+    client_pause(60)
+    assert time.monotonic() - start < 1
+    monkeypatch.setattr(client, "REPLAY_TIME_SCALE", 0.005)
+    start = time.monotonic()
+    client_pause(60)
+    assert 0.3 <= time.monotonic() - start < 1
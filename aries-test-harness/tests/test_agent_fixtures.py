@@ -0,0 +1,262 @@
+import asyncio
+import json
+
+import pytest
+
+import agent_fixtures
+from agent_fixtures import (
+    add_credential_to_pool,
+    credential_pool_key,
+    get_issuer_fixture,
+    get_pooled_connection,
+    issuer_fixture_key,
+    pool_connection,
+    pooled_credential,
+    prepare_credentials,
+    use_connection_pool,
+    use_issuer_fixture,
+)
+
+ACME = "http://localhost:9020"
+BOB = "http://localhost:9030"
+SCHEMA = {"schema_name": "Degree Schema", "schema_version": "1.0.1", "attributes": ["name", "date", "degree"]}
+
+
+@pytest.fixture(autouse=True)
+def empty_pools(monkeypatch):
+    monkeypatch.setattr(agent_fixtures, "issuer_fixtures", {})
+    monkeypatch.setattr(agent_fixtures, "connection_pool", {})
+    monkeypatch.setattr(agent_fixtures, "credential_pool", {})
+
+
+async def gather(*coroutines):
+    return await asyncio.gather(*coroutines)
+
+
+@pytest.fixture
+def agents(monkeypatch):
+    """
+    The records of the agents, {url: {record id: record}}; GETs from agent_fixtures are served
+    from them and listed in agents.gets.
+    """
+    class Agents(dict):
+        pass
+
+    agents = Agents({ACME: {}, BOB: {}})
+    gets = agents.gets = []
+
+    async def agent_backchannel_GET(url, topic, operation=None, id=None, params=None):
+        gets.append((url, topic, id))
+        record = agents[url.replace("/agent/command/", "")].get(id)
+        if record is None:
+            return (404, f"404 {topic} {id} not found")
+        return (200, json.dumps(record))
+
+    monkeypatch.setattr(agent_fixtures, "async_agent_backchannel_GET", agent_backchannel_GET)
+    monkeypatch.setattr(agent_fixtures, "run_on_client_loop", asyncio.run)
+    monkeypatch.setattr(agent_fixtures, "gather_agent_requests", lambda *coroutines: asyncio.run(gather(*coroutines)))
+    return agents
+
+
+@pytest.fixture
+def created(monkeypatch):
+    """
+    The (issuer url, schema name, support revocation) of the issuer fixtures created on the ledger.
+    """
+    created = []
+
+    async def create_issuer_fixture(issuer_url, schema, support_revocation):
+        created.append((issuer_url, schema["schema_name"], support_revocation))
+        return {"schema_id": f"schema-{len(created)}", "cred_def_id": f"cred-def-{len(created)}"}
+
+    monkeypatch.setattr(agent_fixtures, "create_issuer_fixture", create_issuer_fixture)
+    monkeypatch.setattr(agent_fixtures, "run_on_client_loop", asyncio.run)
+    return created
+
+
+def test_issuer_fixture_keys_identify_the_schema_and_cred_def():
+    key = issuer_fixture_key(ACME, SCHEMA, False)
+    assert key == (ACME, "Degree Schema", "1.0.1", ("date", "degree", "name"), False)
+    # the attribute order doesn't matter
+    assert issuer_fixture_key(ACME, dict(SCHEMA, attributes=["degree", "name", "date"]), 0) == key
+    assert issuer_fixture_key("http://localhost:9040", SCHEMA, False) != key
+    assert issuer_fixture_key(ACME, dict(SCHEMA, schema_version="1.0.2"), False) != key
+    assert issuer_fixture_key(ACME, dict(SCHEMA, attributes=["name"]), False) != key
+    assert issuer_fixture_key(ACME, SCHEMA, True) != key
+
+
+@pytest.mark.parametrize("cache", ["on", "eager"])
+def test_issuer_fixtures_are_opt_in_and_never_revocable(monkeypatch, cache):
+    monkeypatch.setattr(agent_fixtures, "FIXTURE_CACHE", "off")
+    assert not use_issuer_fixture(False)
+    assert not use_issuer_fixture(True)
+
+    monkeypatch.setattr(agent_fixtures, "FIXTURE_CACHE", cache)
+    assert use_issuer_fixture(False)
+    # revocable credential definitions come with a revocation registry of their own
+    assert not use_issuer_fixture(True)
+
+
+def test_issuer_fixtures_are_created_once(created):
+    first = get_issuer_fixture(ACME, SCHEMA, False)
+    assert get_issuer_fixture(ACME, dict(SCHEMA, attributes=list(reversed(SCHEMA["attributes"]))), False) is first
+    other = get_issuer_fixture("http://localhost:9040", SCHEMA, False)
+    assert other is not first
+    assert created == [(ACME, "Degree Schema", False), ("http://localhost:9040", "Degree Schema", False)]
+    assert list(agent_fixtures.issuer_fixtures) == [issuer_fixture_key(ACME, SCHEMA, False), issuer_fixture_key("http://localhost:9040", SCHEMA, False)]
+
+
+def test_the_connection_pool_is_opt_in_and_not_for_connection_features(monkeypatch):
+    assert not use_connection_pool(["RFC0036", "AcceptanceTest"])
+
+    monkeypatch.setattr(agent_fixtures, "CONNECTION_POOL", True)
+    assert use_connection_pool(["RFC0036", "AcceptanceTest"])
+    # the connection is what these test
+    assert not use_connection_pool(["RFC0160", "AcceptanceTest"])
+    assert not use_connection_pool(["RFC0023", "DIDExchangeConnection"])
+
+
+def test_pooled_connections_are_reused_while_established(agents):
+    assert get_pooled_connection(ACME, BOB, "connection") is None
+
+    pool_connection(ACME, BOB, "connection", "acme-bob", "bob-acme")
+    agents[ACME]["acme-bob"] = {"state": "responded"}
+    agents[BOB]["bob-acme"] = {"state": "complete"}
+    # by every later scenario
+    for _ in range(2):
+        assert get_pooled_connection(ACME, BOB, "connection") == ("acme-bob", "bob-acme")
+    assert agents.gets == [
+        (ACME + "/agent/command/", "connection", "acme-bob"),
+        (BOB + "/agent/command/", "connection", "bob-acme"),
+    ] * 2
+    # only between the same agents, in the same direction, over the same protocol
+    assert get_pooled_connection(BOB, ACME, "connection") is None
+    assert get_pooled_connection(ACME, BOB, "did-exchange") is None
+
+
+@pytest.mark.parametrize("state", [None, "abandoned", "completed"])
+def test_pooled_connections_that_are_not_established_are_dropped(agents, state):
+    pool_connection(ACME, BOB, "connection", "acme-bob", "bob-acme")
+    agents[ACME]["acme-bob"] = {"state": "complete"}
+    if state:
+        agents[BOB]["bob-acme"] = {"state": state}
+
+    assert get_pooled_connection(ACME, BOB, "connection") is None
+    assert agent_fixtures.connection_pool == {}
+
+
+def test_did_exchange_connections_are_established_when_completed(agents):
+    pool_connection(ACME, BOB, "did-exchange", "acme-bob", "bob-acme")
+    agents[ACME]["acme-bob"] = {"state": "completed"}
+    agents[BOB]["bob-acme"] = {"state": "completed"}
+
+    assert get_pooled_connection(ACME, BOB, "did-exchange") == ("acme-bob", "bob-acme")
+
+
+class Context:
+    """
+    The parts of a behave context the pools use.
+    """
+
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+    def __contains__(self, name):
+        return name in self.__dict__
+
+
+def proof_context(**attributes):
+    context = Context(
+        tags=["RFC0037", "AcceptanceTest"],
+        issuer_url=ACME,
+        holder_url=BOB,
+        current_cred_format="indy",
+        credential_data_name="Data_DL_MaxValues",
+        schema={"schema_name": "Schema_DriversLicense"},
+        support_revocation_dict={"Schema_DriversLicense": False},
+        credential_definition_id_dict={"Schema_DriversLicense": "cred-def-1"},
+    )
+    context.__dict__.update(attributes)
+    return context
+
+
+@pytest.fixture
+def credential_pool(monkeypatch):
+    monkeypatch.setattr(agent_fixtures, "CREDENTIAL_POOL", "on")
+
+
+def test_the_credential_pool_is_opt_in():
+    assert credential_pool_key(proof_context(), "Schema_DriversLicense", "issue-credential") is None
+
+
+def test_credential_pool_keys_identify_the_credential(credential_pool):
+    key = credential_pool_key(proof_context(), "Schema_DriversLicense", "issue-credential")
+    assert key == (ACME, BOB, "cred-def-1", "Data_DL_MaxValues")
+    assert credential_pool_key(proof_context(tags=["RFC0454"]), "Schema_DriversLicense", "issue-credential-v2") == key
+    assert credential_pool_key(proof_context(credential_data_name="Data_DL_MinValues"), "Schema_DriversLicense", "issue-credential") != key
+    assert credential_pool_key(proof_context(holder_url=ACME, issuer_url=BOB), "Schema_DriversLicense", "issue-credential") != key
+
+
+@pytest.mark.parametrize("context, topic", [
+    (proof_context(tags=["RFC0036"]), "issue-credential"),
+    (proof_context(support_revocation_dict={"Schema_DriversLicense": True}), "issue-credential"),
+    (proof_context(tags=["RFC0454"], current_cred_format="json-ld"), "issue-credential-v2"),
+    (proof_context(credential_data_name=None), "issue-credential"),
+])
+def test_some_credentials_are_never_pooled(credential_pool, context, topic):
+    if context.credential_data_name is None:
+        del context.credential_data_name
+    assert credential_pool_key(context, "Schema_DriversLicense", topic) is None
+
+
+def test_pooled_credentials_are_reused_while_the_holder_has_them(agents, credential_pool):
+    first = proof_context()
+    assert not pooled_credential(first, "Schema_DriversLicense", "issue-credential")
+    first.credential_id_dict = {"Schema_DriversLicense": ["credential-1"]}
+    add_credential_to_pool(first, "Schema_DriversLicense", "issue-credential")
+    agents[BOB]["credential-1"] = {"referent": "credential-1"}
+
+    for _ in range(2):
+        later = proof_context()
+        assert pooled_credential(later, "Schema_DriversLicense", "issue-credential")
+        assert later.credential_id_dict == {"Schema_DriversLicense": ["credential-1"]}
+
+    # gone from the holder's wallet
+    del agents[BOB]["credential-1"]
+    assert not pooled_credential(proof_context(), "Schema_DriversLicense", "issue-credential")
+    assert agent_fixtures.credential_pool == {}
+
+
+def test_revocable_credentials_are_not_issued_up_front(agents, created, monkeypatch):
+    monkeypatch.setattr(agent_fixtures, "FIXTURE_CACHE", "on")
+    monkeypatch.setattr(agent_fixtures, "selected_credentials", lambda context: {
+        ("Acme", "Bob", "Schema_DriversLicense", "Data_DL_MaxValues"): "issue-credential",
+        ("Acme", "Bob", "Schema_DriversLicense_Revoc", "Data_DL_MaxValues"): "issue-credential",
+        ("Acme", "Bob", "Schema_DriversLicense", "Data_DL_MinValues"): "issue-credential-v2",
+    })
+    issued = []
+
+    async def connect_agents(inviter_url, invitee_url):
+        return ("acme-bob", "bob-acme")
+
+    async def issue_credential(topic, issuer_url, holder_url, issuer_connection_id, attributes, filters):
+        issued.append((topic, issuer_connection_id, filters["indy"]["cred_def_id"]))
+        return f"credential-{len(issued)}"
+
+    monkeypatch.setattr(agent_fixtures, "connect_agents", connect_agents)
+    monkeypatch.setattr(agent_fixtures, "issue_credential", issue_credential)
+    # the issuer's public DID
+    agents[ACME][None] = {"did": "AcmeDid"}
+
+    prepare_credentials(Context(config=Context(userdata={"Acme": ACME, "Bob": BOB})))
+    assert issued == [("issue-credential", "acme-bob", "cred-def-1"), ("issue-credential-v2", "acme-bob", "cred-def-1")]
+    assert created == [(ACME, "Schema_DriversLicense", False)]
+    assert agent_fixtures.credential_pool == {
+        (ACME, BOB, "cred-def-1", "Data_DL_MaxValues"): "credential-1",
+        (ACME, BOB, "cred-def-1", "Data_DL_MinValues"): "credential-2",
+    }
+
+
+def test_credentials_are_not_issued_up_front_without_the_fixture_cache(monkeypatch):
+    monkeypatch.setattr(agent_fixtures, "selected_credentials", lambda context: pytest.fail("credentials selected"))
+    prepare_credentials(Context())
@@ -0,0 +1,129 @@
+import json
+import os
+
+import pytest
+
+import agent_test_data
+from agent_test_data import (
+    DataList,
+    DataView,
+    check_credential_data,
+    check_proof_request,
+    check_schema,
+    get_test_data,
+    load_test_data,
+)
+
+SCHEMA = {
+    "schema": {"schema_name": "Schema_DL", "schema_version": "1.0.0", "attributes": ["name", "age"]},
+    "cred_def_support_revocation": False,
+}
+
+
+@pytest.fixture
+def data_folder(tmp_path, monkeypatch):
+    # an empty registry reading from tmp_path
+    for name in ("test_data", "data_problems", "templates"):
+        monkeypatch.setattr(agent_test_data, name, {})
+    monkeypatch.setattr(agent_test_data, "DATA_FOLDER", str(tmp_path))
+
+    def write(name, data):
+        text = data if isinstance(data, str) else json.dumps(data)
+        (tmp_path / f"{name}.json").write_text(text)
+
+    write.folder = str(tmp_path)
+    return write
+
+
+def test_view_copies_nested_data_on_first_read():
+    registry = {"a": {"b": [1, 2]}, "c": "text"}
+    view = DataView(registry)
+    view["a"]["b"].append(3)
+    view["a"]["d"] = 4
+    assert view == {"a": {"b": [1, 2, 3], "d": 4}, "c": "text"}
+    assert registry == {"a": {"b": [1, 2]}, "c": "text"}
+
+
+def test_view_methods_hand_out_copies():
+    registry = {"a": {"x": 1}, "b": [{"y": 2}]}
+    view = DataView(registry)
+    for (_, value) in view.items():
+        value.clear()
+    assert registry == {"a": {"x": 1}, "b": [{"y": 2}]}
+
+    view = DataView(registry)
+    view.get("a")["x"] = 10
+    view.setdefault("b")[0]["y"] = 20
+    view.pop("a")["z"] = 30
+    assert registry == {"a": {"x": 1}, "b": [{"y": 2}]}
+
+
+def test_list_view_copies_items_read_by_index_slice_and_iteration():
+    registry = [{"n": 0}, {"n": 1}, {"n": 2}]
+    view = DataList(registry)
+    view[0]["n"] = 10
+    view[-1]["n"] = 12
+    for item in view[1:2]:
+        item["n"] = 11
+    assert registry == [{"n": 0}, {"n": 1}, {"n": 2}]
+    # like a list slice, the slice shares its items with the view
+    assert [item["n"] for item in view] == [10, 11, 12]
+
+
+def test_copies_are_independent_of_each_other():
+    registry = {"a": {"x": 1}}
+    (first, second) = (DataView(registry), DataView(registry))
+    first["a"]["x"] = 2
+    assert second["a"]["x"] == 1
+
+
+def test_checks_report_the_shape_problems():
+    assert check_schema(SCHEMA) == []
+    assert check_schema({"schema": {"schema_name": "x"}}) == [
+        "the file has no cred_def_support_revocation",
+        "schema has no schema_version",
+        "schema has no attributes",
+    ]
+    assert check_proof_request({"presentation_proposal": {"requested_attributes": []}}) == [
+        "presentation_proposal.requested_attributes is not an object"
+    ]
+
+
+def test_credential_data_must_have_the_schema_attributes():
+    data = {
+        "Data_DL_MaxValues": {"attributes": [{"name": "name", "value": "Alice"}, {"name": "age", "value": "30"}]},
+        "Data_DL_Missing": {"attributes": [{"name": "name", "value": "Bob"}]},
+        "Data_DL_Broken": {"attributes": ["name"]},
+    }
+    assert check_credential_data(data, SCHEMA) == [
+        "Data_DL_Missing.attributes ['name'] are not the schema attributes ['age', 'name']",
+        "Data_DL_Broken.attributes are not all name and value pairs",
+    ]
+
+
+def test_load_reports_unreadable_and_malformed_files(data_folder):
+    data_folder("schema_dl", SCHEMA)
+    data_folder("proof_request_broken", {"requested_attributes": {}})
+    data_folder("presentation_truncated", '{"presentation": ')
+    problems = load_test_data(data_folder.folder)
+    assert set(problems) == {"proof_request_broken", "presentation_truncated"}
+    assert problems["proof_request_broken"] == ["the file has no presentation_proposal"]
+
+    assert get_test_data("schema_dl") == SCHEMA
+    with pytest.raises(ValueError, match="presentation_truncated.json could not be read"):
+        get_test_data("presentation_truncated")
+    with pytest.raises(FileNotFoundError, match="No test data file"):
+        get_test_data("schema_missing")
+
+
+def test_load_reads_the_folder_once(data_folder):
+    data_folder("schema_dl", SCHEMA)
+    load_test_data(data_folder.folder)
+    data_folder("schema_dl", "not json")
+    assert load_test_data(data_folder.folder) == {}
+    assert get_test_data("schema_dl")["schema"]["schema_name"] == "Schema_DL"
+
+
+def test_the_shipped_test_data_has_no_problems(data_folder):
+    folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "features", "data")
+    assert load_test_data(folder) == {}
@@ -0,0 +1,111 @@
+import json
+
+import pytest
+
+import agent_test_data
+from agent_test_data import Slot, compile_template, get_test_data, load_test_data, render_test_data
+
+PROOF_REQUEST = {
+    "presentation_proposal": {
+        "requested_attributes": {
+            "attr_1": {
+                "name": "name",
+                "restrictions": [{"schema_name": "Schema_DL", "cred_def_id": "replace_me", "issuer_did": "replace me"}],
+            }
+        },
+        "requested_predicates": {},
+    }
+}
+
+PRESENTATION = {
+    "presentation": {
+        "requested_attributes": {
+            "attr_1": {"cred_type_name": "Schema_DL", "cred_id": "replace_me", "revealed": True, "timestamp": "-1:now"}
+        },
+        "self_attested_attributes": {},
+    }
+}
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    for name in ("test_data", "data_problems", "templates"):
+        monkeypatch.setattr(agent_test_data, name, {})
+    (tmp_path / "proof_request_DL_name.json").write_text(json.dumps(PROOF_REQUEST))
+    (tmp_path / "presentation_DL_name.json").write_text(json.dumps(PRESENTATION))
+    monkeypatch.setattr(agent_test_data, "DATA_FOLDER", str(tmp_path))
+    assert load_test_data(str(tmp_path)) == {}
+
+
+def test_compile_finds_the_slots_by_path():
+    restrictions = ("presentation_proposal", "requested_attributes", "attr_1", "restrictions", 0)
+    assert compile_template("proof_request_DL_name", PROOF_REQUEST) == [
+        (("presentation_proposal",), [Slot(("presentation_proposal",), "non_revoked", "non_revoked", None)]),
+        (restrictions, [
+            Slot(restrictions, "cred_def_id", "cred_def_id", None),
+            Slot(restrictions, "issuer_did", "issuer_did", None),
+        ]),
+    ]
+
+
+def test_compile_fills_cred_type_fields_and_drops_the_type_name():
+    attr = ("presentation", "requested_attributes", "attr_1")
+    assert compile_template("presentation_DL_name", PRESENTATION) == [
+        (attr, [
+            Slot(attr, "cred_id", "cred_id", "Schema_DL"),
+            Slot(attr, "timestamp", "timestamp", "-1:now"),
+            Slot(attr, "cred_type_name", None, None),
+        ]),
+    ]
+
+
+def test_compile_leaves_data_without_slots_alone():
+    assert compile_template("schema_dl", {"schema": {"schema_name": "replace_me"}}) == []
+
+
+def test_render_fills_the_slots_of_a_view_only(registry):
+    values = {"cred_def_id": "cd:1", "issuer_did": "did:1", "non_revoked": None}
+    data = render_test_data(get_test_data("proof_request_DL_name"), lambda name, arg: values[name])
+    restriction = data["presentation_proposal"]["requested_attributes"]["attr_1"]["restrictions"][0]
+    assert restriction == {"schema_name": "Schema_DL", "cred_def_id": "cd:1", "issuer_did": "did:1"}
+    # a slot without a value is left out
+    assert "non_revoked" not in data["presentation_proposal"]
+    # the registry keeps the template for the next scenario
+    assert get_test_data("proof_request_DL_name") == PROOF_REQUEST
+
+
+def test_render_passes_the_slot_arg_and_removes_the_type_name(registry):
+    calls = []
+
+    def values(name, arg):
+        calls.append((name, arg))
+        return f"{name}-{arg}"
+
+    data = render_test_data(get_test_data("presentation_DL_name"), values)
+    assert data["presentation"]["requested_attributes"]["attr_1"] == {
+        "cred_id": "cred_id-Schema_DL",
+        "revealed": True,
+        "timestamp": "timestamp--1:now",
+    }
+    assert calls == [("cred_id", "Schema_DL"), ("timestamp", "-1:now")]
+
+
+def test_render_a_part_of_a_file_only_fills_its_own_slots(registry):
+    proposal = get_test_data("proof_request_DL_name")["presentation_proposal"]
+    attributes = proposal["requested_attributes"]
+    render_test_data(attributes, lambda name, arg: "filled")
+    assert attributes["attr_1"]["restrictions"][0]["cred_def_id"] == "filled"
+    # the non_revoked slot is on the parent object
+    assert "non_revoked" not in proposal
+
+
+def test_render_leaves_data_from_elsewhere_alone():
+    data = {"cred_def_id": "replace_me"}
+    assert render_test_data(agent_test_data.DataView(data), lambda name, arg: "filled") == data
+
+
+@pytest.mark.parametrize("data", [{"cred_def_id": "replace_me"}, [{"cred_def_id": "replace_me"}]])
+def test_render_refuses_plain_data(data):
+    with pytest.raises(TypeError, match=f"needs data from get_test_data, not a {type(data).__name__}"):
+        render_test_data(data, lambda name, arg: "filled")
+    assert "replace_me" in str(data)
@@ -0,0 +1,93 @@
+import json
+
+from run_parallel import count_statuses, merge_results, shard_scenarios, split_paths
+
+LOCATIONS = [f"features/a.feature:{line}" for line in (10, 20, 30)] + [f"features/b.feature:{line}" for line in (5, 15)]
+
+
+def scenario(location, status="passed"):
+    return {"type": "scenario", "location": location, "status": status}
+
+
+def write_results(folder, worker, features):
+    (folder / f"worker-{worker}.json").write_text(json.dumps(features))
+
+
+def test_shards_round_robin_without_durations():
+    shards = shard_scenarios(LOCATIONS, 2, {})
+    assert shards == [
+        ["features/a.feature:10", "features/a.feature:30", "features/b.feature:15"],
+        ["features/a.feature:20", "features/b.feature:5"],
+    ]
+
+
+def test_shards_balance_known_durations():
+    durations = {
+        "features/a.feature:10": 50.0,
+        "features/a.feature:20": 10.0,
+        "features/a.feature:30": 10.0,
+        "features/b.feature:5": 20.0,
+        "features/b.feature:15": 10.0,
+    }
+    shards = shard_scenarios(LOCATIONS, 2, durations)
+    assert shards[0] == ["features/a.feature:10"]
+    # the rest share the other worker, in file order
+    assert shards[1] == ["features/a.feature:20", "features/a.feature:30", "features/b.feature:5", "features/b.feature:15"]
+
+
+def test_shards_count_unknown_durations_as_the_mean():
+    durations = {"features/a.feature:10": 30.0, "features/a.feature:20": 10.0}
+    shards = shard_scenarios(LOCATIONS, 3, durations)
+    assert sorted(sum(shards, [])) == sorted(LOCATIONS)
+    assert shards[0] == ["features/a.feature:10"]
+    assert all(shards)
+
+
+def test_every_scenario_lands_in_exactly_one_shard():
+    for workers in (1, 2, 4, 5):
+        shards = shard_scenarios(LOCATIONS, workers, {})
+        assert len(shards) == workers
+        assert sorted(sum(shards, [])) == sorted(LOCATIONS)
+
+
+def test_split_paths_keeps_option_values_with_their_options():
+    (options, paths) = split_paths(
+        ["--tags=@AcceptanceTest", "-t", "~@wip", "features/a.feature", "-D", "Acme=http://x", "features/b.feature:5"]
+    )
+    assert options == ["--tags=@AcceptanceTest", "-t", "~@wip", "-D", "Acme=http://x"]
+    assert paths == ["features/a.feature", "features/b.feature:5"]
+
+
+def test_split_paths_treats_everything_after_a_separator_as_paths():
+    assert split_paths(["--no-skipped", "--", "-odd-name.feature"]) == (["--no-skipped"], ["-odd-name.feature"])
+
+
+def test_merge_keeps_each_workers_own_scenarios_in_file_order(tmp_path):
+    shards = [["features/a.feature:20"], ["features/a.feature:10", "features/b.feature:5"]]
+    write_results(tmp_path, 0, [
+        {"location": "features/a.feature:1", "status": "failed", "elements": [
+            scenario("features/a.feature:10", "skipped"), scenario("features/a.feature:20", "failed")]},
+    ])
+    write_results(tmp_path, 1, [
+        {"location": "features/a.feature:1", "status": "passed", "elements": [
+            scenario("features/a.feature:10"), scenario("features/a.feature:20", "skipped")]},
+        {"location": "features/b.feature:1", "status": "passed", "elements": [scenario("features/b.feature:5")]},
+    ])
+    (features, missing) = merge_results(str(tmp_path), shards)
+    assert missing == []
+    assert [feature["location"] for feature in features] == ["features/a.feature:1", "features/b.feature:1"]
+    assert [e["location"] for e in features[0]["elements"]] == ["features/a.feature:10", "features/a.feature:20"]
+    assert features[0]["status"] == "failed"
+    assert count_statuses(features) == {"passed": 2, "failed": 1}
+
+
+def test_merge_reports_workers_without_results(tmp_path):
+    shards = [["features/a.feature:10"], ["features/a.feature:20"], ["features/b.feature:5"]]
+    write_results(tmp_path, 0, [
+        {"location": "features/a.feature:1", "status": "passed", "elements": [scenario("features/a.feature:10")]},
+    ])
+    # worker 1 never wrote its file, worker 2 was stopped halfway through writing it
+    (tmp_path / "worker-2.json").write_text('[{"location": "features/b.feature:1", "elem')
+    (features, missing) = merge_results(str(tmp_path), shards)
+    assert missing == [1, 2]
+    assert count_statuses(features) == {"passed": 1}